@@ -1,6 +1,14 @@
+from __future__ import annotations
+
 from ngen.cal import hookimpl
 from ngen.cal.meta import JobMeta
 from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+import atexit
+import os
+import re
+import shutil
+import tarfile
 
 class NgenSaveOutput:
     runoff_pattern = "cat-*.csv"
@@ -35,6 +43,114 @@ class NgenSaveOutput:
             for f in g:
                 f.rename(out_dir / f.name)
 
+class NgenArchiveOutput(NgenSaveOutput):
+    """
+    Archiving mode of NgenSaveOutput: the outputs of each iteration are moved (renamed, no copy) to a
+    staging directory and packed into one compressed bundle (output_archive/output_{iteration}.tar.gz)
+    by a background thread, so the next iteration starts without waiting for file I/O.
+    Retention: only the bundles of the keep_best iterations with the best (lowest) objective and the
+    keep_latest most recent iterations are kept (keep_best = None keeps all bundles).
+    A failed bundle (tar error, full disk, retention) is printed when it fails and raised by
+    ngen_cal_finish; its staging directory is kept.
+    """
+    archive_dir  = "output_archive"
+    compression  = "gz"   # "gz", "bz2", "xz" or "" (no compression)
+    keep_best    = 5
+    keep_latest  = 1
+    objective_pattern = "*objective*.txt"
+
+    def __init__(self) -> None:
+        # one worker, bundles are written in iteration order
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures: list[Future] = []
+        atexit.register(self._executor.shutdown, wait=True)
+
+    @hookimpl
+    def ngen_cal_model_iteration_finish(self, iteration: int, info: JobMeta) -> None:
+        path = info.workdir
+        staging_dir = path / f".output_{iteration}"
+        Path.mkdir(staging_dir, exist_ok=True)
+
+        patterns = [self.runoff_pattern, self.lateral_pattern, self.terminal_pattern, self.coastal_pattern,
+                    self.routing_output_stream, self.routing_csv_output, self.ngen_json]
+        for pattern in patterns:
+            for f in path.glob(pattern):
+                f.rename(staging_dir / f.name)
+
+        future = self._executor.submit(self._archive, path, iteration, staging_dir)
+        future.add_done_callback(lambda f: self._report(f, iteration, staging_dir))
+        self._futures.append(future)
+
+    @hookimpl
+    def ngen_cal_finish(self, exception: Exception | None) -> None:
+        # wait for the pending bundles
+        self._executor.shutdown(wait=True)
+
+        futures, self._futures = self._futures, []
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        # an exception of the calibration itself is not masked
+        if len(errors) > 0 and exception is None:
+            raise RuntimeError(f"{len(errors)} output bundle(s) failed, first error: {errors[0]!r}") from errors[0]
+
+    @staticmethod
+    def _report(future: Future, iteration: int, staging_dir: Path) -> None:
+        if future.exception() is not None:
+            kept = f", outputs kept in {staging_dir}" if staging_dir.is_dir() else ""
+            print(f"Output bundle of iteration {iteration} failed ({future.exception()!r}){kept}", flush=True)
+
+    def _archive(self, path: Path, iteration: int, staging_dir: Path) -> None:
+        archive_dir = path / self.archive_dir
+        Path.mkdir(archive_dir, exist_ok=True)
+
+        ext = f".tar.{self.compression}" if self.compression else ".tar"
+        bundle = archive_dir / f"output_{iteration}{ext}"
+        tmp_bundle = archive_dir / f".output_{iteration}{ext}.tmp"
+
+        with tarfile.open(tmp_bundle, f"w:{self.compression}") as tar:
+            for f in sorted(staging_dir.iterdir()):
+                tar.add(f, arcname=f"output_{iteration}/{f.name}")
+        os.replace(tmp_bundle, bundle)
+        shutil.rmtree(staging_dir)
+
+        self._apply_retention(path, archive_dir)
+
+    def _read_objectives(self, path: Path) -> dict[int, float]:
+        # objective log lines: "iteration, objective"
+        objective = {}
+        for f in path.glob(self.objective_pattern):
+            with open(f, "r") as infile:
+                for line in infile:
+                    try:
+                        i, value = line.replace(",", " ").split()[:2]
+                        objective[int(i)] = float(value)
+                    except ValueError:
+                        pass
+        return objective
+
+    def _apply_retention(self, path: Path, archive_dir: Path) -> None:
+        if self.keep_best is None:
+            return
+
+        bundles = {}
+        for f in archive_dir.glob("output_*.tar*"):
+            match = re.match(r"output_(\d+)\.tar", f.name)
+            if match is not None:
+                bundles[int(match.group(1))] = f
+
+        iterations = sorted(bundles)
+        keep = set(iterations[-self.keep_latest:]) if self.keep_latest > 0 else set()
+
+        # ngen-cal minimizes the objective function; iterations not scored yet are kept
+        objective = self._read_objectives(path)
+        scored = sorted([i for i in iterations if i in objective], key=objective.get)
+        keep.update(scored[:self.keep_best])
+        last_scored = max(objective) if len(objective) > 0 else -1
+        keep.update([i for i in iterations if i > last_scored])
+
+        for i in iterations:
+            if i not in keep:
+                bundles[i].unlink()
+
 #from __future__ import annotations
 
 #import shutil
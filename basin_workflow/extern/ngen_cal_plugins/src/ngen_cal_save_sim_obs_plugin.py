@@ -5,7 +5,13 @@ import typing
 from ngen.cal import hookimpl
 from hypy.nexus import Nexus
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 from pathlib import Path
+import atexit
+import os
+import time
 
 #from download_nwm_streamflow import
 
@@ -13,6 +19,59 @@ if typing.TYPE_CHECKING:
     from datetime import datetime
     from ngen.cal.meta import JobMeta
 
+# SaveOutput writes output_sim_obs/sim_obs_{iteration}.csv in the ngen-cal workdir on every iteration
+# SaveOutputParquet (opt-in, use instead of SaveOutput) keeps the sim/obs history in a parquet store
+# (output_sim_obs directory of the ngen-cal workdir)
+#  - obs.parquet            : time, obs_flow (written once)
+#  - sim_{run}.parquet      : iteration, time, sim_flow; one row group per iteration, one file per ngen-cal run
+#                             (a resumed calibration adds a file)
+obs_file_name = "obs.parquet"
+sim_file_pattern = "sim_*.parquet"
+
+sim_schema = pa.schema([("iteration", pa.int32()),
+                        ("time", pa.timestamp("ns")),
+                        ("sim_flow", pa.float64())])
+
+
+def _sim_files(store_dir: Path) -> list[str]:
+    # files of interrupted runs (no parquet footer) are skipped
+    files = []
+    for f in sorted(store_dir.glob(sim_file_pattern)):
+        try:
+            pq.read_metadata(f)
+            files.append(str(f))
+        except (OSError, pa.ArrowInvalid):
+            pass
+    return files
+
+
+def read_iteration(store_dir: Path | str, iteration: int) -> pd.DataFrame:
+    """
+    Returns the hydrograph (time, sim_flow, obs_flow) of one iteration; row groups of the other
+    iterations are skipped using the iteration statistics.
+    """
+    store_dir = Path(store_dir)
+    dataset = ds.dataset(_sim_files(store_dir), schema=sim_schema, format="parquet")
+    df = dataset.to_table(columns=["time", "sim_flow"], filter=ds.field("iteration") == iteration).to_pandas()
+
+    obs_file = store_dir / obs_file_name
+    if obs_file.exists():
+        df = df.merge(pd.read_parquet(obs_file), on="time", how="left")
+    return df.set_index("time")
+
+
+def read_timestamp(store_dir: Path | str, timestamp) -> pd.Series:
+    """
+    Returns the simulated flow of all iterations at a given time (Series indexed by iteration);
+    only the time and sim_flow columns are read.
+    """
+    store_dir = Path(store_dir)
+    dataset = ds.dataset(_sim_files(store_dir), schema=sim_schema, format="parquet")
+    df = dataset.to_table(columns=["iteration", "sim_flow"],
+                          filter=ds.field("time") == pa.scalar(pd.Timestamp(timestamp), pa.timestamp("ns"))).to_pandas()
+    return df.set_index("iteration")["sim_flow"].sort_index()
+
+
 class SaveOutput:
     def __init__(self) -> None:
         self.sim: pd.Series | None = None
@@ -82,3 +141,54 @@ class SaveOutput:
         if (not out_dir.is_dir()):
             Path.mkdir(out_dir)
         df.to_csv(f"{out_dir}/sim_obs_{iteration}.csv")
+
+
+class SaveOutputParquet(SaveOutput):
+    """
+    Same as SaveOutput, but the sim/obs history is stored in parquet (obs.parquet and sim_{run}.parquet,
+    see read_iteration and read_timestamp) instead of one csv file per iteration.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.writer: pq.ParquetWriter | None = None
+        atexit.register(self.close)
+
+    @hookimpl
+    def ngen_cal_model_iteration_finish(self, iteration: int, info: JobMeta) -> None:
+        if self.sim is None:
+            return None
+        assert self.obs is not None, "make sure `ngen_cal_model_observations` was called"
+
+        path = info.workdir
+        out_dir = path / f"output_sim_obs"
+        if (not out_dir.is_dir()):
+            Path.mkdir(out_dir)
+
+        # observations are stored once
+        if self.save_obs_nwm:
+            self.save_obs_nwm = False
+            obs = pd.DataFrame({"time": pd.to_datetime(self.obs.index).astype("datetime64[ns]"),
+                                "obs_flow": self.obs.to_numpy(dtype="float64")})
+            obs.to_parquet(out_dir / obs_file_name, index=False)
+
+        if self.writer is None:
+            sim_file = out_dir / f"sim_{time.strftime('%Y%m%d%H%M%S')}_{os.getpid()}.parquet"
+            self.writer = pq.ParquetWriter(sim_file, sim_schema)
+
+        table = pa.table({"iteration": pa.array([iteration] * len(self.sim), pa.int32()),
+                          "time": pa.array(pd.to_datetime(self.sim.index).astype("datetime64[ns]")),
+                          "sim_flow": pa.array(self.sim.to_numpy(dtype="float64"))},
+                         schema=sim_schema)
+        # one row group per iteration
+        self.writer.write_table(table, row_group_size=len(table) + 1)
+
+    @hookimpl
+    def ngen_cal_finish(self, exception: Exception | None) -> None:
+        self.close()
+
+    def close(self) -> None:
+        # writes the parquet footer, the sim file is readable afterwards
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
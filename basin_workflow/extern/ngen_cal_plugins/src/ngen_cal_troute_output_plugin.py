@@ -0,0 +1,97 @@
+from __future__ import annotations
+
+import typing
+from pathlib import Path
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from ngen.cal import hookimpl
+
+if typing.TYPE_CHECKING:
+    from ngen.cal.model import ModelExec
+
+# t-route parquet stream output (stream_output_type: '.parquet'), long format: one row per
+# segment, time and variable; only the rows of the evaluated segment are read (predicate pushdown)
+id_columns       = ["location_id", "feature_id"]
+time_columns     = ["value_time", "time", "current_time"]
+variable_columns = ["variable_name"]
+
+
+def _first(columns: list[str], names: list[str]) -> str | None:
+    for name in columns:
+        if name in names:
+            return name
+    return None
+
+
+def read_troute_parquet(
+    filepath: Path | str, id: str, variable: str = "streamflow"
+) -> pd.Series:
+    """
+    Read the time series of one segment (e.g. `wb-3550`) from a t-route parquet output file
+    without loading the rest of the network.
+    """
+    schema = pq.read_schema(filepath)
+    names = schema.names
+
+    id_col = _first(id_columns, names)
+    time_col = _first(time_columns, names)
+    var_col = _first(variable_columns, names)
+    if id_col is None or time_col is None:
+        raise ValueError(f"unexpected t-route parquet output columns: {names}")
+
+    # segment ids are stored either as `wb-<id>` strings or as integers
+    number = str(id).split("-")[-1]
+    if pd.api.types.is_integer_dtype(schema.field(id_col).type.to_pandas_dtype()):
+        ids = [int(number)]
+    else:
+        ids = [str(id), number]
+
+    filters = [(id_col, "in", ids)]
+    if var_col is not None:
+        filters.append((var_col, "==", variable))
+
+    df = pd.read_parquet(filepath, columns=[time_col, "value"], filters=filters)
+
+    sim = df.set_index(pd.to_datetime(df[time_col]))["value"].sort_index()
+    sim = sim.resample("1h").first()
+    sim.name = "sim_flow"
+    return sim
+
+
+class TrouteParquetOutput:
+    """
+    Reads the simulated flow at the evaluation feature from t-route parquet output
+    (`troute_output_*.parquet`) in the directory of the configured model `routing_output`
+    (relative paths are resolved against the model workdir).
+    """
+
+    def __init__(self) -> None:
+        self.config: ModelExec | None = None
+
+    @hookimpl
+    def ngen_cal_model_configure(self, config: ModelExec) -> None:
+        self.config = config
+
+    def _output_files(self) -> list[Path]:
+        routing_output = getattr(self.config, "routing_output", None)
+        if routing_output is None:
+            return []
+
+        # t-route appends the output time to the file name, e.g. troute_output_201010010000.parquet
+        routing_output = Path(routing_output)
+        if not routing_output.is_absolute():
+            routing_output = Path(getattr(self.config, "workdir", None) or ".") / routing_output
+        return list(routing_output.parent.glob(f"{routing_output.stem}_*.parquet"))
+
+    @hookimpl
+    def ngen_cal_model_output(self, id: str | None) -> pd.Series | None:
+        if id is None:
+            return None
+
+        files = sorted(self._output_files(), key=lambda f: f.stat().st_mtime)
+        if len(files) == 0:
+            return None
+
+        return read_troute_parquet(files[-1], id)
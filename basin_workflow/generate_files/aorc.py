@@ -0,0 +1,322 @@
+"""
+Multi-basin AORC forcing generation (used by forcing.py when forcing_multibasin is True)
+ - the AORC grid cells of each basin and their area weights in the divides are found first (sparse
+   cells x divides matrix, persisted per geopackage as .npz), then the union of the zarr chunks needed by all basins is
+   fetched/decoded once into a local chunk cache ({cache_dir}/{year}/{variable}/{t}.{y}.{x}.npy)
+ - per-divide areal averages (one sparse mat-mul per time chunk) are then computed for many basins in
+   parallel from the chunk cache
+ - aorc_source can be a s3 bucket (s3://noaa-nws-aorc-v1-1-1km) or a local directory holding the
+   yearly zarr stores (same layout)
+ - output: one ngen NetCDF forcing file per basin, same layout as forcing_prep output
+   (data/forcing/{start_yr}_to_{end_yr}/{gpkg_name}_{start_yr}_to_{end_yr}.nc)
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import xarray as xr
+import netCDF4
+import scipy.sparse
+import shapely
+from pathlib import Path
+from dataclasses import dataclass
+
+try:
+    from generate_files import configuration
+except:
+    import configuration
+
+aorc_variables = ["APCP_surface", "DLWRF_surface", "DSWRF_surface", "PRES_surface",
+                  "SPFH_2maboveground", "TMP_2maboveground", "UGRD_10maboveground", "VGRD_10maboveground"]
+
+epoch = pd.Timestamp("1970-01-01 00:00:00")
+
+# opened yearly zarr stores, kept per process (workers open each store once)
+_datasets = {}
+
+#############################################################################
+# returns the AORC zarr store of a year
+#############################################################################
+def open_aorc_year(aorc_source, url_template, year):
+
+    url = url_template.format(source=aorc_source, year=year)
+
+    if (url not in _datasets):
+        if (url.startswith("s3://")):
+            _datasets[url] = xr.open_zarr(url, storage_options={"anon": True})
+        elif (not os.path.isdir(url)):
+            raise FileNotFoundError(f"AORC zarr store of year {year} does not exist: {url}")
+        else:
+            _datasets[url] = xr.open_zarr(url)
+
+    return _datasets[url]
+
+#############################################################################
+# grid of a yearly AORC zarr store: coordinates and chunk sizes (time, y, x)
+#############################################################################
+@dataclass
+class AorcGrid:
+    year   : int
+    time   : np.ndarray
+    lat    : np.ndarray
+    lon    : np.ndarray
+    chunks : tuple
+
+def get_aorc_grid(aorc_source, url_template, year, x_lon_dim = "longitude", y_lat_dim = "latitude"):
+
+    ds = open_aorc_year(aorc_source, url_template, year)
+    da = ds[aorc_variables[0]]
+
+    chunks = dict(zip(da.dims, da.encoding.get('chunks', da.shape)))
+
+    return AorcGrid(year   = year,
+                    time   = ds['time'].values,
+                    lat    = ds[y_lat_dim].values,
+                    lon    = ds[x_lon_dim].values,
+                    chunks = (chunks['time'], chunks[y_lat_dim], chunks[x_lon_dim]))
+
+#############################################################################
+# AORC cells of a basin and their mapping to the divides
+# @param gpkg_file  : basin geopackage
+# @param divide_ids : divide ids (output order)
+# @param iy, ix     : grid indices of the cells
+# @param weights    : sparse matrix (cells x divides), columns sum to 1 (areal averaging)
+#############################################################################
+@dataclass
+class BasinCells:
+    gpkg_file  : str
+    divide_ids : np.ndarray
+    iy         : np.ndarray
+    ix         : np.ndarray
+    weights    : scipy.sparse.csr_matrix
+
+    # spatial chunks (y, x) holding the cells
+    def get_chunks(self, chunks):
+        return set(zip((self.iy // chunks[1]).tolist(), (self.ix // chunks[2]).tolist()))
+
+#############################################################################
+# returns the weights file of a basin (persisted sparse cells x divides matrix)
+#############################################################################
+def get_weights_file(gpkg_file):
+    return os.path.join(os.path.dirname(gpkg_file), Path(gpkg_file).stem + "_aorc_weights.npz")
+
+# key of the inputs the weights depend on (geopackage and AORC grid)
+def get_weights_key(gpkg_file, lat, lon):
+    stat = os.stat(gpkg_file)
+    return np.array([stat.st_mtime_ns, stat.st_size, len(lat), len(lon), lat[0], lat[-1], lon[0], lon[-1]],
+                    dtype=np.float64)
+
+def save_basin_cells(cells, weights_file, key):
+    w = cells.weights.tocsr()
+    np.savez(weights_file, key = key, divide_ids = cells.divide_ids, iy = cells.iy, ix = cells.ix,
+             data = w.data, indices = w.indices, indptr = w.indptr, shape = np.array(w.shape))
+
+def load_basin_cells(gpkg_file, weights_file, key):
+    if (not os.path.exists(weights_file)):
+        return None
+    try:
+        d = np.load(weights_file)
+        if (not np.array_equal(d['key'], key)):
+            return None
+        weights = scipy.sparse.csr_matrix((d['data'], d['indices'], d['indptr']), shape=tuple(d['shape']))
+        return BasinCells(gpkg_file = gpkg_file, divide_ids = d['divide_ids'], iy = d['iy'], ix = d['ix'],
+                          weights = weights)
+    except:
+        return None
+
+#############################################################################
+# finds the AORC cells of a basin and the weights of each cell in the divides (area of the cell within
+# the divide over the divide area), the sparse weights matrix is persisted next to the geopackage
+# (data/{gpkg_name}_aorc_weights.npz) and reused as long as the geopackage and the grid are unchanged
+#############################################################################
+def get_basin_cells(gpkg_file, lat, lon):
+
+    weights_file = get_weights_file(gpkg_file)
+    key = get_weights_key(gpkg_file, lat, lon)
+
+    cells = load_basin_cells(gpkg_file, weights_file, key)
+    if (cells is None):
+        cells = compute_basin_cells(gpkg_file, lat, lon)
+        save_basin_cells(cells, weights_file, key)
+
+    return cells
+
+def compute_basin_cells(gpkg_file, lat, lon):
+
+    basin = configuration.BasinGeopackage(gpkg_file)
+    divides = basin.divides_4326
+    divide_ids = divides.index.to_numpy(dtype=str)
+
+    # cells within the basin bounding box (plus one cell)
+    minx, miny, maxx, maxy = divides.total_bounds
+    dy = abs(lat[1] - lat[0])
+    dx = abs(lon[1] - lon[0])
+    ys = np.where((lat >= miny - dy) & (lat <= maxy + dy))[0]
+    xs = np.where((lon >= minx - dx) & (lon <= maxx + dx))[0]
+
+    iy, ix = np.meshgrid(ys, xs, indexing='ij')
+    iy = iy.ravel()
+    ix = ix.ravel()
+
+    # cell polygons, intersected with the divides in the geopackage (projected) CRS
+    boxes = shapely.box(lon[ix] - dx / 2, lat[iy] - dy / 2, lon[ix] + dx / 2, lat[iy] + dy / 2)
+    cells_gdf = gpd.GeoDataFrame(geometry=boxes, crs="EPSG:4326").to_crs(basin.divides.crs)
+    divs_gdf  = basin.divides[['divide_id', 'geometry']]
+
+    joined = gpd.sjoin(cells_gdf, divs_gdf, predicate='intersects', how='inner')
+    area = shapely.area(shapely.intersection(cells_gdf.geometry.values[joined.index.values],
+                                             divs_gdf.geometry.values[joined['index_right'].values]))
+
+    keep = area > 0
+    cell_div  = pd.Index(divide_ids).get_indexer(joined['divide_id'].values[keep])
+    cell_iy   = iy[joined.index.values[keep]]
+    cell_ix   = ix[joined.index.values[keep]]
+    cell_area = area[keep]
+
+    # divides outside the grid get the cell nearest to their centroid
+    missing = np.setdiff1d(np.arange(len(divide_ids)), cell_div)
+    if (len(missing) > 0):
+        centroids = basin.centroids.iloc[missing]
+        near_iy = np.abs(lat[:, None] - centroids.y.values[None, :]).argmin(axis=0)
+        near_ix = np.abs(lon[:, None] - centroids.x.values[None, :]).argmin(axis=0)
+        cell_div  = np.concatenate([cell_div, missing])
+        cell_iy   = np.concatenate([cell_iy, near_iy])
+        cell_ix   = np.concatenate([cell_ix, near_ix])
+        cell_area = np.concatenate([cell_area, np.ones(len(missing))])
+
+    # unique cells (rows) and the area weights of each divide (columns sum to 1)
+    cells, cell_index = np.unique(np.stack([cell_iy, cell_ix], axis=1), axis=0, return_inverse=True)
+    area_div = np.bincount(cell_div, weights=cell_area, minlength=len(divide_ids))
+    weights = scipy.sparse.csr_matrix((cell_area / area_div[cell_div], (cell_index.ravel(), cell_div)),
+                                      shape=(len(cells), len(divide_ids)))
+
+    return BasinCells(gpkg_file = gpkg_file, divide_ids = divide_ids, iy = cells[:, 0], ix = cells[:, 1],
+                      weights = weights)
+
+#############################################################################
+# chunk cache file of a variable
+#############################################################################
+def get_chunk_file(cache_dir, year, var, ct, cy, cx):
+    return os.path.join(cache_dir, str(year), var, f"{ct}.{cy}.{cx}.npy")
+
+#############################################################################
+# fetches and decodes one zarr chunk (all variables) into the chunk cache, skipped if cached already
+# @param task : (aorc_source, url_template, grid, ct, cy, cx, cache_dir, x_lon_dim, y_lat_dim)
+# - returns   : number of variables fetched
+#############################################################################
+def fetch_chunk(task):
+
+    aorc_source, url_template, grid, ct, cy, cx, cache_dir, x_lon_dim, y_lat_dim = task
+
+    chunk_t, chunk_y, chunk_x = grid.chunks
+    nfetched = 0
+
+    for var in aorc_variables:
+        chunk_file = get_chunk_file(cache_dir, grid.year, var, ct, cy, cx)
+        if (os.path.exists(chunk_file)):
+            continue
+
+        ds = open_aorc_year(aorc_source, url_template, grid.year)
+        da = ds[var].isel({"time"    : slice(ct * chunk_t, (ct + 1) * chunk_t),
+                           y_lat_dim : slice(cy * chunk_y, (cy + 1) * chunk_y),
+                           x_lon_dim : slice(cx * chunk_x, (cx + 1) * chunk_x)})
+        values = da.transpose("time", y_lat_dim, x_lon_dim).values.astype(np.float32)
+
+        os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+        tmp_file = f"{chunk_file}.{os.getpid()}.tmp.npy"
+        np.save(tmp_file, values)
+        os.replace(tmp_file, chunk_file)
+        nfetched += 1
+
+    return nfetched
+
+#############################################################################
+# returns the fetch tasks of the union of chunks needed by all basins for the given years
+#############################################################################
+def get_fetch_tasks(basins_cells, grids, aorc_source, url_template, cache_dir, x_lon_dim, y_lat_dim):
+
+    tasks = []
+    for grid in grids:
+        chunks = set()
+        for cells in basins_cells:
+            chunks |= cells.get_chunks(grid.chunks)
+
+        nct = int(np.ceil(len(grid.time) / grid.chunks[0]))
+        for ct in range(nct):
+            for cy, cx in sorted(chunks):
+                tasks.append((aorc_source, url_template, grid, ct, cy, cx, cache_dir, x_lon_dim, y_lat_dim))
+
+    return tasks
+
+#############################################################################
+# computes the per-divide areal averages of a basin from the chunk cache and writes the ngen forcing file
+#  - the file is created with the time steps of all years, each time chunk is averaged and written
+#    on its own (memory does not grow with the simulation length)
+# @param cells     : BasinCells of the basin
+# @param grids     : AorcGrid of each year
+# @param cache_dir : chunk cache directory
+# @param out_file  : output NetCDF forcing file
+#############################################################################
+def write_basin_forcing(cells, grids, cache_dir, out_file):
+
+    ncats  = len(cells.divide_ids)
+    ntimes = sum(len(grid.time) for grid in grids)
+
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+
+    with netCDF4.Dataset(tmp_file, "w", format="NETCDF4") as ds:
+        ds.createDimension("catchment-id", ncats)
+        ds.createDimension("time", ntimes)
+
+        ids = ds.createVariable("ids", str, ("catchment-id",))
+        ids[:] = np.asarray(cells.divide_ids, dtype=object)
+
+        # catchment-major, the time series of a catchment is stored contiguously
+        time_var = ds.createVariable("Time", "f8", ("catchment-id", "time"), contiguous=True)
+        time_var.units = "s"
+        time_var.epoch_start = "01/01/1970 00:00:00"
+
+        nc_vars = {var : ds.createVariable(var, "f4", ("catchment-id", "time"), contiguous=True)
+                   for var in aorc_variables}
+
+        start = 0
+        for grid in grids:
+            chunk_t, chunk_y, chunk_x = grid.chunks
+            nct = int(np.ceil(len(grid.time) / chunk_t))
+
+            cy = cells.iy // chunk_y
+            cx = cells.ix // chunk_x
+            chunks = sorted(set(zip(cy.tolist(), cx.tolist())))
+
+            for ct in range(nct):
+                nt  = min(chunk_t, len(grid.time) - ct * chunk_t)
+                end = start + nt
+
+                times   = pd.DatetimeIndex(grid.time[ct * chunk_t : ct * chunk_t + nt])
+                seconds = (times - epoch) // pd.Timedelta(seconds=1)
+                time_var[:, start:end] = np.broadcast_to(np.asarray(seconds, dtype=np.float64), (ncats, nt))
+
+                for var in aorc_variables:
+                    values = np.empty((nt, len(cells.iy)), dtype=np.float32)
+
+                    for (y, x) in chunks:
+                        cell_loc = np.where((cy == y) & (cx == x))[0]
+                        arr = np.load(get_chunk_file(cache_dir, grid.year, var, ct, y, x), mmap_mode='r')
+                        values[:, cell_loc] = arr[:, cells.iy[cell_loc] - y * chunk_y, cells.ix[cell_loc] - x * chunk_x]
+
+                    # areal average of all divides (time x divides)
+                    average = np.asarray(values @ cells.weights, dtype=np.float32)
+
+                    # AORC precipitation is hourly accumulation [kg/m2], ngen expects a rate [kg/m2/sec]
+                    if (var == "APCP_surface"):
+                        average = average / np.float32(3600.0)
+
+                    nc_vars[var][:, start:end] = average.T
+
+                start = end
+
+    os.replace(tmp_file, out_file)
+
+    return out_file
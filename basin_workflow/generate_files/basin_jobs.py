@@ -0,0 +1,421 @@
+"""
+Basin discovery and job manifest of the config files generation
+ - the basin directories (output_dir/*/data/*.gpkg) are scanned once with os.scandir, basins are yielded
+   as they are found
+ - forcing files (ForcingResolver): if all basins' .nc files are in one directory, the directory is scanned
+   once and indexed by basin id (parsed from the file names with forcing_id_pattern, or exact file name
+   tokens), so the forcing file of a basin is an exact dict lookup; the per-basin paths of the `{*}`
+   template (forcing_source local) and of Nels_forcing_prep are checked for all basins up front, one
+   directory listing per parent directory (listed concurrently)
+ - the job manifest (output_dir/basins_manifest.json) holds basin id, basin directory, geopackage and
+   forcing file of each basin, and the forcing settings the forcing files were resolved with; it is rebuilt on
+   every run unless rescan_basins is False. A reused manifest is not trusted for forcing: all forcing files are
+   resolved again if the forcing settings changed, otherwise the stored forcing files are checked (one listing
+   per parent directory) and the missing ones are resolved again
+ - sharding (array jobs): shard "i/N" takes the basins with crc32(basin_id) % N == i (independent of the
+   scan order and of the other basins)
+ - resumable runs: each shard appends the result of every basin to output_dir/jobs/shard_{i}_of_{N}.csv as
+   it completes; with resume True the basins already passed are skipped. basins_passed.csv (read by the
+   runner) is rebuilt from the N shard files after each shard
+ - usage (manifest and shard sizes, or merge the shard results):
+   python basin_jobs.py -o output_dir [-f forcing_dir] [-n N] [-merge]
+"""
+
+import os, sys
+import re
+import csv
+import json
+import zlib
+import platform
+import argparse
+import concurrent.futures
+from pathlib import Path
+import pandas as pd
+
+manifest_name  = "basins_manifest.json"
+jobs_dir_name  = "jobs"
+shard_env      = "BASIN_WORKFLOW_SHARD"
+status_columns = ['basin_id', 'n_cats', 'status']
+
+#############################################################################
+# returns the basin id from the geopackage name (Gage_01047000.gpkg -> 01047000)
+#############################################################################
+def get_basin_id(gpkg_name):
+    last_underscore_index = gpkg_name.rfind('_')
+    dot_index = gpkg_name.rfind('.')
+    return gpkg_name[last_underscore_index + 1:dot_index]
+
+# returns the first geopackage (sorted by name) in dir/data, None if there is none
+def get_gpkg_file(dir):
+    try:
+        with os.scandir(os.path.join(dir, "data")) as entries:
+            gpkgs = sorted(e.name for e in entries if e.name.endswith(".gpkg") and e.is_file())
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return os.path.join(dir, "data", gpkgs[0]) if len(gpkgs) > 0 else None
+
+#############################################################################
+# yields the basins of output_dir as they are found: dict (basin_id, dir, gpkg_file)
+#############################################################################
+def scan_basins(output_dir):
+    with os.scandir(output_dir) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if (not entry.is_dir()):
+                continue
+            gpkg_file = get_gpkg_file(entry.path)
+            if (gpkg_file is None):
+                continue
+            yield {"basin_id"  : get_basin_id(os.path.basename(gpkg_file)),
+                   "dir"       : os.path.join(entry.path, ""),
+                   "gpkg_file" : gpkg_file}
+
+#############################################################################
+# index of the forcing files of a directory by basin id
+# @param files      : forcing files
+# @param id_pattern : regular expression extracting the basin id from the file name (group `id` or the
+#                     first group, e.g. "forcing_(?P<id>[0-9]+)"); if empty, the file names are split into
+#                     alphanumeric tokens and digit runs (basin_01047000_2010.nc -> basin, 01047000, 2010)
+#                     and the basin id has to be one of the tokens
+#############################################################################
+class ForcingIndex:
+
+    def __init__(self, files, id_pattern = ""):
+        self.files = list(files)
+        self.index = {}
+
+        pattern = re.compile(id_pattern) if id_pattern else None
+        for f in self.files:
+            stem = os.path.splitext(os.path.basename(f))[0]
+            if (pattern is not None):
+                match = pattern.search(stem)
+                if (match is None):
+                    continue
+                ids = [match.group("id") if "id" in pattern.groupindex else match.group(1 if pattern.groups else 0)]
+            else:
+                ids = set(re.findall(r"[A-Za-z0-9]+", stem)) | set(re.findall(r"[0-9]+", stem))
+
+            for id in ids:
+                self.index.setdefault(id, []).append(f)
+
+    @classmethod
+    def from_dir(cls, forcing_dir, id_pattern = "", ext = ".nc"):
+        with os.scandir(forcing_dir) as entries:
+            files = sorted(e.path for e in entries if e.name.endswith(ext) and e.is_file())
+        return cls(files, id_pattern)
+
+    # forcing file of the basin (exact id match), None if no file or more than one file matches
+    def lookup(self, basin_id):
+        files = self.index.get(str(basin_id), [])
+        return files[0] if len(files) == 1 else None
+
+    def __len__(self):
+        return len(self.files)
+
+#############################################################################
+# lists many directories concurrently (one os.scandir per directory)
+# - returns : dict {directory : sorted list of names}, None for directories that do not exist
+#############################################################################
+def list_dirs(dirs, max_workers = 16):
+
+    def scan(dir):
+        try:
+            with os.scandir(dir) as entries:
+                return sorted(e.name for e in entries)
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+    dirs = list(dict.fromkeys(dirs))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(dirs, executor.map(scan, dirs)))
+
+# returns the paths that exist, one listing of each parent directory
+def batch_exists(paths):
+    listings = list_dirs(os.path.dirname(os.path.normpath(p)) for p in paths)
+    exist = set()
+    for p in paths:
+        names = listings[os.path.dirname(os.path.normpath(p))]
+        if (names is not None and os.path.basename(os.path.normpath(p)) in names):
+            exist.add(p)
+    return exist
+
+#############################################################################
+# resolves the forcing file (or csv forcing directory) of the basins
+# @param forcing_source    : local, Nels_forcing_prep, or empty
+# @param forcing_dir       : directory of all basins' .nc files, or template with {*} (basin directory name)
+# @param is_netcdf_forcing : True for NetCDF forcing (one file per basin), False for csv forcing directories
+# @param simulation_time   : simulation start/end time (json string or dict, Nels_forcing_prep paths)
+# @param id_pattern        : basin id pattern of the forcing file names (see ForcingIndex)
+#############################################################################
+class ForcingResolver:
+
+    def __init__(self, forcing_source = "", forcing_dir = "", is_netcdf_forcing = True, simulation_time = None,
+                 id_pattern = ""):
+        self.forcing_source    = forcing_source
+        self.forcing_dir       = forcing_dir or ""
+        self.is_netcdf_forcing = is_netcdf_forcing
+        self.simulation_time   = simulation_time
+        self.id_pattern        = id_pattern or ""
+
+        # forcing files (.nc) of all basins stored in one directory, indexed once
+        self.index = None
+        if (is_netcdf_forcing and "{*}" not in self.forcing_dir and os.path.isdir(self.forcing_dir)):
+            index = ForcingIndex.from_dir(self.forcing_dir, self.id_pattern)
+            self.index = index if len(index) > 0 else None
+
+    # settings the forcing files depend on (stored in the job manifest)
+    def get_settings(self):
+        settings = {"forcing_source"    : self.forcing_source,
+                    "forcing_dir"       : self.forcing_dir,
+                    "is_netcdf_forcing" : self.is_netcdf_forcing,
+                    "id_pattern"        : self.id_pattern,
+                    "simulation_time"   : self.simulation_time}
+        return json.loads(json.dumps(settings, default=str))
+
+    # forcing directory of forcing_prep outputs, e.g. data/forcing/2010_to_2012
+    def get_years_dir(self):
+        sim_time = self.simulation_time
+        if (isinstance(sim_time, str)):
+            sim_time = json.loads(sim_time)
+        start_yr = pd.Timestamp(sim_time['start_time']).year
+        end_yr   = pd.Timestamp(sim_time['end_time']).year
+
+        if (start_yr <= end_yr):
+            end_yr = end_yr + 1
+
+        return start_yr, end_yr
+
+    #############################################################################
+    # sets basin["forcing_file"] of all basins (None if the forcing does not exist)
+    #############################################################################
+    def resolve(self, basins):
+
+        if (self.index is not None):
+            for basin in basins:
+                basin["forcing_file"] = self.index.lookup(basin["basin_id"])
+
+        elif (self.forcing_source == "Nels_forcing_prep"):
+            start_yr, end_yr = self.get_years_dir()
+            paths = {}
+            for basin in basins:
+                path = os.path.join(basin["dir"], f"data/forcing/{start_yr}_to_{end_yr}")
+                if (self.is_netcdf_forcing):
+                    name_without_ext = os.path.basename(basin["gpkg_file"]).split(".")[0]
+                    path = os.path.join(path, f"{name_without_ext}_{start_yr}_to_{end_yr}.nc")
+                paths[basin["basin_id"]] = path
+
+            exist = batch_exists(list(paths.values()))
+            for basin in basins:
+                path = paths[basin["basin_id"]]
+                basin["forcing_file"] = path if path in exist else None
+
+        elif (self.forcing_source == "local"):
+            dirs = {basin["basin_id"] : self.forcing_dir.replace("{*}", Path(basin["dir"]).name) for basin in basins}
+
+            if (self.is_netcdf_forcing):
+                # first .nc file of the basin's forcing directory
+                listings = list_dirs(dirs.values())
+                for basin in basins:
+                    dir = dirs[basin["basin_id"]]
+                    nc_files = [n for n in (listings[dir] or []) if n.endswith(".nc")]
+                    basin["forcing_file"] = os.path.join(dir, nc_files[0]) if len(nc_files) > 0 else None
+            else:
+                exist = batch_exists(list(dirs.values()))
+                for basin in basins:
+                    dir = dirs[basin["basin_id"]]
+                    basin["forcing_file"] = dir if dir in exist else None
+
+        else:
+            for basin in basins:
+                basin["forcing_file"] = None
+
+        return basins
+
+#############################################################################
+# builds the job manifest of output_dir and writes it to output_dir/basins_manifest.json
+# @param output_dir       : basins directory
+# @param forcing_resolver : ForcingResolver (optional), adds the forcing file of each basin (None if not found)
+# - returns               : list of basins (dict: basin_id, dir, gpkg_file[, forcing_file])
+#############################################################################
+def build_manifest(output_dir, forcing_resolver = None):
+
+    basins = list(scan_basins(output_dir))
+    if (forcing_resolver is not None):
+        forcing_resolver.resolve(basins)
+
+    manifest = {"output_dir" : os.path.abspath(output_dir),
+                "created"    : pd.Timestamp.now().isoformat(timespec="seconds"),
+                "forcing"    : forcing_resolver.get_settings() if forcing_resolver is not None else None,
+                "basins"     : basins}
+
+    manifest_file = os.path.join(output_dir, manifest_name)
+    tmp_file = f"{manifest_file}.{platform.node()}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as outfile:
+        json.dump(manifest, outfile, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+    return basins
+
+# reads the job manifest (dict: output_dir, created, forcing, basins), None if it does not exist
+def read_manifest(output_dir):
+    manifest_file = os.path.join(output_dir, manifest_name)
+    if (not os.path.exists(manifest_file)):
+        return None
+    with open(manifest_file, 'r') as infile:
+        return json.load(infile)
+
+#############################################################################
+# returns the shard (index, count) from "i/N" (e.g. "3/16"); the BASIN_WORKFLOW_SHARD environment variable
+# overrides the value given (set per task in array jobs); (0, 1) if none is given
+#############################################################################
+def get_shard(shard = ""):
+    shard = os.environ.get(shard_env, shard or "")
+    if (shard == ""):
+        return 0, 1
+
+    try:
+        index, count = [int(s) for s in str(shard).split("/")]
+        assert (0 <= index < count)
+    except (ValueError, AssertionError):
+        sys.exit(f"Invalid shard {shard}, expected i/N with 0 <= i < N")
+
+    return index, count
+
+def in_shard(basin_id, shard_index, shard_count):
+    return zlib.crc32(str(basin_id).encode()) % shard_count == shard_index
+
+def get_status_file(output_dir, shard_index, shard_count):
+    return os.path.join(output_dir, jobs_dir_name, f"shard_{shard_index}_of_{shard_count}.csv")
+
+#############################################################################
+# reads the results of the status files of all shards of a run split in shard_count shards: DataFrame
+# (basin_id, n_cats, status), the latest result of each basin is kept
+#############################################################################
+def read_status(output_dir, shard_count = 1, status_files = None):
+
+    if (status_files is None):
+        status_files = [get_status_file(output_dir, i, shard_count) for i in range(shard_count)]
+
+    dfs = [pd.read_csv(f, dtype=str) for f in status_files if os.path.exists(f)]
+    dfs = [df for df in dfs if len(df) > 0]
+    if (len(dfs) == 0):
+        return pd.DataFrame(columns=status_columns)
+
+    df = pd.concat(dfs).dropna(subset=['basin_id'])
+    return df.drop_duplicates(subset='basin_id', keep='last')
+
+#############################################################################
+# rewrites output_dir/basins_passed.csv (basin_id, n_cats) from the status files of all shards (atomic
+# replace, the last shard to finish writes the complete list)
+# - returns : number of basins passed
+#############################################################################
+def write_basins_passed(output_dir, shard_count = 1):
+
+    df = read_status(output_dir, shard_count)
+    df = df[df['status'] == "passed"]
+
+    basins_passed = os.path.join(output_dir, "basins_passed.csv")
+    tmp_file = f"{basins_passed}.{platform.node()}.{os.getpid()}.tmp"
+    df[['basin_id', 'n_cats']].to_csv(tmp_file, index=False)
+    os.replace(tmp_file, basins_passed)
+
+    return len(df)
+
+#############################################################################
+# status file of a shard, results are appended (and flushed) as basins complete
+# @param output_dir  : basins directory
+# @param shard_index : shard index
+# @param shard_count : number of shards
+# @param resume      : True keeps the results of the previous run of the shard
+#############################################################################
+class ShardStatus:
+
+    def __init__(self, output_dir, shard_index = 0, shard_count = 1, resume = False):
+        self.status_file = get_status_file(output_dir, shard_index, shard_count)
+        os.makedirs(os.path.dirname(self.status_file), exist_ok=True)
+
+        self.passed = set()
+        if (resume and os.path.exists(self.status_file)):
+            df = read_status(output_dir, status_files = [self.status_file])
+            self.passed = set(df.loc[df['status'] == "passed", 'basin_id'])
+
+        is_new = not (resume and os.path.exists(self.status_file))
+        self.file = open(self.status_file, 'w' if is_new else 'a', newline='')
+        self.writer = csv.writer(self.file)
+        if (is_new):
+            self.writer.writerow(status_columns)
+            self.file.flush()
+
+    def add(self, basin_id, n_cats, passed = True):
+        self.writer.writerow([basin_id, n_cats, "passed" if passed else "failed"])
+        self.file.flush()
+        if (passed):
+            self.passed.add(basin_id)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#############################################################################
+# returns the basins (job manifest entries) to process in this shard
+# @param output_dir       : basins directory
+# @param forcing_resolver : ForcingResolver (optional)
+# @param rescan           : False reuses the existing job manifest (no scan of the basin directories)
+# @param shard_index      : shard index
+# @param shard_count      : number of shards
+#############################################################################
+def get_jobs(output_dir, forcing_resolver = None, rescan = True, shard_index = 0, shard_count = 1):
+
+    manifest = None if rescan else read_manifest(output_dir)
+    basins = build_manifest(output_dir, forcing_resolver) if manifest is None else manifest["basins"]
+
+    jobs = [b for b in basins if in_shard(b["basin_id"], shard_index, shard_count)]
+
+    # forcing files of a reused manifest: all resolved again if the forcing settings changed (or the manifest was
+    # written without forcing), otherwise the forcing files that no longer exist (or were not found) are
+    if (forcing_resolver is not None and manifest is not None):
+        if (manifest.get("forcing") != forcing_resolver.get_settings()):
+            forcing_resolver.resolve(jobs)
+        else:
+            exist = batch_exists([job["forcing_file"] for job in jobs if job.get("forcing_file")])
+            forcing_resolver.resolve([job for job in jobs if job.get("forcing_file") not in exist])
+
+    return jobs
+
+
+if __name__ == "__main__":
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-o",     dest="output_dir",  type=str, required=True,  help="basins directory")
+        parser.add_argument("-f",     dest="forcing_dir", type=str, required=False, default="",
+                            help="directory of the basins' NetCDF forcing files")
+        parser.add_argument("-p",     dest="id_pattern",  type=str, required=False, default="",
+                            help="basin id pattern of the forcing file names, e.g. 'forcing_(?P<id>[0-9]+)'")
+        parser.add_argument("-n",     dest="num_shards",  type=int, required=False, default=1,
+                            help="number of shards")
+        parser.add_argument("-merge", dest="merge",       action='store_true',
+                            help="rebuild basins_passed.csv from the status files of the N shards")
+    except:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    if (args.merge):
+        print (f"Basins passed: {write_basins_passed(args.output_dir, args.num_shards)}")
+        sys.exit(0)
+
+    forcing_resolver = ForcingResolver(forcing_dir = args.forcing_dir, id_pattern = args.id_pattern) \
+                       if args.forcing_dir else None
+    basins = build_manifest(args.output_dir, forcing_resolver)
+    print (f"Basins: {len(basins)}, manifest: {os.path.join(args.output_dir, manifest_name)}")
+    if (forcing_resolver is not None):
+        print (f"  without forcing file: {sum(b['forcing_file'] is None for b in basins)}")
+
+    for i in range(args.num_shards):
+        nbasins = sum(in_shard(b["basin_id"], i, args.num_shards) for b in basins)
+        print (f"  shard {i}/{args.num_shards}: {nbasins} basins")
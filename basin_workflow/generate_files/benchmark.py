@@ -0,0 +1,379 @@
+"""
+Benchmark of the config files generation on synthetic hydrofabric geopackages (no CAMELS data needed)
+ - synthetic geopackages with `divides`, `model-attributes` and `flowpath-attributes` layers (noaa-owp
+   schema) are generated once per size under work_dir/gpkg and reused
+ - each size runs in a fresh process (peak RSS of a size is not inflated by the previous sizes); steps
+   timed: read_gpkg_file, write_*_input_files, write_realization_file and write_troute_input_files
+ - runs standalone without -ngen: the NOM soil parameter table is replaced by a stub table (same format, placeholder
+   values) and write_realization_file, which needs the model libraries of an ngen build, is skipped
+ - reported per step: wall time, files written, files/sec, peak RSS [MB] and its increase during the step
+ - results are appended (JSON lines) to the results file together with the version (git describe), each
+   step is compared with the latest result of a different version, slowdowns above the tolerance are flagged
+ - usage:
+   python benchmark.py -o work_dir [-ngen ngen_dir] [-n 10 1000 10000 100000] [-r results.jsonl] [-tol 0.2]
+"""
+
+import os, sys
+import shutil
+import json
+import time
+import platform
+import argparse
+import subprocess
+import concurrent.futures
+import multiprocessing
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+try:
+    from generate_files import configuration, realization, tracing
+except:
+    import configuration, realization, tracing
+
+default_sizes = [10, 1000, 10000, 100000]
+
+min_wall_sec = 0.05 # shorter steps are not compared (timer noise)
+
+simulation_time = {"start_time" : "2010-10-01 00:00:00", "end_time" : "2011-10-01 00:00:00"}
+
+#############################################################################
+# writes a synthetic hydrofabric geopackage (noaa-owp schema), divides are square cells on a grid
+# @param gpkg_file : output geopackage
+# @param ndivides  : number of divides
+# @param seed      : random seed of the attributes
+#############################################################################
+def write_synthetic_gpkg(gpkg_file, ndivides, seed = 0):
+
+    rng = np.random.default_rng(seed)
+    ids = np.arange(1, ndivides + 1)
+
+    # 3 km x 3 km cells in EPSG:5070 (CONUS Albers)
+    side = int(np.ceil(np.sqrt(ndivides)))
+    x = 1500000.0 + (ids - 1) % side * 3000.0
+    y = 2000000.0 + (ids - 1) // side * 3000.0
+    geometry = shapely.box(x, y, x + 3000.0, y + 3000.0)
+
+    divide_ids = np.char.add("cat-", ids.astype(str))
+    toids      = np.char.add("nex-", (ids + 1).astype(str))
+
+    gdf_div = gpd.GeoDataFrame({'divide_id' : divide_ids,
+                                'toid'      : toids,
+                                'areasqkm'  : 9.0,
+                                'tot_drainage_areasqkm' : np.arange(ndivides, 0, -1) * 9.0},
+                               geometry=geometry, crs="EPSG:5070")
+
+    # distributions (json), a handful of shapes shared by the divides
+    giuh  = [json.dumps([{'v' : 0.1 * k, 'frequency' : f} for k, f in enumerate(rng.dirichlet(np.ones(5)))])
+             for _ in range(16)]
+    twi   = [json.dumps([{'v' : v, 'frequency' : f} for v, f in zip([3., 5., 7., 9.], rng.dirichlet(np.ones(4)))])
+             for _ in range(16)]
+    width = [json.dumps([{'v' : v, 'frequency' : f} for v, f in zip([100., 200., 300., 400.], rng.dirichlet(np.ones(4)))])
+             for _ in range(16)]
+
+    df_attr = pd.DataFrame({'divide_id' : divide_ids,
+                            'mode.bexp_soil_layers_stag=1'   : rng.uniform(2., 10., ndivides),
+                            'mode.dksat_soil_layers_stag=1'  : rng.uniform(1e-6, 1e-5, ndivides),
+                            'mode.psisat_soil_layers_stag=1' : rng.uniform(0.1, 0.5, ndivides),
+                            'mean.smcmax_soil_layers_stag=1' : rng.uniform(0.3, 0.5, ndivides),
+                            'mean.smcwlt_soil_layers_stag=1' : rng.uniform(0.02, 0.1, ndivides),
+                            'mode.ISLTYP'    : rng.integers(1, 13, ndivides),
+                            'mode.IVGTYP'    : rng.integers(1, 20, ndivides),
+                            'mean.refkdt'    : rng.uniform(1., 5., ndivides),
+                            'mean.Coeff'     : rng.uniform(0.001, 0.01, ndivides),
+                            'mean.Zmax'      : rng.uniform(10., 250., ndivides),
+                            'mode.Expon'     : 6.0,
+                            'mean.slope'     : rng.uniform(0., 1., ndivides),
+                            'mean.elevation' : rng.uniform(1., 2000., ndivides),
+                            'giuh'           : np.take(giuh, rng.integers(0, 16, ndivides)),
+                            'twi'            : np.take(twi, rng.integers(0, 16, ndivides)),
+                            'width_dist'     : np.take(width, rng.integers(0, 16, ndivides)),
+                            'N_nash'         : 2,
+                            'K_nash'         : rng.uniform(0.1, 0.9, ndivides)})
+
+    df_fp = pd.DataFrame({'id'        : np.char.add("wb-", ids.astype(str)),
+                          'toid'      : toids,
+                          'length_m'  : rng.uniform(500., 5000., ndivides),
+                          'n'         : 0.06,
+                          'nCC'       : 0.12,
+                          'So'        : rng.uniform(0.001, 0.05, ndivides),
+                          'BtmWdth'   : 3.0,
+                          'rl_NHDWaterbodyComID' : None,
+                          'rl_gages'  : np.where(ids == ndivides, "01234567", None),
+                          'TopWdth'   : 5.0,
+                          'TopWdthCC' : 10.0,
+                          'MusK'      : 3600.0,
+                          'MusX'      : 0.2,
+                          'ChSlp'     : 0.5,
+                          'alt'       : rng.uniform(1., 2000., ndivides)})
+
+    os.makedirs(os.path.dirname(os.path.abspath(gpkg_file)), exist_ok=True)
+    tmp_file = f"{gpkg_file}.{os.getpid()}.tmp.gpkg"
+    gdf_div.to_file(tmp_file, layer='divides', driver='GPKG')
+    gpd.GeoDataFrame(df_attr).to_file(tmp_file, layer='model-attributes', driver='GPKG')
+    gpd.GeoDataFrame(df_fp).to_file(tmp_file, layer='flowpath-attributes', driver='GPKG')
+    os.replace(tmp_file, gpkg_file)
+
+def get_synthetic_gpkg(work_dir, ndivides):
+    gpkg_file = os.path.join(work_dir, "gpkg", f"synthetic_{ndivides}.gpkg")
+    if (not os.path.exists(gpkg_file)):
+        write_synthetic_gpkg(gpkg_file, ndivides)
+    return gpkg_file
+
+#############################################################################
+# writes a stub NOM soil parameter table (SOILPARM.TBL format, 19 STAS soil classes, placeholder values), used
+# when no ngen directory is given; only the timing of the writers is of interest
+#############################################################################
+def write_stub_soil_table(soil_file):
+    lines = ["Soil Parameters", "STAS",
+             "19,1   'BB      DRYSMC      F11     MAXSMC   REFSMC   SATPSI  SATDK       SATDW     WLTSMC  QTZ    "
+             "BVIC  AXAJ   BXAJ  XXAJ  BDVIC  BBVIC  GDVIC ISLTYP'"]
+    for i in range(1, 20):
+        lines.append(f"{i}, 5.0, 0.05, 0.0, 0.45, 0.3, 0.3, 5.0E-06, 1.0E-05, 0.05, 0.4, 0.1, 0.01, 0.5, "
+                     f"0.2, 0.1, 0.1, 0.5, 'STUB'")
+    os.makedirs(os.path.dirname(os.path.abspath(soil_file)), exist_ok=True)
+    with open(soil_file, 'w') as outfile:
+        outfile.write("\n".join(lines) + "\n")
+
+# version of the code benchmarked (git describe), "unknown" outside a git checkout
+def get_version():
+    try:
+        out = subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() if out.returncode == 0 else "unknown"
+    except OSError:
+        return "unknown"
+
+#############################################################################
+# runs a step and returns its measurements, None if the step failed
+# @param step    : step name
+# @param func    : function called without arguments
+# @param out_dir : directory the step writes its files to (counted after the step)
+#############################################################################
+def run_step(step, func, out_dir = None):
+
+    rss_start = tracing.get_max_rss()
+    start = time.perf_counter()
+    try:
+        func()
+    except (Exception, SystemExit) as e:
+        print (f"  {step} failed: {e!r}")
+        return None
+    wall = time.perf_counter() - start
+    rss = tracing.get_max_rss()
+
+    nfiles = tracing.count_files(out_dir) if (out_dir is not None and os.path.isdir(out_dir)) else 0
+
+    return {"step"          : step,
+            "wall_sec"      : round(wall, 4),
+            "nfiles"        : nfiles,
+            "files_per_sec" : round(nfiles / wall, 1) if wall > 0 else 0.0,
+            "max_rss_mb"    : round(rss, 1),
+            "rss_increase_mb" : round(rss - rss_start, 1)}
+
+#############################################################################
+# times the config/realization files generation of a synthetic basin (runs in its own process)
+# @param gpkg_file : synthetic geopackage
+# @param ngen_dir  : ngen directory (NOM/LASAM parameter files, model libraries for the realization file),
+#                    "" runs with a stub soil parameter table and skips the realization file
+# @param run_dir   : output directory, emptied before the run
+# - returns        : list of step measurements
+#############################################################################
+def benchmark_basin(gpkg_file, ngen_dir, run_dir):
+
+    if (os.path.exists(run_dir)):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+
+    if (ngen_dir == ""):
+        nom_soil_file = os.path.join(run_dir, "stub", "SOILPARM.TBL")
+        write_stub_soil_table(nom_soil_file)
+        lasam_params  = os.path.join(run_dir, "stub", "vG_default_params.dat") # referenced only, not read
+    else:
+        nom_soil_file = os.path.join(ngen_dir, "extern/noah-owp-modular/noah-owp-modular/parameters/SOILPARM.TBL")
+        lasam_params  = os.path.join(ngen_dir, "extern/LGAR-C/data/vG_default_params.dat")
+        if (not os.path.isfile(lasam_params)):
+            lasam_params = os.path.join(ngen_dir, "extern/LASAM/data/vG_default_params.dat")
+    routing_file  = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                 "configs/samples/config_troute.yaml")
+    forcing_file  = os.path.join(run_dir, "forcing.nc") # referenced only, not read
+
+    # all models of the options benchmarked below (topmodel reads twi/width_dist, cfe/lasam read giuh)
+    coupled_models = "nom_topmodel_cfe_lasam_smp_sft_pet"
+
+    results = []
+    def step(name, func, out_dir = None):
+        if (out_dir is not None):
+            os.makedirs(out_dir, exist_ok=True)
+        res = run_step(name, func, out_dir)
+        if (res is not None):
+            results.append(res)
+        return res
+
+    basin = configuration.BasinGeopackage(gpkg_file)
+    data = {}
+    def read():
+        data['gdf_soil'], data['catids'] = configuration.read_gpkg_file(basin, coupled_models, "GIUH", 0)
+
+    if (step("read_gpkg_file", read) is None):
+        return results
+
+    gdf_soil, catids = data['gdf_soil'], data['catids']
+    soil_class_NWM = configuration.get_soil_class_NWM(nom_soil_file)
+    maat = pd.Series(285.0, index=configuration.get_cat_names(catids))
+
+    d = lambda m : os.path.join(run_dir, m)
+
+    step("write_nom_input_files",
+         lambda : configuration.write_nom_input_files(catids, d("nom"), os.path.dirname(forcing_file), gdf_soil,
+                                                      simulation_time, 0), d("nom"))
+    step("write_cfe_input_files",
+         lambda : configuration.write_cfe_input_files(catids, "Schaake", "GIUH", soil_class_NWM, gdf_soil,
+                                                      d("cfe"), "nom_cfe_smp_sft"), d("cfe"))
+    step("write_topmodel_input_files",
+         lambda : configuration.write_topmodel_input_files(catids, gdf_soil, d("topmodel"), "nom_topmodel"),
+         d("topmodel"))
+    step("write_pet_input_files",
+         lambda : configuration.write_pet_input_files(catids, gdf_soil, basin, d("pet")), d("pet"))
+    step("write_sft_input_files",
+         lambda : configuration.write_sft_input_files(catids, "Schaake", "GIUH", maat, gdf_soil, soil_class_NWM,
+                                                      d("sft")), d("sft"))
+    step("write_smp_input_files",
+         lambda : configuration.write_smp_input_files(catids, gdf_soil, d("smp"), "nom_cfe_smp_sft"), d("smp"))
+    step("write_lasam_input_files",
+         lambda : configuration.write_lasam_input_files(catids, lasam_params, gdf_soil, d("lasam"),
+                                                        "nom_lasam_smp_sft"), d("lasam"))
+    # the realization file needs the model libraries of an ngen build
+    if (ngen_dir != ""):
+        step("write_realization_file",
+             lambda : realization.write_realization_file(ngen_dir = ngen_dir,
+                                                         forcing_dir = forcing_file,
+                                                         config_dir = run_dir,
+                                                         realization_file = os.path.join(d("json"), "realization.json"),
+                                                         coupled_models = "nom_cfe_smp_sft",
+                                                         runoff_scheme = "GIUH",
+                                                         precip_partitioning_scheme = "Schaake",
+                                                         simulation_time = simulation_time,
+                                                         baseline_case = False,
+                                                         is_netcdf_forcing = "True",
+                                                         is_troute = "True",
+                                                         verbosity = 0,
+                                                         sim_output_dir = d("outputs"),
+                                                         is_calib = "False"), d("json"))
+    step("write_troute_input_files",
+         lambda : configuration.write_troute_input_files(basin, routing_file, d("troute"), simulation_time,
+                                                         d("outputs"), "False"), d("troute"))
+
+    return results
+
+#############################################################################
+# reads the results file, returns the latest result of each (ndivides, step) of versions other than version
+#############################################################################
+def get_previous_results(results_file, version):
+    previous = {}
+    if (not os.path.exists(results_file)):
+        return previous
+
+    with open(results_file, 'r') as infile:
+        for line in infile:
+            try:
+                res = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if (res.get("version") != version):
+                previous[(res["ndivides"], res["step"])] = res
+
+    return previous
+
+#############################################################################
+# runs the benchmark for all sizes, appends the results to results_file and prints the comparison with
+# the previous version
+# @param ngen_dir     : ngen directory
+# @param work_dir     : work directory (synthetic geopackages and generated files)
+# @param sizes        : list of numbers of divides
+# @param results_file : results file (JSON lines)
+# @param tolerance    : relative slowdown flagged as a regression (0.2 = 20% slower)
+# @param keep         : keep the generated files of each size
+# - returns           : number of regressions
+#############################################################################
+def run_benchmark(ngen_dir, work_dir, sizes = default_sizes, results_file = "", tolerance = 0.2, keep = False):
+
+    if (results_file == ""):
+        results_file = os.path.join(work_dir, "benchmark_results.jsonl")
+
+    version  = get_version()
+    previous = get_previous_results(results_file, version)
+    info = {"version" : version,
+            "date"    : pd.Timestamp.now().isoformat(timespec="seconds"),
+            "host"    : platform.node(),
+            "python"  : platform.python_version()}
+
+    print (f"Benchmark version {version}, results: {results_file}")
+    print (f"{'divides':>8} {'step':<28} {'wall [s]':>9} {'files':>7} {'files/s':>9} {'rss [MB]':>9} "
+           f"{'+rss [MB]':>9} {'prev [s]':>9} {'ratio':>6}")
+
+    nregressions = 0
+    for ndivides in sizes:
+        run_dir = os.path.join(work_dir, f"run_{ndivides}")
+
+        # fresh processes per size, peak RSS is the one of this size (ru_maxrss is inherited through fork/exec,
+        # so the geopackage is not generated by this process either)
+        ctx = multiprocessing.get_context("spawn")
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            gpkg_file = executor.submit(get_synthetic_gpkg, work_dir, ndivides).result()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=ctx) as executor:
+            results = executor.submit(benchmark_basin, gpkg_file, ngen_dir, run_dir).result()
+
+        with open(results_file, 'a') as outfile:
+            for res in results:
+                res = dict(info, ndivides = ndivides, **res)
+                outfile.write(json.dumps(res) + "\n")
+
+                prev = previous.get((ndivides, res["step"]))
+                ratio, flag = "", ""
+                if (prev is not None and prev["wall_sec"] > 0):
+                    ratio = res["wall_sec"] / prev["wall_sec"]
+                    if (ratio > 1 + tolerance and res["wall_sec"] >= min_wall_sec):
+                        flag = f"  <-- slower than {prev['version']}"
+                        nregressions += 1
+                    ratio = f"{ratio:.2f}"
+
+                print (f"{ndivides:>8} {res['step']:<28} {res['wall_sec']:>9.3f} {res['nfiles']:>7} "
+                       f"{res['files_per_sec']:>9.1f} {res['max_rss_mb']:>9.1f} {res['rss_increase_mb']:>9.1f} "
+                       f"{(prev['wall_sec'] if prev else ''):>9} {ratio:>6}{flag}")
+
+        if (not keep):
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    if (nregressions > 0):
+        print (f"{nregressions} step(s) more than {tolerance:.0%} slower than the previous version")
+
+    return nregressions
+
+if __name__ == "__main__":
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-ngen", dest="ngen_dir",     type=str, required=False, default="",
+                            help="ngen base directory (default: stub parameter tables, no realization file)")
+        parser.add_argument("-o",    dest="work_dir",     type=str, required=True,  help="benchmark work directory")
+        parser.add_argument("-n",    dest="sizes",        type=int, required=False, nargs='+', default=default_sizes,
+                            help="numbers of divides of the synthetic geopackages")
+        parser.add_argument("-r",    dest="results_file", type=str, required=False, default="",
+                            help="results file (default: work_dir/benchmark_results.jsonl)")
+        parser.add_argument("-tol",  dest="tolerance",    type=float, required=False, default=0.2,
+                            help="relative slowdown reported as a regression")
+        parser.add_argument("-keep", dest="keep",         action='store_true', help="keep the generated files")
+    except:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    if (args.ngen_dir != "" and not os.path.exists(args.ngen_dir)):
+        sys.exit(f"The ngen directory does not exist! {args.ngen_dir}")
+
+    nregressions = run_benchmark(args.ngen_dir, os.path.abspath(args.work_dir), args.sizes,
+                                 args.results_file, args.tolerance, args.keep)
+
+    sys.exit(1 if nregressions > 0 else 0)
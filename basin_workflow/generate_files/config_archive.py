@@ -0,0 +1,144 @@
+"""
+Bulk output mode for per-catchment config files
+ - config files of all models (cfe, sft, smp, nom, topmodel, pet, lasam) of a basin, and the NOM/LASAM
+   parameter files they reference, are written into one uncompressed tar archive (configs/configs.tar) instead of one small file per catchment per model
+ - an offset index (configs/configs.tar.index.json) maps each member to its data offset/size, which is
+   used to extract the configs (e.g. to node-local scratch) without parsing the tar headers
+ - ngen cannot read the archive directly, the realization file init_config points to the directory
+   the archive is extracted to (see realization.py -initdir and runner.py)
+"""
+
+import os, sys
+import io
+import json
+import tarfile
+import argparse
+
+archive_name = "configs.tar"
+
+#############################################################################
+# returns the index file of the given archive file
+#############################################################################
+def get_index_file(archive_file):
+    return archive_file + ".index.json"
+
+#############################################################################
+# class writes config files into one tar archive and keeps the offset index of the members
+# @param archive_file : output archive file (.tar)
+# @param root_dir     : config files directory, member names are paths relative to this directory
+#############################################################################
+class ConfigArchive:
+
+    def __init__(self, archive_file, root_dir):
+        self.archive_file = archive_file
+        self.root_dir     = root_dir
+        self.index        = {}
+        self.tar = tarfile.open(archive_file, "w", format=tarfile.GNU_FORMAT)
+
+    # add a file, given its path (under root_dir) and text (or bytes)
+    def add(self, file_path, text):
+        name = os.path.relpath(file_path, self.root_dir)
+        data = text.encode() if isinstance(text, str) else text
+
+        tarinfo = tarfile.TarInfo(name=name)
+        tarinfo.size = len(data)
+        self.tar.addfile(tarinfo, io.BytesIO(data))
+
+        # data is padded to the tar block size, the current offset is the end of the padded data
+        blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+        if (remainder > 0):
+            blocks += 1
+        self.index[name] = [self.tar.offset - blocks * tarfile.BLOCKSIZE, tarinfo.size]
+
+    # add all files of a directory (e.g. model parameter tables), given the destination directory (under root_dir)
+    def add_dir(self, dir_path, src_dir):
+        for file_name in sorted(os.listdir(src_dir)):
+            src_file = os.path.join(src_dir, file_name)
+            if (os.path.isdir(src_file)):
+                self.add_dir(os.path.join(dir_path, file_name), src_file)
+            else:
+                with open(src_file, 'rb') as infile:
+                    self.add(os.path.join(dir_path, file_name), infile.read())
+
+    def close(self):
+        self.tar.close()
+        with open(get_index_file(self.archive_file), 'w') as outfile:
+            json.dump(self.index, outfile)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+#############################################################################
+# extracts all config files of the archive to a directory (e.g. node-local scratch) using the offset index
+#  - members are read one at a time in archive order (seek to the member offset), the archive is not loaded in memory
+# @param archive_file : archive file (.tar) written by ConfigArchive
+# @param output_dir   : directory the config files are extracted to (same layout as the config files directory)
+# - returns           : number of files extracted
+#############################################################################
+def extract_config_archive(archive_file, output_dir):
+
+    index_file = get_index_file(archive_file)
+
+    # fall back to the tar headers if the index does not exist
+    if (not os.path.exists(index_file)):
+        with tarfile.open(archive_file, "r") as tar:
+            members = tar.getmembers()
+            tar.extractall(output_dir, members=members, filter="data")
+        return len(members)
+
+    with open(index_file, 'r') as infile:
+        index = json.load(infile)
+
+    # member names must stay under output_dir
+    for name in index:
+        if (os.path.isabs(name) or os.path.normpath(name).split(os.sep)[0] == ".."):
+            sys.exit("Invalid member in the config archive index: " + name)
+
+    dirs = set()
+    with open(archive_file, 'rb') as infile:
+        for name, (offset, size) in sorted(index.items(), key = lambda item: item[1][0]):
+            dir_name = os.path.dirname(os.path.join(output_dir, name))
+            if (dir_name not in dirs):
+                os.makedirs(dir_name, exist_ok=True)
+                dirs.add(dir_name)
+
+            infile.seek(offset)
+            with open(os.path.join(output_dir, name), 'wb') as outfile:
+                outfile.write(infile.read(size))
+
+    return len(index)
+
+#############################################################################
+# reads one config file from the archive (e.g. for inspection) using the offset index
+#############################################################################
+def read_config_file(archive_file, name):
+
+    with open(get_index_file(archive_file), 'r') as infile:
+        offset, size = json.load(infile)[name]
+
+    with open(archive_file, 'rb') as infile:
+        infile.seek(offset)
+        text = infile.read(size).decode()
+
+    return text
+
+
+if __name__ == "__main__":
+
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-i", dest="archive_file", type=str, required=True,  help="config files archive (configs.tar)")
+        parser.add_argument("-o", dest="output_dir",   type=str, required=True,  help="directory the config files are extracted to")
+        args = parser.parse_args()
+    except:
+        parser.print_help()
+        sys.exit(1)
+
+    if (not os.path.exists(args.archive_file)):
+        sys.exit("Config archive does not exist, provided is " + args.archive_file)
+
+    nfiles = extract_config_archive(args.archive_file, args.output_dir)
+    print (f"Extracted {nfiles} config files to {args.output_dir}")
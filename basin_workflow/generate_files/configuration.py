@@ -19,15 +19,24 @@ import json
 import subprocess
 import pandas as pd
 import geopandas as gpd
+import shapely
 import numpy as np
 import fiona
 import yaml
 import platform
+import itertools
+from functools import cached_property
 
 try:
     from generate_files import schema
+    from generate_files import config_archive
+    from generate_files import tracing
+    from generate_files.manifest import file_stat, path_stat, file_hash
 except:
     import schema
+    import config_archive
+    import tracing
+    from manifest import file_stat, path_stat, file_hash
 os_name = platform.system()
 
 
@@ -47,36 +56,197 @@ def get_soil_class_NWM(infile):
 
 
 
+#############################################################################
+# class holding the hydrofabric geopackage of a basin; each layer is read once (only the columns needed)
+# and the EPSG:4326 geometries/centroids are computed once, the object is then shared by all writers
+# @param gpkg_file : input file pointing to hydrofabric basin geopkacge
+#############################################################################
+class BasinGeopackage:
+
+    divides_columns = ['divide_id', 'tot_drainage_areasqkm']
+
+    def __init__(self, gpkg_file):
+        self.gpkg_file = gpkg_file
+        self.layers = fiona.listlayers(gpkg_file)
+
+    def layer_fields(self, layer):
+        with fiona.open(self.gpkg_file, layer=layer) as src:
+            fields = list(src.schema['properties'].keys())
+        return fields
+
+    @cached_property
+    def model_attributes_layer(self):
+        for layer in ['model-attributes', 'model_attributes']:
+            if layer in self.layers:
+                return layer
+        raise ValueError("layer 'model-attributes or model_attributes does not exist!'")
+
+    @cached_property
+    def flowpath_attributes_layer(self):
+        return [layer for layer in self.layers if 'flowpath' in layer and not 'flowpaths' in layer][0]
+
+    # field names of the layers (no data is read)
+    @cached_property
+    def model_attributes_fields(self):
+        return self.layer_fields(self.model_attributes_layer)
+
+    @cached_property
+    def flowpath_attributes_fields(self):
+        return self.layer_fields(self.flowpath_attributes_layer)
+
+    @cached_property
+    def divides(self):
+        columns = [c for c in self.divides_columns if c in self.layer_fields('divides')]
+        gdf_div = gpd.read_file(self.gpkg_file, layer='divides', columns=columns)
+        return gdf_div
+
+    # divides geometry in EPSG:4326 indexed by divide_id
+    @cached_property
+    def divides_4326(self):
+        gdf_div = self.divides[['divide_id', 'geometry']].to_crs("EPSG:4326") # change CRS to 4326
+        gdf_div.set_index("divide_id", inplace=True)
+        return gdf_div
+
+    # divides centroids (x = longitude, y = latitude) indexed by divide_id
+    @cached_property
+    def centroids(self):
+        centroids = shapely.centroid(self.divides_4326.geometry.values)
+        df = pd.DataFrame(data={'x': shapely.get_x(centroids), 'y': shapely.get_y(centroids)},
+                          index=self.divides_4326.index)
+        return df
+
+    @cached_property
+    def catids(self):
+        return [int(re.findall('[0-9]+',s)[0]) for s in self.divides['divide_id']]
+
+    @property
+    def n_cats(self):
+        return len(self.divides)
+
+    # reads model attributes, only the columns listed (plus divide_id)
+    def read_model_attributes(self, columns):
+        columns = ['divide_id'] + [c for c in dict.fromkeys(columns) if c != 'divide_id']
+        df = gpd.read_file(self.gpkg_file, layer=self.model_attributes_layer, columns=columns,
+                           ignore_geometry=True)
+        return df
+
+    # reads flowpath attributes, only the columns listed
+    def read_flowpath_attributes(self, columns):
+        df = gpd.read_file(self.gpkg_file, layer=self.flowpath_attributes_layer,
+                           columns=list(dict.fromkeys(columns)), ignore_geometry=True)
+        return df
+
+#############################################################################
+# returns BasinGeopackage for the given geopackage (file or already opened BasinGeopackage)
+#############################################################################
+def get_basin_geopackage(gpkg_file):
+    if (isinstance(gpkg_file, BasinGeopackage)):
+        return gpkg_file
+    return BasinGeopackage(gpkg_file)
+
+
+#############################################################################
+# helpers for the columnar rendering of the per-catchment config files; each parameter is formatted once
+# for all catchments (one array of lines per parameter), files are then written from the prebuilt rows
+#############################################################################
+def get_cat_names(catids):
+    return ['cat-'+str(catID) for catID in catids]
+
+#############################################################################
+# formats values of all catchments at once, same as str(value) per catchment
+# @param values : array/series of values (ordered as catchments)
+# @param prefix : string added before each value (e.g., 'soil_params.b=')
+# @param suffix : string added after each value (e.g., '[]')
+# - returns     : array of strings
+#############################################################################
+def format_column(values, prefix="", suffix=""):
+    values = np.asarray(values).astype(str).astype(object)
+    return prefix + values + suffix
+
+#############################################################################
+# parses json distributions of all catchments (e.g., giuh [{"v": .., "frequency": ..}, ...])
+# and returns the comma separated frequencies (ordinates) of each catchment
+#  - the distributions of all catchments are parsed as one json array; frequencies are formatted as numpy does
+#    per catchment (float repr, integer-only distributions keep the integer format)
+# @param values : array/series of json strings (ordered as catchments)
+# - returns     : array of strings
+#############################################################################
+def format_distribution_column(values):
+    distributions = json.loads("[" + ",".join(values) + "]")
+
+    ordinates = np.empty(len(distributions), dtype=object)
+    for i, dist in enumerate(distributions):
+        freqs = [d['frequency'] for d in dist]
+        if (all(type(f) is int for f in freqs)):
+            ordinates[i] = ",".join(map(str, freqs))
+        else:
+            ordinates[i] = ",".join([str(float(f)) for f in freqs])
+
+    return ordinates
+
+#############################################################################
+# writes one config file per catchment from the prebuilt lines
+# @param out_dir        : output directory
+# @param fname_template : file name template, e.g., 'cfe_config_{}.txt' ({} is replaced by the catchment name)
+# @param cat_names      : list of catchment names (cat-ID)
+# @param lines          : list of lines, each is either a string (same for all catchments) or an array
+#                         of strings (one per catchment)
+# @param archive        : ConfigArchive (optional), if provided files are added to the archive instead
+#############################################################################
+def write_catchment_files(out_dir, fname_template, cat_names, lines, archive=None):
+
+    columns = [itertools.repeat(line) if isinstance(line, str) else line for line in lines]
+
+    for cat_name, row in zip(cat_names, zip(*columns)):
+        file_path = os.path.join(out_dir, fname_template.format(cat_name))
+        if (archive is not None):
+            archive.add(file_path, '\n'.join(row))
+        else:
+            with open(file_path, "w") as f:
+                f.write('\n'.join(row))
+
+
 #############################################################################
 # module reads hydrofabric geopackage file and retuns a dict containing parameters needed for our models
 # this is intended to be modified if more models are added or more soil parameters need to be extracted
-# @param infile : input file pointing to hydrofabric basin geopkacge
+# @param infile : input file pointing to hydrofabric basin geopkacge (or BasinGeopackage)
 # - returns     : geodataframe 
 #############################################################################
 def read_gpkg_file(infile, coupled_models, surface_runoff_scheme, verbosity, schema_type='noaa-owp'):
-    
+
+    basin = get_basin_geopackage(infile)
+
     try:
-        gdf_soil = gpd.read_file(infile, layer='model-attributes')
+        fields = basin.model_attributes_fields
     except:
-        try:
-            gdf_soil = gpd.read_file(infile, layer='model_attributes')
-        except:
-            print("layer 'model-attributes or model_attributes does not exist!'")
-            sys.exit(1)
-    
-    gdf_soil.set_index("divide_id", inplace=True)
-    gdf_div = gpd.read_file(infile, layer='divides')
-    gdf_div = gdf_div.to_crs("EPSG:4326") # change CRS to 4326
-
-    #global layers, flowpath_layer   # global layers
-    layers = fiona.listlayers(infile)
+        print("layer 'model-attributes or model_attributes does not exist!'")
+        sys.exit(1)
 
-    flowpath_layer = [layer for layer in layers if 'flowpath' in layer][0]
-    
     if (verbosity >=3):
-        print ("Geopackage layers: ", layers)
+        print ("Geopackage layers: ", basin.layers)
         print ("\n")
 
+    # find the schema from the field names, and then read only the columns needed
+    params = schema.get_schema_model_attributes(pd.DataFrame(columns=fields))
+
+    columns = [params[key] for key in ['soil_b', 'soil_dksat', 'soil_psisat', 'soil_smcmax', 'soil_smcwlt',
+                                       'gw_Zmax', 'gw_Coeff', 'gw_Expon', 'soil_slope', 'ISLTYP', 'IVGTYP',
+                                       'elevation_mean']]
+    if ('refkdt' in fields):
+        columns += ['refkdt', params['soil_refkdt']]
+
+    if ("nom_topmodel" in coupled_models):
+        columns += [params['twi'], params['width_dist']]
+
+    if ("cfe" in coupled_models or "lasam" in coupled_models):
+        if (surface_runoff_scheme == "GIUH" or surface_runoff_scheme == 1):
+            columns += [params['giuh']]
+        elif (surface_runoff_scheme == "NASH_CASCADE" or surface_runoff_scheme == 2):
+            columns += [params['N_nash_surface'], params['K_nash_surface']]
+
+    gdf_soil = basin.read_model_attributes(columns)
+    gdf_soil.set_index("divide_id", inplace=True)
+
     params = schema.get_schema_model_attributes(gdf_soil)
 
     #read_gpkg_schema()
@@ -107,9 +277,11 @@ def read_gpkg_file(infile, coupled_models, surface_runoff_scheme, verbosity, sch
     # copy parameters needed
     #gdf = gpd.GeoDataFrame(pd.DataFrame(), geometry= gdf_div['geometry'], index=gdf_soil.index)
     
-    gdf = gpd.GeoDataFrame(data={'geometry': gdf_div['geometry'].values},
-                           index=gdf_soil.index
+    gdf = gpd.GeoDataFrame(data={'geometry': basin.divides_4326['geometry'].reindex(gdf_soil.index).values},
+                           index=gdf_soil.index, crs="EPSG:4326"
                            )
+    gdf['centroid_x'] = basin.centroids['x'].reindex(gdf_soil.index)
+    gdf['centroid_y'] = basin.centroids['y'].reindex(gdf_soil.index)
     
     gdf['soil_b']       = gdf_soil['soil_b'].copy()
     gdf['soil_satdk']   = gdf_soil['soil_dksat'].copy()
@@ -152,8 +324,7 @@ def read_gpkg_file(infile, coupled_models, surface_runoff_scheme, verbosity, sch
             gdf['K_nash_surface'] = gdf_soil[params['K_nash_surface']]
 
     # get catchment ids -- for Shengting
-    df_cats = gpd.read_file(infile, layer='divides')
-    catids = [int(re.findall('[0-9]+',s)[0]) for s in df_cats['divide_id']]
+    catids = basin.catids
     
     return gdf, catids
 
@@ -181,106 +352,114 @@ def write_forcing_files(catids, infile):
 # @param forcing_dir : forcing data directory containing data for each catchment
 # @param gpkg_file   : basin geopackage file
 # @param simulation_time : dictionary contain start/end time of the simulation
+# @param archive     : ConfigArchive (optional), config files are added to the archive instead
+# @param parameter_dir : NOM parameter tables directory referenced in the config files (default: nom_dir/parameters)
 
 #############################################################################
-def write_nom_input_files(catids, nom_dir, forcing_dir, gdf_soil, simulation_time, verbosity):
+def write_nom_input_files(catids, nom_dir, forcing_dir, gdf_soil, simulation_time, verbosity, archive=None,
+                          parameter_dir=None):
 
     if (verbosity >=3):
         print ("NOM simulation time: ", simulation_time)
     
     start_time = pd.Timestamp(simulation_time['start_time']).strftime("%Y%m%d%H%M")
     end_time   = pd.Timestamp(simulation_time['end_time']).strftime("%Y%m%d%H%M")
+
+    cat_names = get_cat_names(catids)
+    df = gdf_soil.reindex(cat_names)
+
+    # format all catchments at once
+    forcing_filename = format_column(cat_names, prefix="  forcing_filename   = \"%s"%(os.path.join(forcing_dir,"")),
+                                     suffix=".csv\"         ! file containing forcing data")
+    output_filename  = format_column(cat_names, prefix="  output_filename    = \"output-", suffix=".csv\"")
+    lat = format_column(df['centroid_y'], prefix="  lat              = ",
+                        suffix="                           ! latitude [degrees]  (-90 to 90)")
+    lon = format_column(df['centroid_x'], prefix="  lon              = ",
+                        suffix="                           ! longitude [degrees] (-180 to 180)")
+    soil_type = format_column(df['ISLTYP'], prefix="  isltyp           = ", suffix="               ! soil texture class")
+    veg_type  = format_column(df['IVGTYP'], prefix="  vegtyp           = ", suffix="               ! vegetation type")
+
+    timing = ["&timing                                   ! and input/output paths",
+              "  dt                 = 3600.0             ! timestep [seconds]",
+              "  startdate          = \"%s\"             ! UTC time start of simulation (YYYYMMDDhhmm)"%start_time,
+              "  enddate            = \"%s\"             ! UTC time end of simulation (YYYYMMDDhhmm)"%end_time,
+              forcing_filename,
+              output_filename,
+              "/\n"
+              ]
     
-    for catID in catids:
-        cat_name = 'cat-'+str(catID)
-        
-        centroid_x = str(gdf_soil['geometry'][cat_name].centroid.x)
-        centroid_y = str(gdf_soil['geometry'][cat_name].centroid.y)
-        
-        soil_type = str(gdf_soil.loc[cat_name]['ISLTYP'])
-        veg_type  = str(gdf_soil.loc[cat_name]['IVGTYP'])
-
-        timing = ["&timing                                   ! and input/output paths",
-                  "  dt                 = 3600.0             ! timestep [seconds]",
-                  "  startdate          = \"%s\"             ! UTC time start of simulation (YYYYMMDDhhmm)"%start_time,
-                  "  enddate            = \"%s\"             ! UTC time end of simulation (YYYYMMDDhhmm)"%end_time,
-                  "  forcing_filename   = \"%s.csv\"         ! file containing forcing data"%(os.path.join(forcing_dir,cat_name)),
-                  "  output_filename    = \"output-%s.csv\""%cat_name,
-                  "/\n"
-                  ]
-        
-        params = ["&parameters",
-                  "  parameter_dir      = \"%s\"  ! location of input parameter files"%(os.path.join(nom_dir,"parameters")),
-                  "  general_table      = \"GENPARM.TBL\"                ! general param tables and misc params",
-                  "  soil_table         = \"SOILPARM.TBL\"               ! soil param table",
-                  "  noahowp_table      = \"MPTABLE.TBL\"                ! model param tables (includes veg)",
-                  "  soil_class_name    = \"STAS\"                       ! soil class data source - STAS or STAS-RUC",
-                  "  veg_class_name     = \"MODIFIED_IGBP_MODIS_NOAH\"   ! vegetation class data source - MODIFIED_IGBP_MODIS_NOAH or USGS",
-                  "/\n"
-                  ]
-        
-        location = ["&location                                         ! for point runs",
-                    "  lat              = %s                           ! latitude [degrees]  (-90 to 90)"%centroid_y,
-                    "  lon              = %s                           ! longitude [degrees] (-180 to 180)"%centroid_x,
-                    "  terrain_slope    = 0.0                          ! terrain slope [degrees]",
-                    "  azimuth          = 0.0                          ! terrain azimuth or aspect [degrees clockwise from north]",
-                    "/ \n"
-                    ]
-        
-        forcing = ["&forcing",
-                   "  ZREF               = 10.0                        ! measurement height for wind speed (m)",
-                   "  rain_snow_thresh   = 1.0                         ! rain-snow temperature threshold (degrees Celcius)",
-                   "/ \n"
-                   ]
-
-        model_opt = ["&model_options                                   ! see OptionsType.f90 for details",
-                     "  precip_phase_option               = 1",
-                     "  snow_albedo_option                = 1",
-                     "  dynamic_veg_option                = 4",
-                     "  runoff_option                     = 3",
-                     "  drainage_option                   = 8",
-                     "  frozen_soil_option                = 1",
-                     "  dynamic_vic_option                = 1",
-                     "  radiative_transfer_option         = 3",
-                     "  sfc_drag_coeff_option             = 1",
-                     "  canopy_stom_resist_option         = 1",
-                     "  crop_model_option                 = 0",
-                     "  snowsoil_temp_time_option         = 3",
-                     "  soil_temp_boundary_option         = 2",
-                     "  supercooled_water_option          = 1",
-                     "  stomatal_resistance_option        = 1",
-                     "  evap_srfc_resistance_option       = 4",
-                     "  subsurface_option                 = 2",
-                     "/\n",
-                     ]
-
-        struct = ["&structure",
-                  "  isltyp           = %s               ! soil texture class"%soil_type,
-                  "  nsoil            = 4               ! number of soil levels",
-                  "  nsnow            = 3               ! number of snow levels",
-                  "  nveg             = 27              ! number of vegetation types",
-                  "  vegtyp           = %s               ! vegetation type"%veg_type,
-                  "  croptype         = 0               ! crop type (0 = no crops; this option is currently inactive)",
-                  "  sfctyp           = 1               ! land surface type, 1:soil, 2:lake",
-                  "  soilcolor       = 4               ! soil color code",
-                  "/\n"
-                  ]
-        
-        init_val = ["&initial_values",
-                    "  dzsnso    =  0.0,  0.0,  0.0,  0.1,  0.3,  0.6,  1.0     ! level thickness [m]",
-                    "  sice      =  0.0,  0.0,  0.0,  0.0                       ! initial soil ice profile [m3/m3]",
-                    "  sh2o      =  0.3,  0.3,  0.3,  0.3                       ! initial soil liquid profile [m3/m3]",
-                    "  zwt       =  -2.0                                        ! initial water table depth below surface [m]",
-                    "/\n",
-                    ]
-
-        # combine all sub-blocks
-        nom_params = timing + params + location + forcing + model_opt + struct + init_val
-
-        fname_nom = 'nom_config_'+cat_name+'.input'
-        nom_file = os.path.join(nom_dir, fname_nom)
-        with open(nom_file, "w") as f:
-            f.writelines('\n'.join(nom_params))
+    if (parameter_dir is None):
+        parameter_dir = os.path.join(nom_dir,"parameters")
+
+    params = ["&parameters",
+              "  parameter_dir      = \"%s\"  ! location of input parameter files"%parameter_dir,
+              "  general_table      = \"GENPARM.TBL\"                ! general param tables and misc params",
+              "  soil_table         = \"SOILPARM.TBL\"               ! soil param table",
+              "  noahowp_table      = \"MPTABLE.TBL\"                ! model param tables (includes veg)",
+              "  soil_class_name    = \"STAS\"                       ! soil class data source - STAS or STAS-RUC",
+              "  veg_class_name     = \"MODIFIED_IGBP_MODIS_NOAH\"   ! vegetation class data source - MODIFIED_IGBP_MODIS_NOAH or USGS",
+              "/\n"
+              ]
+    
+    location = ["&location                                         ! for point runs",
+                lat,
+                lon,
+                "  terrain_slope    = 0.0                          ! terrain slope [degrees]",
+                "  azimuth          = 0.0                          ! terrain azimuth or aspect [degrees clockwise from north]",
+                "/ \n"
+                ]
+    
+    forcing = ["&forcing",
+               "  ZREF               = 10.0                        ! measurement height for wind speed (m)",
+               "  rain_snow_thresh   = 1.0                         ! rain-snow temperature threshold (degrees Celcius)",
+               "/ \n"
+               ]
+
+    model_opt = ["&model_options                                   ! see OptionsType.f90 for details",
+                 "  precip_phase_option               = 1",
+                 "  snow_albedo_option                = 1",
+                 "  dynamic_veg_option                = 4",
+                 "  runoff_option                     = 3",
+                 "  drainage_option                   = 8",
+                 "  frozen_soil_option                = 1",
+                 "  dynamic_vic_option                = 1",
+                 "  radiative_transfer_option         = 3",
+                 "  sfc_drag_coeff_option             = 1",
+                 "  canopy_stom_resist_option         = 1",
+                 "  crop_model_option                 = 0",
+                 "  snowsoil_temp_time_option         = 3",
+                 "  soil_temp_boundary_option         = 2",
+                 "  supercooled_water_option          = 1",
+                 "  stomatal_resistance_option        = 1",
+                 "  evap_srfc_resistance_option       = 4",
+                 "  subsurface_option                 = 2",
+                 "/\n",
+                 ]
+
+    struct = ["&structure",
+              soil_type,
+              "  nsoil            = 4               ! number of soil levels",
+              "  nsnow            = 3               ! number of snow levels",
+              "  nveg             = 27              ! number of vegetation types",
+              veg_type,
+              "  croptype         = 0               ! crop type (0 = no crops; this option is currently inactive)",
+              "  sfctyp           = 1               ! land surface type, 1:soil, 2:lake",
+              "  soilcolor       = 4               ! soil color code",
+              "/\n"
+              ]
+    
+    init_val = ["&initial_values",
+                "  dzsnso    =  0.0,  0.0,  0.0,  0.1,  0.3,  0.6,  1.0     ! level thickness [m]",
+                "  sice      =  0.0,  0.0,  0.0,  0.0                       ! initial soil ice profile [m3/m3]",
+                "  sh2o      =  0.3,  0.3,  0.3,  0.3                       ! initial soil liquid profile [m3/m3]",
+                "  zwt       =  -2.0                                        ! initial water table depth below surface [m]",
+                "/\n",
+                ]
+
+    # combine all sub-blocks
+    nom_params = timing + params + location + forcing + model_opt + struct + init_val
+
+    write_catchment_files(nom_dir, 'nom_config_{}.input', cat_names, nom_params, archive)
 
 #############################################################################
 # The function generates configuration file for CFE
@@ -292,9 +471,10 @@ def write_nom_input_files(catids, nom_dir, forcing_dir, gdf_soil, simulation_tim
 # @param cfe_dir        : output directory (config files are written to this directory)
 # @param gpkg_file      : basin geopackage file
 # @param coupled_models : option needed to modify CFE config files based on the coupling type
+# @param archive        : ConfigArchive (optional), config files are added to the archive instead
 #############################################################################
 def write_cfe_input_files(catids, precip_partitioning_scheme, surface_runoff_scheme, soil_class_NWM, gdf_soil,
-                          cfe_dir, coupled_models):
+                          cfe_dir, coupled_models, archive=None):
 
     if (not precip_partitioning_scheme in ["Schaake", "Xinanjiang"]):
         sys.exit("Runoff scheme should be: Schaake or Xinanjiang")
@@ -304,76 +484,66 @@ def write_cfe_input_files(catids, precip_partitioning_scheme, surface_runoff_sch
     urban_decimal_fraction = 0.0 # used when runoff scheme is Xinanjiang
 
     delimiter = ","
-    
-    # loop over all catchments and write config files
-    for catID in catids:
-        cat_name = 'cat-'+str(catID) 
-        fname = cat_name+'*.txt'
-        
-        # cfe params set
-        cfe_params = ['forcing_file=BMI',
-                      'surface_water_partitioning_scheme=Schaake',
-                      'surface_runoff_scheme=GIUH',
-                      'soil_params.depth=2.0[m]',
-                      'soil_params.b='      + str(gdf_soil['soil_b'][cat_name])+'[]',
-                      'soil_params.satdk='  + str(gdf_soil['soil_satdk'][cat_name])+'[m s-1]', 
-                      'soil_params.satpsi=' + str(gdf_soil['soil_satpsi'][cat_name])+'[m]',
-                      'soil_params.slop='   + str(gdf_soil['soil_slop'][cat_name])+"[m/m]",
-                      'soil_params.smcmax=' + str(gdf_soil['soil_smcmax'][cat_name])+"[m/m]",
-                      'soil_params.wltsmc=' + str(gdf_soil['soil_wltsmc'][cat_name])+"[m/m]",
-                      'soil_params.expon=1.0[]',
-                      'soil_params.expon_secondary=1.0[]',
-                      'refkdt='         + str(gdf_soil['soil_refkdt'][cat_name]),
-                      'max_gw_storage=' + str(gdf_soil['max_gw_storage'][cat_name])+'[m]',
-                      'Cgw=' + str(gdf_soil['Cgw'][cat_name])+'[m h-1]',
-                      'expon=' + str(gdf_soil['gw_expon'][cat_name])+'[]',
-                      'gw_storage=0.05[m/m]',
-                      'alpha_fc=0.33',
-                      'soil_storage=' + str(gdf_soil['soil_smcmax'][cat_name])+'[m/m]', # 50% reservoir filled
-                      'K_nash_subsurface=0.03[]',
-                      'N_nash_subsurface=2',
-                      'K_lf=0.01[]',
-                      'nash_storage_subsurface=0.0,0.0',
-                      'num_timesteps=1',
-                      'verbosity=0'
-                   ]
 
-        
-        if (gdf_soil['soil_b'][cat_name] == 1.0):
-            cfe_params[4] = 1.1
+    cat_names = get_cat_names(catids)
+    df = gdf_soil.reindex(cat_names)
 
-        # add giuh ordinates
-        if (surface_runoff_scheme == "GIUH" or surface_runoff_scheme == 1):
-            giuh_cat = json.loads(gdf_soil['giuh'][cat_name])
-            giuh_cat = pd.DataFrame(giuh_cat, columns=['v', 'frequency'])
+    soil_b = df['soil_b'].where(df['soil_b'] != 1.0, 1.1)
+    
+    # cfe params set (formatted for all catchments at once)
+    cfe_params = ['forcing_file=BMI',
+                  'surface_water_partitioning_scheme=Schaake',
+                  'surface_runoff_scheme=GIUH',
+                  'soil_params.depth=2.0[m]',
+                  format_column(soil_b, 'soil_params.b=', '[]'),
+                  format_column(df['soil_satdk'], 'soil_params.satdk=', '[m s-1]'),
+                  format_column(df['soil_satpsi'], 'soil_params.satpsi=', '[m]'),
+                  format_column(df['soil_slop'], 'soil_params.slop=', '[m/m]'),
+                  format_column(df['soil_smcmax'], 'soil_params.smcmax=', '[m/m]'),
+                  format_column(df['soil_wltsmc'], 'soil_params.wltsmc=', '[m/m]'),
+                  'soil_params.expon=1.0[]',
+                  'soil_params.expon_secondary=1.0[]',
+                  format_column(df['soil_refkdt'], 'refkdt='),
+                  format_column(df['max_gw_storage'], 'max_gw_storage=', '[m]'),
+                  format_column(df['Cgw'], 'Cgw=', '[m h-1]'),
+                  format_column(df['gw_expon'], 'expon=', '[]'),
+                  'gw_storage=0.05[m/m]',
+                  'alpha_fc=0.33',
+                  format_column(df['soil_smcmax'], 'soil_storage=', '[m/m]'), # 50% reservoir filled
+                  'K_nash_subsurface=0.03[]',
+                  'N_nash_subsurface=2',
+                  'K_lf=0.01[]',
+                  'nash_storage_subsurface=0.0,0.0',
+                  'num_timesteps=1',
+                  'verbosity=0'
+                  ]
 
-            giuh_ordinates = ",".join(str(x) for x in np.array(giuh_cat["frequency"]))
-            cfe_params.append(f'giuh_ordinates={giuh_ordinates}')
+    # add giuh ordinates
+    if (surface_runoff_scheme == "GIUH" or surface_runoff_scheme == 1):
+        cfe_params.append('giuh_ordinates=' + format_distribution_column(df['giuh']))
             
-        elif (surface_runoff_scheme == "NASH_CASCADE" or surface_runoff_scheme == 2):
-            cfe_params[2]='surface_runoff_scheme=NASH_CASCADE'
-            cfe_params.append("N_nash_surface=" + str(int(gdf_soil['N_nash_surface'][cat_name]))+'[]')
-            cfe_params.append("K_nash_surface=" + str(gdf_soil['K_nash_surface'][cat_name])+'[h-1]')
-            s = [str(0.0),]*int(gdf_soil['N_nash_surface'][cat_name])
-            s = delimiter.join(s)
-            cfe_params.append("nash_storage_surface=" + str(s)+'[]')
+    elif (surface_runoff_scheme == "NASH_CASCADE" or surface_runoff_scheme == 2):
+        N_nash = df['N_nash_surface'].astype(int)
+        cfe_params[2]='surface_runoff_scheme=NASH_CASCADE'
+        cfe_params.append(format_column(N_nash, "N_nash_surface=", '[]'))
+        cfe_params.append(format_column(df['K_nash_surface'], "K_nash_surface=", '[h-1]'))
+        nash_storage = np.asarray([delimiter.join([str(0.0),]*n) for n in N_nash], dtype=object)
+        cfe_params.append("nash_storage_surface=" + nash_storage + '[]')
         
-        if(precip_partitioning_scheme == 'Xinanjiang'):
-            cfe_params[1]='surface_water_partitioning_scheme=Xinanjiang'
-            cfe_params.append('a_Xinanjiang_inflection_point_parameter='+str(soil_class_NWM['AXAJ'][soil_id]))
-            cfe_params.append('b_Xinanjiang_shape_parameter='+str(soil_class_NWM['BXAJ'][soil_id]))
-            cfe_params.append('x_Xinanjiang_shape_parameter='+str(soil_class_NWM['XXAJ'][soil_id]))
-            cfe_params.append('urban_decimal_fraction='+str(urban_decimal_fraction))
-
-        # coupled with Soil freeze thaw model
-        if(coupled_models == "nom_cfe_smp_sft"):
-            cfe_params.append("sft_coupled=true")
-            cfe_params.append("ice_content_threshold="+str(ice_content_threshold))
-
-        fname_cfe = 'cfe_config_' + cat_name + '.txt'
-        cfe_file = os.path.join(cfe_dir, fname_cfe)
-        with open(cfe_file, "w") as f:
-            f.writelines('\n'.join(cfe_params))
+    if(precip_partitioning_scheme == 'Xinanjiang'):
+        soil_id = df['ISLTYP'].values
+        cfe_params[1]='surface_water_partitioning_scheme=Xinanjiang'
+        cfe_params.append(format_column(soil_class_NWM['AXAJ'].reindex(soil_id), 'a_Xinanjiang_inflection_point_parameter='))
+        cfe_params.append(format_column(soil_class_NWM['BXAJ'].reindex(soil_id), 'b_Xinanjiang_shape_parameter='))
+        cfe_params.append(format_column(soil_class_NWM['XXAJ'].reindex(soil_id), 'x_Xinanjiang_shape_parameter='))
+        cfe_params.append('urban_decimal_fraction='+str(urban_decimal_fraction))
+
+    # coupled with Soil freeze thaw model
+    if(coupled_models == "nom_cfe_smp_sft"):
+        cfe_params.append("sft_coupled=true")
+        cfe_params.append("ice_content_threshold="+str(ice_content_threshold))
+
+    write_catchment_files(cfe_dir, 'cfe_config_{}.txt', cat_names, cfe_params, archive)
 
 #############################################################################
 # The function generates configuration file for TopModel
@@ -385,9 +555,22 @@ def write_cfe_input_files(catids, precip_partitioning_scheme, surface_runoff_sch
 # @param cfe_dir        : output directory (config files are written to this directory)
 # @param gpkg_file      : basin geopackage file
 # @param coupled_models : option needed to modify CFE config files based on the coupling type
+# @param archive        : ConfigArchive (optional), config files are added to the archive instead
+# @param init_topmodel_dir : directory the TopModel files are read from by ngen (default: topmodel_dir),
+#                            e.g. the directory the config archive is extracted to
 #############################################################################
-def write_topmodel_input_files(catids, gdf_soil, topmodel_dir, coupled_models):
-    
+def write_topmodel_input_files(catids, gdf_soil, topmodel_dir, coupled_models, archive=None, init_topmodel_dir=None):
+
+    def write_file(file_path, lines):
+        if (archive is not None):
+            archive.add(file_path, '\n'.join(lines))
+        else:
+            with open(file_path, "w") as f:
+                f.writelines('\n'.join(lines))
+
+    if (init_topmodel_dir is None):
+        init_topmodel_dir = topmodel_dir
+
     # loop over all catchments and write config files
     for catID in catids:
         cat_name = 'cat-'+str(catID) 
@@ -397,18 +580,15 @@ def write_topmodel_input_files(catids, gdf_soil, topmodel_dir, coupled_models):
         topmod = ["0",
                   f'{cat_name}',
                   "./forcing/%s.csv"%cat_name,
-                  f'./{topmodel_dir}/subcat_{cat_name}.dat',
-                  f'./{topmodel_dir}/params_{cat_name}.dat',
-                  f'./{topmodel_dir}/topmod_{cat_name}.out',
-                  f'./{topmodel_dir}/hyd_{cat_name}.out'
+                  f'./{init_topmodel_dir}/subcat_{cat_name}.dat',
+                  f'./{init_topmodel_dir}/params_{cat_name}.dat',
+                  f'./{init_topmodel_dir}/topmod_{cat_name}.out',
+                  f'./{init_topmodel_dir}/hyd_{cat_name}.out'
                   ]
 
         fname_tm = f'topmod_{cat_name}.run' # + '_config_.run'
         tm_file = os.path.join(topmodel_dir, fname_tm)
-        with open(tm_file, "w") as f:
-            f.writelines('\n'.join(topmod))
-
-        f.close()
+        write_file(tm_file, topmod)
         
         #################
         params = [f'Extracted study basin: {cat_name}',
@@ -417,10 +597,7 @@ def write_topmodel_input_files(catids, gdf_soil, topmodel_dir, coupled_models):
 
         fname_tm = f'params_{cat_name}.dat'
         tm_file = os.path.join(topmodel_dir, fname_tm)
-        with open(tm_file, "w") as f:
-            f.writelines('\n'.join(params))
-
-        f.close()
+        write_file(tm_file, params)
 
         ################
         twi_cat = json.loads(gdf_soil['twi'][cat_name])
@@ -462,25 +639,53 @@ def write_topmodel_input_files(catids, gdf_soil, topmodel_dir, coupled_models):
         
         fname_tm = f'subcat_{cat_name}.dat'
         tm_file = os.path.join(topmodel_dir, fname_tm)
-        with open(tm_file, "w") as f:
-            f.writelines('\n'.join(subcat))
-
-        f.close()
+        write_file(tm_file, subcat)
         
                        
+#############################################################################
+# computes mean annual air temperature (mean of the first year of the forcing data) of all catchments
+# - NetCDF forcing (one file per basin, forcing_prep layout) is read once, only the first year of the
+#   temperature variable is loaded and reduced for all catchments at once
+# - csv forcing (one file per catchment) reads only the first year of the T2D column of each file
+# @param forcing_dir : basin NetCDF forcing file or forcing directory containing csv files for each catchment
+# @param cat_names   : catchment names (cat-*)
+# - returns          : Series of MAAT [K] indexed by catchment name
+#############################################################################
+def get_maat(forcing_dir, cat_names):
+
+    nsteps_yr = 365 * 24 # number of steps in the first year of the met. data
+
+    if (os.path.isfile(forcing_dir)):
+        import xarray as xr
+        with xr.open_dataset(forcing_dir) as ds:
+            var = "T2D" if "T2D" in ds else "TMP_2maboveground"
+            time_dim = "time" if "time" in ds[var].dims else ds[var].dims[-1]
+            maat = ds[var].isel({time_dim : slice(0, nsteps_yr)}).mean(dim=time_dim).values.astype(np.float64)
+            ids = ds['ids'].values.astype(str)
+        return pd.Series(maat, index=ids).reindex(cat_names)
+
+    maat = []
+    for cat_name in cat_names:
+        forcing_file = glob.glob(os.path.join(forcing_dir, cat_name+'*.csv'))[0]
+        df_forcing = pd.read_csv(forcing_file,  delimiter=',', usecols=['T2D'], nrows=nsteps_yr, index_col=None)
+        maat.append(df_forcing['T2D'].mean())
+
+    return pd.Series(maat, index=cat_names)
+
 #############################################################################
 # The function generates configuration file for soil freeze thaw (SFT) model
 # @param catids         : array/list of integers contain catchment ids
 # @param runoff_schame  : surface runoff schemes - Options = Schaake or Xinanjiang
-# @param forcing_dir    : forcing data directory containing data for each catchment
-#                         used here for model initialization (based on mean annual air temperature)                
+# @param maat           : Series of mean annual air temperature [K] indexed by catchment name (see get_maat),
+#                         used here for model initialization
 # @param soil_class_NWM : a dict containing NWM soil characteristics, used here for extracting
 # @param gdf_soil       : geodataframe contains soil properties extracted from the hydrofabric
 #                         Quartz properties for a given soil type
 # @param sft_dir        : output directory (config files are written to this directory)
+# @param archive        : ConfigArchive (optional), config files are added to the archive instead
 #############################################################################
-def write_sft_input_files(catids, precip_partitioning_scheme, surface_runoff_scheme, forcing_dir,
-                          gdf_soil, soil_class_NWM, sft_dir):
+def write_sft_input_files(catids, precip_partitioning_scheme, surface_runoff_scheme, maat,
+                          gdf_soil, soil_class_NWM, sft_dir, archive=None):
 
     # runoff scheme
     if (not precip_partitioning_scheme in ["Schaake", "Xinanjiang"]):
@@ -495,40 +700,28 @@ def write_sft_input_files(catids, precip_partitioning_scheme, surface_runoff_sch
     
     delimiter = ','
 
-    nsteps_yr = 365 * 24 # number of steps in the first year of the met. data
+    cat_names = get_cat_names(catids)
+    df = gdf_soil.reindex(cat_names)
     
-    # loop over all catchments and write config files
-    for catID in catids:
-        cat_name = 'cat-'+str(catID)
-        forcing_file = glob.glob(os.path.join(forcing_dir, cat_name+'*.csv'))[0]
-        
-        # obtain annual mean surface temperature as proxy for initial soil temperature
-        #df_forcing = pd.read_table(forcing_file,  delimiter=',')
-        df_forcing = pd.read_csv(forcing_file,  delimiter=',', usecols=['T2D'], nrows=nsteps_yr, index_col=None)
-        
-        # compute mean annual air temperature for model initialization
-        #MAAT = [str(round(df_forcing['T2D'][:nsteps_yr].mean(), 2)),]*ncells
-        MAAT = [str(round(df_forcing['T2D'].mean(), 2)),]*ncells
-        MAAT = delimiter.join(MAAT)
-        
-        # get soil type
-        soil_id = gdf_soil['ISLTYP'][cat_name]
-        
-        # sft params set
-        sft_params = ['verbosity=none', 'soil_moisture_bmi=1', 'end_time=1.0[d]', 'dt=1.0[h]', 
-                      'soil_params.smcmax=' + str(gdf_soil['soil_params.smcmax'][cat_name]) + '[m/m]', 
-                      'soil_params.b=' + str(gdf_soil['soil_params.b'][cat_name]) + '[]', 
-                      'soil_params.satpsi=' + str(gdf_soil['soil_params.satpsi'][cat_name]) + '[m]', 
-                      'soil_params.quartz=' + str(soil_class_NWM['QTZ'][soil_id]) +'[]',
-                      'ice_fraction_scheme=' + precip_partitioning_scheme,
-                      f'soil_z={soil_z}[m]',
-                      f'soil_temperature={MAAT}[K]'
-                      ]
-
-        fname_sft = 'sft_config_' + cat_name + '.txt'
-        sft_file = os.path.join(sft_dir, fname_sft)
-        with open(sft_file, "w") as f:
-            f.writelines('\n'.join(sft_params))
+    # annual mean surface temperature as proxy for initial soil temperature (same value for all cells)
+    MAAT = format_column(maat.reindex(cat_names).round(2))
+    MAAT = np.asarray([delimiter.join([t,]*ncells) for t in MAAT], dtype=object)
+
+    # get soil type
+    soil_id = df['ISLTYP'].values
+
+    # sft params set (formatted for all catchments at once)
+    sft_params = ['verbosity=none', 'soil_moisture_bmi=1', 'end_time=1.0[d]', 'dt=1.0[h]', 
+                  format_column(df['soil_smcmax'], 'soil_params.smcmax=', '[m/m]'),
+                  format_column(df['soil_b'], 'soil_params.b=', '[]'),
+                  format_column(df['soil_satpsi'], 'soil_params.satpsi=', '[m]'),
+                  format_column(soil_class_NWM['QTZ'].reindex(soil_id), 'soil_params.quartz=', '[]'),
+                  'ice_fraction_scheme=' + precip_partitioning_scheme,
+                  f'soil_z={soil_z}[m]',
+                  'soil_temperature=' + MAAT + '[K]'
+                  ]
+
+    write_catchment_files(sft_dir, 'sft_config_{}.txt', cat_names, sft_params, archive)
 
 #############################################################################
 # The function generates configuration file for soil moisture profiles (SMP) model
@@ -536,39 +729,35 @@ def write_sft_input_files(catids, precip_partitioning_scheme, surface_runoff_sch
 # @gdf_soil             : geodataframe contains soil properties extracted from the hydrofabric
 # @param smp_dir        : output directory (config files are written to this directory)
 # @param coupled_models : option needed to modify SMP config files based on the coupling type
+# @param archive        : ConfigArchive (optional), config files are added to the archive instead
 #############################################################################
-def write_smp_input_files(catids, gdf_soil, smp_dir, coupled_models):
+def write_smp_input_files(catids, gdf_soil, smp_dir, coupled_models, archive=None):
 
     #soil_z = "0.1,0.3,1.0,2.0"
     soil_z = "0.1,0.15,0.18,0.23,0.29,0.36,0.44,0.55,0.69,0.86,1.07,1.34,1.66,2.07,2.58,3.22,4.01,5.0,6.0"
 
-    # loop over all catchments and write config files
-    for catID in catids:
-        cat_name = 'cat-'+str(catID) 
+    cat_names = get_cat_names(catids)
+    df = gdf_soil.reindex(cat_names)
+
+    # smp params set (formatted for all catchments at once)
+    smp_params = ['verbosity=none',
+                  format_column(df['soil_smcmax'], 'soil_params.smcmax=', '[m/m]'),
+                  format_column(df['soil_b'], 'soil_params.b=', '[]'),
+                  format_column(df['soil_satpsi'], 'soil_params.satpsi=', '[m]'),
+                  f'soil_z={soil_z}[m]',
+                  'soil_moisture_fraction_depth=1.0[m]'
+                  ]
 
-        soil_id = gdf_soil['ISLTYP'][cat_name]
-                   
-        smp_params = ['verbosity=none',
-                      'soil_params.smcmax=' + str(gdf_soil['soil_params.smcmax'][cat_name]) + '[m/m]',
-                      'soil_params.b=' + str(gdf_soil['soil_params.b'][cat_name]) + '[]',
-                      'soil_params.satpsi=' + str(gdf_soil['soil_params.satpsi'][cat_name]) + '[m]',
-                      f'soil_z={soil_z}[m]',
-                      'soil_moisture_fraction_depth=1.0[m]'
-                      ]
-
-        if ("cfe" in coupled_models):
-            smp_params += ['soil_storage_model=conceptual', 'soil_storage_depth=2.0']  
-        elif ("lasam" in coupled_models):
-            smp_params += ['soil_storage_model=layered', 'soil_moisture_profile_option=constant',
-                           'soil_depth_layers=2.0', 'water_table_depth=10[m]']
-            # note: soil_depth_layers is an array of depths and will be modified in the future for heterogeneous soils 
-            # for exmaple, 'soil_depth_layers=0.4,1.75,2.0'
-            # SMCMAX is also an array for hetero. soils
-
-        fname_smp = 'smp_config_' + cat_name + '.txt'
-        smp_file = os.path.join(smp_dir, fname_smp)
-        with open(smp_file, "w") as f:
-            f.writelines('\n'.join(smp_params))
+    if ("cfe" in coupled_models):
+        smp_params += ['soil_storage_model=conceptual', 'soil_storage_depth=2.0']  
+    elif ("lasam" in coupled_models):
+        smp_params += ['soil_storage_model=layered', 'soil_moisture_profile_option=constant',
+                       'soil_depth_layers=2.0', 'water_table_depth=10[m]']
+        # note: soil_depth_layers is an array of depths and will be modified in the future for heterogeneous soils 
+        # for exmaple, 'soil_depth_layers=0.4,1.75,2.0'
+        # SMCMAX is also an array for hetero. soils
+
+    write_catchment_files(smp_dir, 'smp_config_{}.txt', cat_names, smp_params, archive)
 
 #############################################################################
 # The function generates configuration file for lumped arid/semi-arid model (LASAM)
@@ -578,8 +767,9 @@ def write_smp_input_files(catids, gdf_soil, smp_dir, coupled_models):
 # @gdf_soil             : geodataframe contains soil properties extracted from the hydrofabric
 # @param lasam_dir        : output directory (config files are written to this directory)
 # @param coupled_models : option needed to modify SMP config files based on the coupling type
+# @param archive        : ConfigArchive (optional), config files are added to the archive instead
 #############################################################################
-def write_lasam_input_files(catids, soil_param_file, gdf_soil, lasam_dir, coupled_models):
+def write_lasam_input_files(catids, soil_param_file, gdf_soil, lasam_dir, coupled_models, archive=None):
 
     sft_calib = "False" # update later (should be taken as an argument)
 
@@ -610,96 +800,74 @@ def write_lasam_input_files(catids, soil_param_file, gdf_soil, lasam_dir, couple
     if ( ("sft" in coupled_models) and (sft_calib in ["true", "True"]) ):
         lasam_params_base.append('calib_params=true')
 
-    
+    cat_names = get_cat_names(catids)
+    df = gdf_soil.reindex(cat_names)
+
     soil_type_loc = lasam_params_base.index("layer_soil_type=")
     giuh_loc_id   = lasam_params_base.index("giuh_ordinates=")
-    
-    # loop over all catchments and write config files
-    for catID in catids:
-        cat_name = 'cat-'+str(catID) 
-        fname = cat_name+'*.txt'
 
-        lasam_params = lasam_params_base.copy()
-        lasam_params[soil_type_loc] += str(gdf_soil['ISLTYP'][cat_name])
+    # formatted for all catchments at once
+    lasam_params = lasam_params_base.copy()
+    lasam_params[soil_type_loc] = format_column(df['ISLTYP'], "layer_soil_type=")
+    lasam_params[giuh_loc_id]   = "giuh_ordinates=" + format_distribution_column(df['giuh'])
 
-        # add giuh ordinates
-        giuh_cat = json.loads(gdf_soil['giuh'][cat_name])
-        giuh_cat = pd.DataFrame(giuh_cat, columns=['v', 'frequency'])
-
-        giuh_ordinates = ",".join(str(x) for x in np.array(giuh_cat["frequency"]))
-        lasam_params[giuh_loc_id] += giuh_ordinates
-        
-        fname_lasam = 'lasam_config_' + cat_name + '.txt'
-        lasam_file = os.path.join(lasam_dir, fname_lasam)
-        with open(lasam_file, "w") as f:
-            f.writelines('\n'.join(lasam_params))
+    write_catchment_files(lasam_dir, 'lasam_config_{}.txt', cat_names, lasam_params, archive)
 
 #############################################################################
 # The function generates configuration file for potential evapotranspiration model
 # @param catids         : array/list of integers contain catchment ids
 # @param gdf_soil       : geodataframe contains soil properties extracted from the model attributes
 #                          (characterizes soil for specified soil types)
-# @param gdf_soil        : geodataframe contains soil properties extracted from the model attributes
+# @param gpkg_file       : basin geopackage file (or BasinGeopackage)
 # @param pet_dir         : output directory (config files are written to this directory)
+# @param archive        : ConfigArchive (optional), config files are added to the archive instead
 #############################################################################
-def write_pet_input_files(catids, gdf_soil, gpkg_file, pet_dir):
+def write_pet_input_files(catids, gdf_soil, gpkg_file, pet_dir, archive=None):
 
-    df_cats = gpd.read_file(gpkg_file, layer='divides')
-    df_cats = df_cats.to_crs("EPSG:4326") # change CRS to 4326
-    
-    df_cats.set_index("divide_id", inplace=True)
+    # catchments centroids in EPSG:4326 (computed once per basin)
+    cat_names = get_cat_names(catids)
+    df_cats = get_basin_geopackage(gpkg_file).centroids.reindex(cat_names)
     
     pet_method = 3
 
-    
-    # loop over all catchments and write config files
-    for catID in catids:
-        cat_name = 'cat-'+str(catID)
-        
-        centroid_x = str(df_cats['geometry'][cat_name].centroid.x)
-        centroid_y = str(df_cats['geometry'][cat_name].centroid.y)
+    # pet parameters (formatted for all catchments at once)
+    pet_params = ['verbose=0',
+                  f'pet_method={pet_method}',
+                  'forcing_file=BMI',
+                  'run_unit_tests=0',
+                  'yes_aorc=1',
+                  'yes_wrf=0',
+                  'wind_speed_measurement_height_m=10.0',
+                  'humidity_measurement_height_m=2.0',
+                  'vegetation_height_m=16.0',
+                  'zero_plane_displacement_height_m=0.0003',
+                  'momentum_transfer_roughness_length=0.0',
+                  'heat_transfer_roughness_length_m=0.0',
+                  'surface_longwave_emissivity=1.0',
+                  'surface_shortwave_albedo=0.17',
+                  'cloud_base_height_known=FALSE',
+                  'time_step_size_s=3600',
+                  'num_timesteps=720',
+                  'shortwave_radiation_provided=1',
+                  format_column(df_cats['y'], 'latitude_degrees='),
+                  format_column(df_cats['x'], 'longitude_degrees='),
+                  format_column(gdf_soil['elevation_mean'].reindex(cat_names), 'site_elevation_m=')
+                  ]
 
-        elevation_mean = gdf_soil['elevation_mean'][cat_name]
-        
-        # pet parameters
-        pet_params = ['verbose=0',
-                      f'pet_method={pet_method}',
-                      'forcing_file=BMI',
-                      'run_unit_tests=0',
-                      'yes_aorc=1',
-                      'yes_wrf=0',
-                      'wind_speed_measurement_height_m=10.0',
-                      'humidity_measurement_height_m=2.0',
-                      'vegetation_height_m=16.0',
-                      'zero_plane_displacement_height_m=0.0003',
-                      'momentum_transfer_roughness_length=0.0',
-                      'heat_transfer_roughness_length_m=0.0',
-                      'surface_longwave_emissivity=1.0',
-                      'surface_shortwave_albedo=0.17',
-                      'cloud_base_height_known=FALSE',
-                      'time_step_size_s=3600',
-                      'num_timesteps=720',
-                      'shortwave_radiation_provided=1',
-                      f'latitude_degrees={centroid_y}',
-                      f'longitude_degrees={centroid_x}',
-                      f'site_elevation_m={elevation_mean}'
-                      ]
-    
-
-        
-        fname_pet = 'pet_config_' + cat_name + '.txt'
-        pet_file = os.path.join(pet_dir, fname_pet)
-        with open(pet_file, "w") as f:
-            f.writelines('\n'.join(pet_params))
+    write_catchment_files(pet_dir, 'pet_config_{}.txt', cat_names, pet_params, archive)
 
 #############################################################################
 # The function generates configuration file for t-route model
-# @param catids         : array/list of integers contain catchment ids
+# @param gpkg_file      : basin geopackage file (or BasinGeopackage)
 # @param troute_dir        : output directory (config files are written to this directory)
+# @param output_format  : t-route stream output format, csv or parquet (columnar, the calibration reads only the
+#                         evaluated segment, see ngen_cal_troute_output_plugin.py)
 #############################################################################
 def write_troute_input_files(gpkg_file, routing_file, troute_dir, simulation_time,
-                             sim_output_dir, is_calib):
+                             sim_output_dir, is_calib, output_format = "csv"):
 
+    basin      = get_basin_geopackage(gpkg_file)
+    gpkg_file  = basin.gpkg_file
     gpkg_name  = os.path.basename(gpkg_file).split(".")[0]
     
     if (not os.path.exists(routing_file)):
@@ -723,7 +891,7 @@ def write_troute_input_files(gpkg_file, routing_file, troute_dir, simulation_tim
     params = schema.get_schema_flowpath_attributes(gdf_fp_attr)
     """
     
-    params = get_flowpath_attributes(gpkg_file, full_schema=True)
+    params = get_flowpath_attributes(basin, full_schema=True)
 
     columns = {
         'key' : params['key'],
@@ -768,7 +936,20 @@ def write_troute_input_files(gpkg_file, routing_file, troute_dir, simulation_tim
 
     d['compute_parameters']['cpu_pool'] = 10
 
-    if(is_calib in ["True", "true", "TRUE", "Yes", "yes",  "YES"]):
+    if (output_format == "parquet"):
+        if(is_calib in ["True", "true", "TRUE", "Yes", "yes",  "YES"]):
+            output_directory = "./"
+        else:
+            output_directory = os.path.join(sim_output_dir, "troute_parq")
+        stream_output = {
+            "stream_output" : {
+                'stream_output_directory' : output_directory,
+                'stream_output_time'      : -1, #[hr], -1 = write one file at the end of simulation
+                'stream_output_type'      : '.parquet',
+                'stream_output_internal_frequency' : 60 #[min]
+            }
+        }
+    elif(is_calib in ["True", "true", "TRUE", "Yes", "yes",  "YES"]):
         stream_output = {
             "csv_output" : {
                 "csv_output_folder" : "./"
@@ -802,9 +983,15 @@ def write_troute_input_files(gpkg_file, routing_file, troute_dir, simulation_tim
 # @ngen_dir             : ngen directory
 # @param gpkg_file      : basin geopackage file
 # @param real_file      : realization file
+# @param start_iteration : iteration to resume an interrupted calibration from (None starts a new calibration)
+# @param troute_output_format : t-route stream output format (csv or parquet)
 #############################################################################
 def write_calib_input_files(gpkg_file, ngen_dir, conf_dir, realz_file, realz_file_par,
-                            troute_output_file, ngen_cal_basefile, num_proc = 1):
+                            troute_output_file, ngen_cal_basefile, num_proc = 1, start_iteration = None,
+                            troute_output_format = "csv"):
+
+    basin     = get_basin_geopackage(gpkg_file)
+    gpkg_file = basin.gpkg_file
 
     if (not os.path.exists(ngen_cal_basefile)):
         sys.exit("Sample calib yaml file does not exist, provided is " + ngen_cal_basefile)
@@ -818,6 +1005,11 @@ def write_calib_input_files(gpkg_file, ngen_dir, conf_dir, realz_file, realz_fil
 
     d['general']['workdir']    = os.path.dirname(os.path.dirname(gpkg_file))
 
+    # resume an interrupted calibration
+    if (start_iteration is not None):
+        d['general']['start_iteration'] = start_iteration
+        d['general']['restart']         = True
+
     d['model']['binary']      = os.path.join(ngen_dir, "cmake_build/ngen")
     d['model']['realization'] = realz_file
     d['model']['hydrofabric'] = gpkg_file
@@ -825,15 +1017,22 @@ def write_calib_input_files(gpkg_file, ngen_dir, conf_dir, realz_file, realz_fil
     #"./troute_output_201010010000.csv" # in the ngen-cal created directory named {current_time}_ngen_{random stuff}_worker
     #d['model']['routing_output'] = troute_output_file # if in the outputs/troute directory
 
+    # parquet t-route output is read by the TrouteParquetOutput plugin (only the eval_feature rows are loaded)
+    if (troute_output_format == "parquet"):
+        d['model']['routing_output'] = './troute_output.parquet'
+        parquet_plugin = "ngen_cal_user_plugins.ngen_cal_troute_output_plugin.TrouteParquetOutput"
+        plugins = d['model'].get('plugins') or []
+        if (parquet_plugin not in plugins):
+            d['model']['plugins'] = plugins + [parquet_plugin]
+
 
-    gage_id = get_flowpath_attributes(gpkg_file, gage_id=True)
+    gage_id = get_flowpath_attributes(basin, gage_id=True)
 
     if (len(gage_id) == 1):
         d['model']['eval_feature'] = gage_id[0]
     else:
         print ("more than one rl_gages exist in the geopackage, using max drainage area to filter...")
-        div = gpd.read_file(gpkg_file, layer='divides')
-        df = div[['divide_id', 'tot_drainage_areasqkm']]
+        df = pd.DataFrame(basin.divides[['divide_id', 'tot_drainage_areasqkm']])
         index = df['divide_id'].map(lambda x: 'wb-'+str(x.split("-")[1]))
         df.set_index(index, inplace=True)
         idmax = df['tot_drainage_areasqkm'].idxmax() # maximum drainage area catchment ID; downstream outlet
@@ -866,16 +1065,15 @@ def write_calib_input_files(gpkg_file, ngen_dir, conf_dir, realz_file, realz_fil
 
 #############################################################################
 # Return flowpath attributes for t-troue and ngen-cal
+# @param gpkg_file : basin geopackage file (or BasinGeopackage)
 #############################################################################
 def get_flowpath_attributes(gpkg_file, full_schema=False, gage_id=False):
 
-    layers = fiona.listlayers(gpkg_file)
-
-    flowpath_layer = [layer for layer in layers if 'flowpath' in layer and not 'flowpaths' in layer][0]
-
-    gdf_fp_attr = gpd.read_file(gpkg_file, layer=flowpath_layer)
+    basin = get_basin_geopackage(gpkg_file)
 
-    params = schema.get_schema_flowpath_attributes(gdf_fp_attr, for_gage_id = gage_id)
+    # the schema needs only the field names, no data is read here
+    params = schema.get_schema_flowpath_attributes(pd.DataFrame(columns=basin.flowpath_attributes_fields),
+                                                   for_gage_id = gage_id)
 
     if (full_schema):
         return params
@@ -884,7 +1082,7 @@ def get_flowpath_attributes(gpkg_file, full_schema=False, gage_id=False):
         gage_id      = params['gages']   # gage or rl_gages
         waterbody_id = params['key']     # id or link
 
-        gdf_fp_cols = gdf_fp_attr[[waterbody_id, gage_id]] # select the two columns of interest
+        gdf_fp_cols = basin.read_flowpath_attributes([waterbody_id, gage_id]) # read the two columns of interest
         basin_gage  = gdf_fp_cols[gdf_fp_cols[gage_id].notna()]
         basin_gage_id = basin_gage[waterbody_id].tolist()
 
@@ -921,7 +1119,7 @@ def write_forcing_input_files(forcing_basefile, gpkg_file, time):
     d["out_dir"] = os.path.join(os.path.dirname(gpkg_file), "forcing")
 
     if (not os.path.exists(d["out_dir"])):
-        os.makedirs("data/forcing")
+        os.makedirs(d["out_dir"])
 
     with open(os.path.join(d["out_dir"],"forcing_config.yaml"), 'w') as file:
         yaml.dump(d,file, default_flow_style=False, sort_keys=False)
@@ -938,164 +1136,246 @@ def create_directory(dir_name):
 
 
 #############################################################################
-# main function controlling calls to modules writing config files
-# @param gpkg_file       : hydrofabric geopackage file (.gpkg)
+# module controlling calls to modules writing config files of a basin (used in-process by driver.py)
+# @param gpkg_file       : hydrofabric geopackage file (.gpkg) or BasinGeopackage
 # @param forcing_dir     : forcing data directory containing data for each catchment
 # @param output_dir      : output directory (config files are written to subdirectories under this directory)
 # @param ngen_dir        : path to nextgen directory
 # @param models_option   : models coupling option (pre-defined names; see main.py)
-# @param runoff_schame   : surface runoff schemes - Options = Schaake or Xinanjiang (For CFE and SFT)
-# @param time            : dictionary containing simulations start and end time
-# @param overwrite       : boolean (if true, existing output directories are deleted or overwritten)
+# @param precip_partitioning_scheme : precip partitioning schemes - Options = Schaake or Xinanjiang (For CFE and SFT)
+# @param surface_runoff_scheme      : surface runoff schemes - Options = GIUH or NASH_CASCADE
+# @param simulation_time : dictionary containing simulations start and end time
+# @param is_troute       : boolean (if true, t-route config file is generated)
+# @param routing_file    : t-route sample config file
+# @param sim_output_dir  : ngen runs output directory
+# @param is_calib        : calibration option (string, see write_troute_input_files)
+# @param troute_output_format : t-route stream output format, csv or parquet
+# @param is_config_archive : boolean (if true, per-catchment config files are written to configs.tar, see config_archive.py)
+# @param init_config_dir : directory the config archive is extracted to before runs (default: output_dir), paths
+#                          referenced in the config files (e.g. NOM parameters) point to this directory
+# @param manifest        : Manifest of the basin (incremental mode, see manifest.py); config files of a model are
+#                          regenerated only if their inputs changed, None regenerates all
+# - returns              : list of catchment ids (None if all config files are up to date)
 #############################################################################
-def main():
-
-    try:
-        parser = argparse.ArgumentParser()
-        parser.add_argument("-gpkg", dest="gpkg_file",     type=str, required=True,  help="the gpkg file")
-        parser.add_argument("-f",    dest="forcing_dir",   type=str, required=True,  help="the forcing files directory")
-        parser.add_argument("-o",    dest="output_dir",    type=str, required=True,  help="the output files directory")
-        parser.add_argument("-ngen", dest="ngen_dir",      type=str, required=True,  help="the ngen directory")
-        parser.add_argument("-m",    dest="models_option", type=str, required=True,  help="option for models coupling")
-        parser.add_argument("-p",    dest="precip_partitioning_scheme", type=str, required=False,
-                            help="option for precip partitioning scheme", default="Schaake")
-        parser.add_argument("-r",    dest="surface_runoff_scheme", type=str, required=False,
-                            help="option for surface runoff scheme", default="GIUH")
-        parser.add_argument("-t",    dest="time",          type=json.loads, required=True,
-                            help="simulation start/end time") 
-        parser.add_argument("-ow",   dest="overwrite",     type=str, required=False, default=True,
-                            help="overwrite old/existing files")
-        parser.add_argument("-troute", dest="troute",     type=str, required=False, default=False, help="option for t-toure")
-        parser.add_argument("-routfile", dest="routfile", type=str, required=False, default=False, help="routing sample config file")
-        parser.add_argument("-v",      dest="verbosity",  type=int, required=False, default=False, help="verbosity option (0, 1, 2)")
-        parser.add_argument("-json",   dest="json_dir",   type=str, required=True,  help="realization files directory")
-        parser.add_argument("-sout",   dest="sim_output_dir",  type=str, required=True,  help="ngen runs output directory")
-        parser.add_argument("-c",      dest="calib",     type=str, required=False, default=False, help="option for calibration")
-        parser.add_argument("-schema", dest="schema",    type=str, required=False, default=False, help="gpkg schema type")
-    except:
-        parser.print_help()
-        sys.exit(1)
-    
-    args = parser.parse_args()
-    
-    if (not os.path.exists(args.gpkg_file)):
-        str_msg = 'The gpkg file does not exist! %s'%args.gpkg_file
-        sys.exit(str_msg)
+def write_config_files(gpkg_file, forcing_dir, output_dir, ngen_dir, models_option,
+                       precip_partitioning_scheme, surface_runoff_scheme, simulation_time,
+                       verbosity = 0, schema_type = 'noaa-owp', is_troute = False,
+                       routing_file = "", sim_output_dir = "", is_calib = "False",
+                       troute_output_format = "csv", is_config_archive = False, init_config_dir = "",
+                       manifest = None):
 
-    # check if the forcing dir is under Inputs directory
-    if (not os.path.exists(args.forcing_dir)):
-        str_msg = 'The forcing directory does not exist! %s'%args.forcing_dir
-        sys.exit(str_msg)
+    # geopackage layers are read once and shared by all writers
+    basin = get_basin_geopackage(gpkg_file)
 
+    if (not is_config_archive or init_config_dir == ""):
+        init_config_dir = output_dir
 
-    try:
-        gdf_soil, catids = read_gpkg_file(args.gpkg_file,
-                                          args.models_option,
-                                          args.surface_runoff_scheme,
-                                          args.verbosity,
-                                          schema_type=args.schema)
-    except:
-        print("Couldn't read geopackage file for model-attributes successfully..")
-        sys.exit(1)        
     # doing it outside NOM as some of params from this file are also needed by CFE for Xinanjiang runoff scheme
-    nom_params = os.path.join(args.ngen_dir,"extern/noah-owp-modular/noah-owp-modular/parameters")
-    
+    nom_params = os.path.join(ngen_dir,"extern/noah-owp-modular/noah-owp-modular/parameters")
+    soil_params_hash = file_hash(os.path.join(nom_params,"SOILPARM.TBL"))
+
+    lasam_params = os.path.join(ngen_dir,"extern/LGAR-C/data/vG_default_params.dat")
+    if (not os.path.isfile(lasam_params)):
+        lasam_params = os.path.join(ngen_dir,"extern/LASAM/data/vG_default_params.dat")
+
+    # inputs the config files of each model depend on
+    gpkg_inputs = {"gpkg" : file_stat(basin.gpkg_file), "schema_type" : schema_type, "models_option" : models_option}
+    model_inputs = {}
+
+    if "nom" in models_option:
+        model_inputs["nom"] = dict(gpkg_inputs, forcing_dir = forcing_dir, simulation_time = simulation_time,
+                                   soil_params = soil_params_hash)
+    if "cfe" in models_option:
+        model_inputs["cfe"] = dict(gpkg_inputs, precip_partitioning_scheme = precip_partitioning_scheme,
+                                   surface_runoff_scheme = surface_runoff_scheme, soil_params = soil_params_hash)
+    if "topmodel" in models_option:
+        model_inputs["topmodel"] = gpkg_inputs
+    if "pet" in models_option:
+        model_inputs["pet"] = gpkg_inputs
+    if "sft" in models_option:
+        # SFT and SMP config files are generated together, MAAT is computed from the forcing data
+        model_inputs["sft"] = dict(gpkg_inputs, precip_partitioning_scheme = precip_partitioning_scheme,
+                                   surface_runoff_scheme = surface_runoff_scheme, soil_params = soil_params_hash,
+                                   forcing_dir = forcing_dir, forcing = path_stat(forcing_dir))
+    elif "smp" in models_option:
+        model_inputs["smp"] = gpkg_inputs
+    if "lasam" in models_option:
+        model_inputs["lasam"] = dict(gpkg_inputs, surface_runoff_scheme = surface_runoff_scheme,
+                                     lasam_params = file_hash(lasam_params))
+
+    # models whose config files need to be (re)generated
+    model_dirs = {m : [os.path.join(output_dir, m)] for m in model_inputs}
+    model_dirs["sft"] = model_dirs.get("sft", []) + [os.path.join(output_dir, "smp")]
+
+    if (manifest is None):
+        models = list(model_inputs)
+    elif (is_config_archive):
+        archive_file = os.path.join(output_dir, config_archive.archive_name)
+        is_stale = manifest.is_stale("config_archive", dict(model_inputs, init_config_dir = init_config_dir),
+                                     outputs = [archive_file])
+        models = list(model_inputs) if is_stale else []
+    else:
+        models = [m for m in model_inputs if manifest.is_stale(m, model_inputs[m], outputs = model_dirs[m])]
+
+    catids = None
+    if (len(models) == 0 and verbosity >=3):
+        print ("Config files are up to date, skipping ...")
+
+    # bulk output mode, per-catchment config files of all models go to one archive
+    archive = None
+    if (is_config_archive and len(models) > 0):
+        archive = config_archive.ConfigArchive(os.path.join(output_dir, config_archive.archive_name),
+                                               root_dir = output_dir)
+
+    if (len(models) > 0):
+        try:
+            with tracing.span("read_gpkg_file", basin = basin.gpkg_file):
+                gdf_soil, catids = read_gpkg_file(basin,
+                                                  models_option,
+                                                  surface_runoff_scheme,
+                                                  verbosity,
+                                                  schema_type=schema_type)
+        except:
+            print("Couldn't read geopackage file for model-attributes successfully..")
+            sys.exit(1)
+
     # *************** NOM  ********************
-    if "nom" in args.models_option:
-        if (args.verbosity >=3):
+    if "nom" in models:
+        if (verbosity >=3):
             print ("Generating config files for NOM ...")
-        nom_dir = os.path.join(args.output_dir,"nom")
+        nom_dir = os.path.join(output_dir,"nom")
         create_directory(nom_dir)
-        str_sub ="cp -r "+ nom_params + " %s"%nom_dir
-        out=subprocess.call(str_sub,shell=True)
-        nom_soil_file = os.path.join(nom_dir,"parameters/SOILPARM.TBL")
-
-        write_nom_input_files(catids, nom_dir, args.forcing_dir,  gdf_soil, args.time, args.verbosity)
+        if (archive is not None):
+            archive.add_dir(os.path.join(nom_dir,"parameters"), nom_params)
+        else:
+            str_sub ="cp -r "+ nom_params + " %s"%nom_dir
+            out=subprocess.call(str_sub,shell=True)
+
+        with tracing.span("write_nom_input_files", basin = basin.gpkg_file):
+            write_nom_input_files(catids, nom_dir, forcing_dir,  gdf_soil, simulation_time, verbosity, archive,
+                                  parameter_dir = os.path.join(init_config_dir,"nom","parameters"))
     
     # *************** CFE  ********************
-    if "cfe" in args.models_option:
-        if (args.verbosity >=3):
+    if "cfe" in models:
+        if (verbosity >=3):
             print ("Generating config files for CFE ...")
-        cfe_dir = os.path.join(args.output_dir,"cfe")
+        cfe_dir = os.path.join(output_dir,"cfe")
         create_directory(cfe_dir)
 
         # read NWM soil class
         nom_soil_file = os.path.join(nom_params,"SOILPARM.TBL")
         soil_class_NWM = get_soil_class_NWM(nom_soil_file)
         
-        write_cfe_input_files(catids, args.precip_partitioning_scheme, args.surface_runoff_scheme,
-                              soil_class_NWM, gdf_soil, cfe_dir, args.models_option)
+        with tracing.span("write_cfe_input_files", basin = basin.gpkg_file):
+            write_cfe_input_files(catids, precip_partitioning_scheme, surface_runoff_scheme,
+                                  soil_class_NWM, gdf_soil, cfe_dir, models_option, archive)
 
     # *************** TOPMODEL  ********************
-    if "topmodel" in args.models_option:
-        if (args.verbosity >=3):
+    if "topmodel" in models:
+        if (verbosity >=3):
             print ("Generating config files for TopModel ...")
-        tm_dir = os.path.join(args.output_dir,"topmodel")
+        tm_dir = os.path.join(output_dir,"topmodel")
         create_directory(tm_dir)
         
-        write_topmodel_input_files(catids, gdf_soil, tm_dir, args.models_option)
+        with tracing.span("write_topmodel_input_files", basin = basin.gpkg_file):
+            write_topmodel_input_files(catids, gdf_soil, tm_dir, models_option, archive,
+                                       init_topmodel_dir = os.path.join(init_config_dir,"topmodel"))
 
     # *************** PET  ********************
-    if "pet" in args.models_option:
-        if (args.verbosity >=3):
+    if "pet" in models:
+        if (verbosity >=3):
             print ("Generating config files for PET ...")
-        pet_dir = os.path.join(args.output_dir,"pet")
+        pet_dir = os.path.join(output_dir,"pet")
         create_directory(pet_dir)
         
-        write_pet_input_files(catids, gdf_soil, args.gpkg_file, pet_dir)
+        with tracing.span("write_pet_input_files", basin = basin.gpkg_file):
+            write_pet_input_files(catids, gdf_soil, basin, pet_dir, archive)
         
     # *************** SFT ********************
-    if "sft" in args.models_option:
-        if (args.verbosity >=3):
+    if "sft" in models:
+        if (verbosity >=3):
             print ("Generating config files for SFT and SMP ...")
         smp_only_flag = False
         
-        sft_dir = os.path.join(args.output_dir,"sft")
+        sft_dir = os.path.join(output_dir,"sft")
         create_directory(sft_dir)
 
-        smp_dir = os.path.join(args.output_dir,"smp")
+        smp_dir = os.path.join(output_dir,"smp")
         create_directory(smp_dir)
 
         # read NWM soil class
         nom_soil_file = os.path.join(nom_params,"SOILPARM.TBL")
         soil_class_NWM = get_soil_class_NWM(nom_soil_file)
         
-        write_sft_input_files(catids, args.precip_partitioning_scheme, args.surface_runoff_scheme,
-                              args.forcing_dir, gdf_soil, soil_class_NWM, sft_dir)
+        # MAAT of all catchments (kept in maat.csv for reference)
+        with tracing.span("get_maat", basin = basin.gpkg_file):
+            maat = get_maat(forcing_dir, get_cat_names(catids))
+        maat.rename("MAAT").to_csv(os.path.join(output_dir, "maat.csv"), index_label="divide_id")
 
-        write_smp_input_files(catids, gdf_soil, smp_dir, args.models_option)
+        with tracing.span("write_sft_input_files", basin = basin.gpkg_file):
+            write_sft_input_files(catids, precip_partitioning_scheme, surface_runoff_scheme,
+                                  maat, gdf_soil, soil_class_NWM, sft_dir, archive)
+
+        with tracing.span("write_smp_input_files", basin = basin.gpkg_file):
+            write_smp_input_files(catids, gdf_soil, smp_dir, models_option, archive)
         
-    elif ("smp" in args.models_option):
-        if (args.verbosity >=3):
+    elif ("smp" in models):
+        if (verbosity >=3):
             print ("Generating config files for SMP...")
 
-        smp_dir = os.path.join(args.output_dir,"smp")
+        smp_dir = os.path.join(output_dir,"smp")
         create_directory(smp_dir)
 
-        write_smp_input_files(catids, gdf_soil, smp_dir, args.models_option)
+        with tracing.span("write_smp_input_files", basin = basin.gpkg_file):
+            write_smp_input_files(catids, gdf_soil, smp_dir, models_option, archive)
     
     
-    if "lasam" in args.models_option:
-        if (args.verbosity >=3):
+    if "lasam" in models:
+        if (verbosity >=3):
             print ("Generating config files for LASAM ...")
-        lasam_params = os.path.join(args.ngen_dir,"extern/LGAR-C/data/vG_default_params.dat")
-
-        if (not os.path.isfile(lasam_params)):
-            lasam_params = os.path.join(args.ngen_dir,"extern/LASAM/data/vG_default_params.dat")
-
-        lasam_dir = os.path.join(args.output_dir,"lasam")
+        lasam_dir = os.path.join(output_dir,"lasam")
         create_directory(lasam_dir)
     
-        str_sub ="cp -r "+ lasam_params + " %s"%lasam_dir
-        out=subprocess.call(str_sub,shell=True)
-
-        write_lasam_input_files(catids, os.path.join(lasam_dir, "vG_default_params.dat"),
-                                gdf_soil, lasam_dir, args.models_option)
-
-
-    if (args.troute):
-        write_troute_input_files(args.gpkg_file, args.routfile, args.output_dir, args.time,
-                                 sim_output_dir = args.sim_output_dir, is_calib = args.calib)
+        if (archive is not None):
+            with open(lasam_params, 'rb') as infile:
+                archive.add(os.path.join(lasam_dir, "vG_default_params.dat"), infile.read())
+        else:
+            str_sub ="cp -r "+ lasam_params + " %s"%lasam_dir
+            out=subprocess.call(str_sub,shell=True)
+
+        with tracing.span("write_lasam_input_files", basin = basin.gpkg_file):
+            write_lasam_input_files(catids, os.path.join(init_config_dir, "lasam", "vG_default_params.dat"),
+                                    gdf_soil, lasam_dir, models_option, archive)
+
+
+    if (archive is not None):
+        archive.close()
+
+    # record the inputs of the regenerated config files
+    if (manifest is not None and len(models) > 0):
+        if (is_config_archive):
+            # model directories hold no config files in bulk output mode
+            for m in model_inputs:
+                manifest.remove(m)
+            manifest.update("config_archive", dict(model_inputs, init_config_dir = init_config_dir))
+        else:
+            manifest.remove("config_archive")
+            for m in models:
+                manifest.update(m, model_inputs[m])
+
+    if (is_troute):
+        troute_inputs = {"gpkg" : file_stat(basin.gpkg_file), "routing_file" : file_hash(routing_file),
+                         "simulation_time" : simulation_time, "sim_output_dir" : sim_output_dir, "is_calib" : is_calib,
+                         "output_format" : troute_output_format}
+        troute_file = os.path.join(output_dir, "troute_config.yaml")
+
+        if (manifest is None or manifest.is_stale("troute", troute_inputs, outputs = [troute_file])):
+            with tracing.span("write_troute_input_files", basin = basin.gpkg_file):
+                write_troute_input_files(basin, routing_file, output_dir, simulation_time,
+                                         sim_output_dir = sim_output_dir, is_calib = is_calib,
+                                         output_format = troute_output_format)
+            if (manifest is not None):
+                manifest.update("troute", troute_inputs)
 
     #if (args.calib):
     #    real_file = os.path.join(args.json_dir, "realization_%s.json"%args.models_option)
@@ -1104,6 +1384,73 @@ def main():
     ## create uniform forcings
     #forcing_file = os.path.join(args.forcing_dir,"cat-base.csv")
     #write_forcing_files(catids, forcing_file)
+
+    return catids
+
+#############################################################################
+# main function (command line wrapper of write_config_files)
+# @param gpkg_file       : hydrofabric geopackage file (.gpkg)
+# @param forcing_dir     : forcing data directory containing data for each catchment
+# @param output_dir      : output directory (config files are written to subdirectories under this directory)
+# @param ngen_dir        : path to nextgen directory
+# @param models_option   : models coupling option (pre-defined names; see main.py)
+# @param runoff_schame   : surface runoff schemes - Options = Schaake or Xinanjiang (For CFE and SFT)
+# @param time            : dictionary containing simulations start and end time
+# @param overwrite       : boolean (if true, existing output directories are deleted or overwritten)
+#############################################################################
+def main():
+
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-gpkg", dest="gpkg_file",     type=str, required=True,  help="the gpkg file")
+        parser.add_argument("-f",    dest="forcing_dir",   type=str, required=True,  help="the forcing files directory")
+        parser.add_argument("-o",    dest="output_dir",    type=str, required=True,  help="the output files directory")
+        parser.add_argument("-ngen", dest="ngen_dir",      type=str, required=True,  help="the ngen directory")
+        parser.add_argument("-m",    dest="models_option", type=str, required=True,  help="option for models coupling")
+        parser.add_argument("-p",    dest="precip_partitioning_scheme", type=str, required=False,
+                            help="option for precip partitioning scheme", default="Schaake")
+        parser.add_argument("-r",    dest="surface_runoff_scheme", type=str, required=False,
+                            help="option for surface runoff scheme", default="GIUH")
+        parser.add_argument("-t",    dest="time",          type=json.loads, required=True,
+                            help="simulation start/end time") 
+        parser.add_argument("-ow",   dest="overwrite",     type=str, required=False, default=True,
+                            help="overwrite old/existing files")
+        parser.add_argument("-troute", dest="troute",     type=str, required=False, default=False, help="option for t-toure")
+        parser.add_argument("-routfile", dest="routfile", type=str, required=False, default=False, help="routing sample config file")
+        parser.add_argument("-v",      dest="verbosity",  type=int, required=False, default=False, help="verbosity option (0, 1, 2)")
+        parser.add_argument("-json",   dest="json_dir",   type=str, required=True,  help="realization files directory")
+        parser.add_argument("-sout",   dest="sim_output_dir",  type=str, required=True,  help="ngen runs output directory")
+        parser.add_argument("-c",      dest="calib",     type=str, required=False, default=False, help="option for calibration")
+        parser.add_argument("-schema", dest="schema",    type=str, required=False, default=False, help="gpkg schema type")
+    except:
+        parser.print_help()
+        sys.exit(1)
+    
+    args = parser.parse_args()
+    
+    if (not os.path.exists(args.gpkg_file)):
+        str_msg = 'The gpkg file does not exist! %s'%args.gpkg_file
+        sys.exit(str_msg)
+
+    # check if the forcing dir is under Inputs directory
+    if (not os.path.exists(args.forcing_dir)):
+        str_msg = 'The forcing directory does not exist! %s'%args.forcing_dir
+        sys.exit(str_msg)
+
+    write_config_files(gpkg_file      = args.gpkg_file,
+                       forcing_dir    = args.forcing_dir,
+                       output_dir     = args.output_dir,
+                       ngen_dir       = args.ngen_dir,
+                       models_option  = args.models_option,
+                       precip_partitioning_scheme = args.precip_partitioning_scheme,
+                       surface_runoff_scheme      = args.surface_runoff_scheme,
+                       simulation_time = args.time,
+                       verbosity       = args.verbosity,
+                       schema_type     = args.schema,
+                       is_troute       = args.troute,
+                       routing_file    = args.routfile,
+                       sim_output_dir  = args.sim_output_dir,
+                       is_calib        = args.calib)
     
 
 if __name__ == "__main__":
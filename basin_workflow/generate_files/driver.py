@@ -5,16 +5,23 @@
 ############################################################################################
 
 # driver of the script, generates configuration files and realization files by calling
-# the respective scripts
+# the respective modules in-process (configuration.py, realization.py and baseline.py)
 
 import os
 import sys
-import subprocess
 from pathlib import Path
 from typing import List, Union
+from dataclasses import dataclass
 import argparse
 import json
 
+try:
+    from generate_files import configuration, realization, baseline, tracing
+    from generate_files.manifest import Manifest, manifest_name, file_stat
+except:
+    import configuration, realization, baseline, tracing
+    from manifest import Manifest, manifest_name, file_stat
+
 coupled_models_options = {
     "C"   : "cfe",
     "L"   : "lasam",
@@ -40,6 +47,274 @@ class colors:
     BOLD    = '\033[1m'
     UNDERLINE = '\033[4m'
     
+
+#############################################################################
+# result of the config/realization files generation for a basin
+# @param gpkg_file        : basin geopackage file
+# @param coupled_models   : models coupling option used for the config files (e.g., nom_cfe_pet)
+# @param n_cats           : number of catchments (divides) in the basin
+# @param realization_file : realization file written for the basin (baseline realization for baseline cases)
+#############################################################################
+@dataclass
+class BasinResult:
+    gpkg_file        : str
+    coupled_models   : str
+    n_cats           : int
+    realization_file : str
+
+#############################################################################
+# module generates config files and the realization file of a basin in a single process
+# (replaces calling configuration.py, realization.py and baseline.py as scripts)
+# @param gpkg_file      : hydrofabric geopackage file (.gpkg)
+# @param forcing_dir    : forcing data directory (or file for netcdf forcing)
+# @param config_dir     : config files directory (config files are written to subdirectories under this directory)
+# @param json_dir       : realization files directory
+# @param sim_output_dir : ngen runs output directory
+# @param options        : dict of simulation options, same keys as the `simulations` block of config_workflow.yaml
+#                         (ngen_dir, model_option, simulation_time, precip_partitioning_scheme, surface_runoff_scheme,
+#                          is_netcdf_forcing, is_routing, is_calibration, verbosity, schema_type, config_archive,
+#                          config_archive_dir, incremental, troute_output_format, forcing_csv_to_netcdf, forcing_subset,
+#                          forcing_spinup_hours)
+#                         and `routing_file` (t-route sample config file)
+# - returns             : BasinResult
+# - raises              : ValueError for unsupported or invalid model options
+#############################################################################
+def generate_basin(gpkg_file, forcing_dir, config_dir, json_dir, sim_output_dir, options):
+
+    ngen_dir        = options["ngen_dir"]
+    models_option   = options["model_option"]
+    simulation_time = options["simulation_time"]
+    precip_partitioning_scheme = options.get("precip_partitioning_scheme", "Schaake")
+    surface_runoff_scheme      = options.get("surface_runoff_scheme", "GIUH")
+    is_netcdf_forcing = options.get("is_netcdf_forcing", True)
+    is_routing      = options.get("is_routing", False)
+    routing_file    = options.get("routing_file", "")
+    is_calibration  = options.get("is_calibration", False)
+    verbosity       = options.get("verbosity", 0)
+    schema_type     = options.get("schema_type", "noaa-owp")
+    is_config_archive  = options.get("config_archive", False)
+    config_archive_dir = options.get("config_archive_dir", "")
+    is_incremental  = options.get("incremental", False)
+    troute_output_format = options.get("troute_output_format", "csv")
+    is_forcing_csv_to_netcdf = options.get("forcing_csv_to_netcdf", False)
+    is_forcing_subset    = options.get("forcing_subset", False)
+    forcing_spinup_hours = options.get("forcing_spinup_hours", 0)
+
+    if (isinstance(simulation_time, str)):
+        simulation_time = json.loads(simulation_time)
+
+    # not all model coupling options are support yet, throw an error if un-supported options are provided
+    if (models_option in ["C","L","B"]):
+        str_model = "Option under development: "+ str(coupled_models_options[models_option])
+        raise ValueError(str_model)
+
+    # check if the model option provided is valid and supported
+    if (models_option not in coupled_models_options):
+        str_msg = "*** Invalid model option provided: (%s) ***"%models_option
+        raise ValueError(str_msg)
+
+    coupled_models = coupled_models_options[models_option]
+
+    # Note: for baseline simulations, models coupling is still either NCSS or NLSS,
+    #       only realization file changes to add jinjaBMI, more output vars etc.
+    baseline_case = False
+    if ( 'baseline_cfe' == coupled_models_options[models_option]):
+        baseline_case = True
+        coupled_models = coupled_models_options["NCSS"]
+    elif ( 'baseline_lasam' == coupled_models_options[models_option]):
+        baseline_case = True
+        coupled_models = coupled_models_options["NLSS"]
+
+    if (verbosity >=3):
+        print ("*******************************************")
+        print (colors.BLUE)
+        print ("Model option provided: ", models_option)
+        print ("Generating configuration files for model(s) option: ", coupled_models_options[models_option])
+        print (colors.ENDC)
+        print ("*******************************************")
+
+    # geopackage layers are read once and shared by all config writers
+    basin = configuration.BasinGeopackage(gpkg_file)
+
+    # incremental mode, only files whose inputs changed since the last run are regenerated (see manifest.py)
+    manifest = None
+    if (is_incremental):
+        manifest = Manifest(os.path.join(config_dir, manifest_name))
+
+    # realization.py and t-route config expect these options as strings (as passed on the command line)
+    catids = configuration.write_config_files(gpkg_file      = basin,
+                                              forcing_dir    = forcing_dir,
+                                              output_dir     = config_dir,
+                                              ngen_dir       = ngen_dir,
+                                              models_option  = coupled_models,
+                                              precip_partitioning_scheme = precip_partitioning_scheme,
+                                              surface_runoff_scheme      = surface_runoff_scheme,
+                                              simulation_time = simulation_time,
+                                              verbosity       = verbosity,
+                                              schema_type     = schema_type,
+                                              is_troute       = is_routing,
+                                              routing_file    = routing_file,
+                                              sim_output_dir  = sim_output_dir,
+                                              is_calib        = str(is_calibration),
+                                              troute_output_format = troute_output_format,
+                                              is_config_archive = is_config_archive,
+                                              init_config_dir   = config_archive_dir,
+                                              manifest          = manifest)
+
+    # csv forcing is packed into one NetCDF file, the realization then uses the NetCDF provider
+    realization_forcing = forcing_dir
+    if (is_forcing_csv_to_netcdf and not is_netcdf_forcing and os.path.isdir(forcing_dir)):
+        with tracing.span("write_forcing_netcdf", basin = gpkg_file):
+            realization_forcing = write_forcing_netcdf(forcing_dir, config_dir, manifest, verbosity)
+        is_netcdf_forcing = True
+
+    # the realization points to the subset of the NetCDF forcing covering the simulation window (plus spin-up)
+    if (is_forcing_subset and is_netcdf_forcing and os.path.isfile(realization_forcing)):
+        with tracing.span("write_forcing_subset", basin = gpkg_file):
+            realization_forcing = write_forcing_subset(realization_forcing, config_dir, simulation_time,
+                                                       forcing_spinup_hours, manifest, verbosity)
+
+    realization_file = os.path.join(json_dir, "realization_%s.json"%coupled_models)
+    baseline_file    = os.path.join(json_dir, "realization_%s_baseline.json"%coupled_models)
+
+    # inputs the realization file depends on (other workflow options, e.g. clean, num_processors_*, are not relevant)
+    realization_inputs = {"ngen_dir" : ngen_dir, "model_option" : models_option, "simulation_time" : simulation_time,
+                          "precip_partitioning_scheme" : precip_partitioning_scheme,
+                          "surface_runoff_scheme" : surface_runoff_scheme, "is_netcdf_forcing" : is_netcdf_forcing,
+                          "is_routing" : is_routing, "is_calibration" : is_calibration,
+                          "config_archive" : is_config_archive, "config_archive_dir" : config_archive_dir,
+                          "forcing_dir" : realization_forcing, "config_dir" : config_dir,
+                          "sim_output_dir" : sim_output_dir}
+    realization_files = [realization_file, baseline_file] if baseline_case else [realization_file]
+
+    if (manifest is None or manifest.is_stale("realization", realization_inputs, outputs = realization_files)):
+        with tracing.span("write_realization_files", basin = gpkg_file):
+            write_realization_files(ngen_dir, realization_forcing, config_dir, json_dir, sim_output_dir, coupled_models,
+                                    surface_runoff_scheme, precip_partitioning_scheme, simulation_time, baseline_case,
+                                    is_netcdf_forcing, is_routing, is_calibration, verbosity,
+                                    config_archive_dir if is_config_archive else None)
+        if (manifest is not None):
+            manifest.update("realization", realization_inputs)
+    elif (verbosity >=3):
+        print ("Realization file is up to date, skipping ...")
+
+    if (baseline_case):
+        realization_file = baseline_file
+
+    # number of catchments is kept in the manifest to avoid reading the geopackage for up-to-date basins
+    n_cats_inputs = {"gpkg" : file_stat(gpkg_file)}
+    if (manifest is None or manifest.is_stale("n_cats", n_cats_inputs)):
+        n_cats = basin.n_cats
+        if (manifest is not None):
+            manifest.update("n_cats", n_cats_inputs, value = n_cats)
+    else:
+        n_cats = manifest.get_value("n_cats")
+
+    if (manifest is not None):
+        manifest.save()
+
+    return BasinResult(gpkg_file        = gpkg_file,
+                       coupled_models   = coupled_models,
+                       n_cats           = n_cats,
+                       realization_file = realization_file)
+
+#############################################################################
+# packs the csv forcing files of a basin into one NetCDF file in the basin data directory
+# (data/forcing/forcing_csv.nc), see netcdf_forcing.py
+# - returns : NetCDF forcing file
+#############################################################################
+def write_forcing_netcdf(forcing_dir, config_dir, manifest, verbosity):
+
+    basin_dir = os.path.dirname(os.path.normpath(config_dir))
+    nc_file   = os.path.join(basin_dir, "data", "forcing", "forcing_csv.nc")
+
+    try:
+        from generate_files import netcdf_forcing
+    except:
+        import netcdf_forcing
+
+    # csv files are tracked by their stats (the directory stat does not change when files are rewritten)
+    csv_files = netcdf_forcing.get_csv_forcing_files(forcing_dir)
+    nc_inputs = {"forcing_dir" : forcing_dir,
+                 "forcing" : [file_stat(f) for f in csv_files.values()]}
+
+    if (manifest is None or manifest.is_stale("forcing_netcdf", nc_inputs, outputs = [nc_file])):
+        ncats = netcdf_forcing.csv_to_netcdf(forcing_dir, nc_file)
+        if (manifest is not None):
+            manifest.update("forcing_netcdf", nc_inputs)
+        if (verbosity >=2):
+            print (f"Forcing csv files of {ncats} catchments packed into: {nc_file}")
+
+    return nc_file
+
+#############################################################################
+# writes the subset of the basin NetCDF forcing file covering the simulation window (plus spin-up) to
+# the basin data directory (data/forcing/{forcing_name}_subset.nc), see netcdf_forcing.py
+# - returns : subset file
+#############################################################################
+def write_forcing_subset(forcing_file, config_dir, simulation_time, spinup_hours, manifest, verbosity):
+
+    basin_dir   = os.path.dirname(os.path.normpath(config_dir))
+    subset_file = os.path.join(basin_dir, "data", "forcing", Path(forcing_file).stem + "_subset.nc")
+
+    subset_inputs = {"forcing" : file_stat(forcing_file), "simulation_time" : simulation_time,
+                     "spinup_hours" : spinup_hours}
+
+    if (manifest is None or manifest.is_stale("forcing_subset", subset_inputs, outputs = [subset_file])):
+        try:
+            from generate_files import netcdf_forcing
+        except:
+            import netcdf_forcing
+
+        nsteps = netcdf_forcing.subset_forcing_file(forcing_file, subset_file, simulation_time['start_time'],
+                                                    simulation_time['end_time'], spinup_hours)
+        if (manifest is not None):
+            manifest.update("forcing_subset", subset_inputs)
+        if (verbosity >=2):
+            print (f"Forcing subset ({nsteps} time steps): {subset_file}")
+
+    return subset_file
+
+#############################################################################
+# module writes the realization file of a basin (and the baseline realization file for baseline cases)
+#############################################################################
+def write_realization_files(ngen_dir, forcing_dir, config_dir, json_dir, sim_output_dir, coupled_models,
+                            surface_runoff_scheme, precip_partitioning_scheme, simulation_time, baseline_case,
+                            is_netcdf_forcing, is_routing, is_calibration, verbosity, init_config_dir):
+
+    if (verbosity >=3):
+        print ("*******************************************")
+        print (colors.GREEN)
+        print ("Generating realization file ...")
+        print (colors.ENDC)
+
+    realization_file = os.path.join(json_dir, "realization_%s.json"%coupled_models)
+
+    realization.write_realization_file(ngen_dir          = ngen_dir,
+                                       forcing_dir       = forcing_dir,
+                                       config_dir        = config_dir,
+                                       realization_file  = realization_file,
+                                       coupled_models    = coupled_models,
+                                       runoff_scheme     = surface_runoff_scheme,
+                                       precip_partitioning_scheme = precip_partitioning_scheme,
+                                       simulation_time   = simulation_time,
+                                       baseline_case     = baseline_case,
+                                       is_netcdf_forcing = str(is_netcdf_forcing),
+                                       is_troute         = str(is_routing),
+                                       verbosity         = verbosity,
+                                       sim_output_dir    = sim_output_dir,
+                                       is_calib          = str(is_calibration),
+                                       init_config_dir   = init_config_dir)
+
+    if (baseline_case):
+        if (verbosity >=3):
+            print (colors.BLUE)
+            print ("Generating baseline realization file ...")
+            print (colors.ENDC)
+
+        baseline.main(realization_file, os.path.join(json_dir, "realization_%s_baseline.json"%coupled_models),
+                      config_dir, coupled_models)
+
 def main():
 
     try:
@@ -62,6 +337,8 @@ def main():
         parser.add_argument("-c",      dest="calib",     type=str, required=False, default=False, help="option for calibration")
         parser.add_argument("-sout",   dest="sim_output_dir",  type=str, required=True,  help="ngen runs output directory")
         parser.add_argument("-schema", dest="schema",    type=str, required=False, default=False, help="gpkg schema type")
+        parser.add_argument("-inc",    dest="incremental", type=str, required=False, default=False,
+                            help="regenerate only files whose inputs changed")
         args = parser.parse_args()
     except:
         parser.print_help()
@@ -79,106 +356,36 @@ def main():
     if (not os.path.exists(args.config_dir)):
         sys.exit("config dir does not exist, create one!")
 
-    # not all model coupling options are support yet, throw an error if un-supported options are provided
-    if (args.models_option in ["C","L","B"]):
-        str_model = "Option under development: "+ str(coupled_models_options[args.models_option])+ ", quitting..."
-        sys.exit(str_model)
-
-    # check if the model option provided is valid and supported
-    try:
-        coupled_models = coupled_models_options[args.models_option]
-    except:
-        parser.print_help()
-        str_msg = "*** Invalid model option provided: (%s) ***"%args.models_option
-        sys.exit(str_msg)
+    # command line options are strings, convert the boolean ones back
+    str_true = ["True", "true", "TRUE", "Yes", "yes",  "YES"]
 
-    path_crf = os.path.dirname(sys.argv[0])
+    options = {
+        "ngen_dir"                   : args.ngen_dir,
+        "model_option"               : args.models_option,
+        "simulation_time"            : args.time,
+        "precip_partitioning_scheme" : args.precip_partitioning_scheme,
+        "surface_runoff_scheme"      : args.surface_runoff_scheme,
+        "is_netcdf_forcing"          : str(args.netcdf) in str_true,
+        "is_routing"                 : str(args.troute) in str_true,
+        "routing_file"               : args.routfile,
+        "is_calibration"             : str(args.calib) in str_true,
+        "verbosity"                  : args.verbosity,
+        "schema_type"                : args.schema,
+        "incremental"                : str(args.incremental) in str_true
+    }
 
-    # Note: for baseline simulations, models coupling is still either NCSS or NLSS,
-    #       only realization file changes to add jinjaBMI, more output vars etc.
-    baseline_case = False
-    if ( 'baseline_cfe' == coupled_models_options[args.models_option]):
-        baseline_case = True
-        coupled_models = coupled_models_options["NCSS"]
-    elif ( 'baseline_lasam' == coupled_models_options[args.models_option]):
-        baseline_case = True
-        coupled_models = coupled_models_options["NLSS"]
-
-    
-    path_crf_gen_files = os.path.join(path_crf,"configuration.py")
-
-    generate_config_files = f'python {path_crf_gen_files} -gpkg {args.gpkg_file} -ngen {args.ngen_dir} \
-                              -f {args.forcing_dir} -o {args.config_dir} -m {coupled_models} \
-                              -p {args.precip_partitioning_scheme} -r {args.surface_runoff_scheme} \
-                              -troute {args.troute} -routfile {args.routfile} \
-                              -t \'{args.time}\' -v {args.verbosity} \
-                              -json {args.json_dir} \
-                              -sout {args.sim_output_dir} \
-                              -c {args.calib} \
-                              -schema {args.schema}'
-
-    if (args.verbosity >=3):
-        print ("*******************************************")
-        print (colors.BLUE)
-        print ("Running (from driver.py):\n", generate_config_files)
-        print ("Model option provided: ", args.models_option)
-        print ("Generating configuration files for model(s) option: ", coupled_models_options[args.models_option])
-        print (colors.ENDC)
-        print ("*******************************************")
-    
-
-    # the following call will generate config files
-    result = subprocess.call(generate_config_files,shell=True)
-
-    # if the results is FALSE, something went wrong while generating config files, so throw an error
-    if (result):
-        sys.exit("config files could not be generated, check the options provided!")
-
-    if (args.verbosity >=3):
-        print ("*******************************************")
-        print (colors.GREEN)
-        print ("Generating realization file ...")
-
-    path_crf_real_file = os.path.join(path_crf,"realization.py")
-
-    generate_realization_file = f'python {path_crf_real_file} -ngen {args.ngen_dir} -f {args.forcing_dir} \
-                                  -i {args.config_dir} -m {coupled_models} -p {args.precip_partitioning_scheme} \
-                                  -b {baseline_case} -r {args.surface_runoff_scheme} -t \'{args.time}\' \
-                                  -netcdf {args.netcdf} -troute {args.troute} -json {args.json_dir} \
-                                  -v {args.verbosity} -sout {args.sim_output_dir} \
-                                  -c {args.calib}'
-
-    if (args.verbosity >=3):
-        print ("Running (from driver.py): \n ", generate_realization_file)
-        print (colors.ENDC)
-    
-    result = subprocess.call(generate_realization_file,shell=True)
+    try:
+        result = generate_basin(gpkg_file      = args.gpkg_file,
+                                forcing_dir    = args.forcing_dir,
+                                config_dir     = args.config_dir,
+                                json_dir       = args.json_dir,
+                                sim_output_dir = args.sim_output_dir,
+                                options        = options)
+    except ValueError as e:
+        sys.exit(str(e) + ", quitting...")
 
-    if (result):
-        sys.exit("realization file could not be generated, check the options provided!")
-        
+    if (result.realization_file.endswith("_baseline.json")):
+        print ("************* DONE (Baseline realization file successfully generated!) ************** ")
 
-    if (baseline_case):
-        infile = os.path.join(os.getcwd(), "realization_%s.json"%coupled_models)
-        outfile = os.path.join(os.getcwd(), "realization_%s_baseline.json"%coupled_models)
-        
-        path_crf_baseline_file = os.path.join(path_crf,"baseline.py")
-        
-        convert_to_baseline = f'python {path_crf_baseline_file} -i {infile} -idir {args.config_dir} -o {outfile} -m {coupled_models}'
-
-        if (args.verbosity >=3):
-            print (colors.BLUE)
-            print ("Generating baseline realization file ...")
-            print ("Running (from driver.py):\n ", convert_to_baseline)
-            print (colors.ENDC)
-        
-        result = subprocess.call(convert_to_baseline,shell=True)
-
-        if (result):
-            sys.exit("realization file could not be generated, check the options provided!")
-        else:
-            print ("************* DONE (Baseline realization file successfully generated!) ************** ")
-        
 if __name__ == "__main__":
     main()
-
@@ -1,17 +1,26 @@
 import os, sys
 import pandas as pd
-import subprocess
 import glob
 import yaml
 import platform
 #from generate_files import configuration
 import configuration
+import aorc
+import tracing
 import json
 from pathlib import Path
 import multiprocessing
 from functools import partial # used for partially applied function which allows to create new functions with arguments
 import time
 
+# forcing_multibasin         : boolean | True to generate AORC forcing of all basins together (see aorc.py), chunks needed by
+#                                        several basins are fetched once into forcing_cache_dir and the cells x divides
+#                                        weights are persisted per geopackage (data/{gpkg_name}_aorc_weights.npz)
+#                                        False runs forcing_prep per basin (extern/CIROH_DL_NextGen submodule, own venv),
+#                                        which computes its own weights (its intermediate files are reused with redo: false)
+# forcing_cache_dir          : string  | AORC chunk cache directory (default output_dir/aorc_cache)
+# num_processors_forcing     : int     | Number of processors for forcing data generation
+
 infile  = sys.argv[1]
 with open(infile, 'r') as file:
     d = yaml.safe_load(file)
@@ -24,20 +33,25 @@ is_netcdf_forcing   = dsim.get('is_netcdf_forcing', True)
 verbosity           = dsim.get('verbosity', 0)
 forcing_venv_dir    = dsim.get('forcing_venv_dir', "~/venv_forcing")
 #forcing_venv_dir   = "/home/ec2-user/venv_forcing"
-num_processors_forcing  = 1
+num_processors_forcing  = dsim.get('num_processors_forcing', 1)
+forcing_multibasin  = dsim.get('forcing_multibasin', False)
+forcing_cache_dir   = dsim.get('forcing_cache_dir', os.path.join(output_dir, "aorc_cache"))
 
-def forcing_generate_catchment(dir):
+forcing_basefile = os.path.join(workflow_dir, "configs/config_aorc.yaml")
 
-    os.chdir(dir)
-    infile = os.path.join(workflow_dir, "configs/config_aorc.yaml")
+tracing.init(dsim.get('trace_file', ""))
+
+# per-basin forcing_prep run; weights are computed inside forcing_prep (submodule), the persisted sparse
+# weights of aorc.py are used by the multi-basin path only
+def forcing_generate_catchment(dir):
 
     if (os.path.exists(os.path.join(dir,"data"))):
         gpkg_file = glob.glob(dir + "data/*.gpkg")[0]
     else:
         return
-    
+
     config_dir = os.path.join(dir,"configs")
-    forcing_config = configuration.write_forcing_input_files(forcing_basefile = infile,
+    forcing_config = configuration.write_forcing_input_files(forcing_basefile = forcing_basefile,
                                                              gpkg_file = gpkg_file,
                                                              time = simulation_time)
 
@@ -51,47 +65,107 @@ def forcing_generate_catchment(dir):
 
     env = os.environ.copy()
     env['PATH'] = f"{venv_bin}:{env['PATH']}"
-    result = subprocess.call(run_cmd, shell=True, env = env)
+    result = tracing.call(run_cmd, Path(dir).name, cat = "basin", env = env, cwd = dir)
 
-    
-def forcing(nproc = 1):
+    return result
 
+def forcing(nproc = 1):
 
-    if (not os.path.exists(infile)):
-        sys.exit("Sample forcing yaml file does not exist, provided is " + infile)
+    if (not os.path.exists(forcing_basefile)):
+        sys.exit("Sample forcing yaml file does not exist, provided is " + forcing_basefile)
 
     # create a pool of processors using multiprocessing tool
-    pool = multiprocessing.Pool(processes=nproc)
-    
+    with multiprocessing.Pool(processes=nproc) as pool:
+        results = pool.map(forcing_generate_catchment, gpkg_dirs)
+
+    nfailed = len([result for result in results if result not in [None, 0]])
+    print (f"Forcing generated for {len(results) - nfailed} basins, failed: {nfailed}")
+
+#############################################################################
+# AORC cells of a basin (worker function), returns None if the basin has no geopackage
+#############################################################################
+def get_basin_cells(dir, lat, lon):
+    gpkg_files = glob.glob(os.path.join(dir, "data/*.gpkg"))
+    if (len(gpkg_files) == 0):
+        return None
+    try:
+        return aorc.get_basin_cells(gpkg_files[0], lat, lon)
+    except Exception as e:
+        print (f"Forcing failed for {gpkg_files[0]}: {e}", flush = True)
+        return None
+
+def write_basin_forcing(cells, grids, start_yr, end_yr):
+    gpkg_name = Path(cells.gpkg_file).stem
+    out_file = os.path.join(os.path.dirname(cells.gpkg_file), "forcing", f"{start_yr}_to_{end_yr}",
+                            f"{gpkg_name}_{start_yr}_to_{end_yr}.nc")
+    try:
+        with tracing.span("write_basin_forcing", basin = cells.gpkg_file):
+            aorc.write_basin_forcing(cells, grids, forcing_cache_dir, out_file)
+    except Exception as e:
+        print (f"Forcing failed for {cells.gpkg_file}: {e}", flush = True)
+        return None
+    return out_file
+
+#############################################################################
+# multi-basin AORC forcing: basin cells -> union of chunks fetched once -> per-basin areal averages
+#############################################################################
+def forcing_multibasin_aorc(nproc = 1):
+
+    if (not os.path.exists(forcing_basefile)):
+        sys.exit("Sample forcing yaml file does not exist, provided is " + forcing_basefile)
+
+    with open(forcing_basefile, 'r') as file:
+        d_aorc = yaml.safe_load(file)
+
+    aorc_source  = d_aorc['aorc_source']
+    url_template = d_aorc['aorc_year_url_template']
+    x_lon_dim    = d_aorc.get('x_lon_dim', "longitude")
+    y_lat_dim    = d_aorc.get('y_lat_dim', "latitude")
+
+    # same years as forcing_prep (whole years, see write_forcing_input_files)
+    time_sim = json.loads(simulation_time)
+    start_yr = pd.Timestamp(time_sim['start_time']).year
+    end_yr   = pd.Timestamp(time_sim['end_time']).year
+    if (start_yr <= end_yr):
+        end_yr = end_yr + 1
+
+    grids = [aorc.get_aorc_grid(aorc_source, url_template, year, x_lon_dim, y_lat_dim)
+             for year in range(start_yr, end_yr)]
+
+    start_time = time.time()
+
+    with multiprocessing.Pool(processes=nproc) as pool:
+        # all years share the same grid
+        with tracing.span("basin_cells", children = True):
+            partial_cells = partial(get_basin_cells, lat = grids[0].lat, lon = grids[0].lon)
+            basins_cells = [cells for cells in pool.map(partial_cells, gpkg_dirs) if cells is not None]
+
+        with tracing.span("fetch_chunks", files = forcing_cache_dir):
+            tasks = aorc.get_fetch_tasks(basins_cells, grids, aorc_source, url_template, forcing_cache_dir,
+                                         x_lon_dim, y_lat_dim)
+            nfetched = sum(pool.imap_unordered(aorc.fetch_chunk, tasks))
+
+        if (verbosity >= 1):
+            print (f"AORC chunks: {len(tasks)} needed by {len(basins_cells)} basins, {nfetched} variable chunks "
+                   f"fetched, in {round(time.time() - start_time, 2)} [sec]", flush = True)
+
+        partial_forcing = partial(write_basin_forcing, grids = grids, start_yr = start_yr, end_yr = end_yr)
+        results = []
+        for out_file in pool.imap_unordered(partial_forcing, basins_cells):
+            results.append(out_file)
+            if (verbosity >= 1 and out_file is not None):
+                print (f"Forcing file: {out_file}", flush = True)
+
+    nfailed = len([r for r in results if r is None])
+    print (f"Forcing generated for {len(results) - nfailed} basins, failed: {nfailed}, "
+           f"in {round(time.time() - start_time, 2)} [sec]")
 
-    #partial_generate_files_catchment = partial(generate_catchment_files, forcing_files=forcing_files)
-
-    # map catchments to each processor
-    #results = pool.map(partial_generate_files_catchment, gpkg_dirs)
-    results = pool.map(forcing_generate_catchment, gpkg_dirs)
-    results = [result for result in results if result is not None]
-
-    # collect results from all processes
-    for result in results:
-        basin_ids.extend(result[0])
-        num_cats.extend(result[1])
-
-    # Write results to CSV
-    #with open(basins_passed, 'w', newline='') as file:
-    #    dat = zip(basin_ids, num_cats)
-    #    writer = csv.writer(file)
-    #    writer.writerow(['basin_id', 'n_cats'])
-    #    writer.writerows(dat)
-
-    pool.close()
-    pool.join()
-    
-
-
-    #print (d)
 if __name__ == "__main__":
 
     all_dirs = glob.glob(output_dir + "/*/", recursive = True)
     gpkg_dirs = [g for g in all_dirs if "failed_cats" not in g] # remove the failed_cats directory
 
-    forcing(nproc = num_processors_forcing)
+    if (forcing_multibasin):
+        forcing_multibasin_aorc(nproc = num_processors_forcing)
+    else:
+        forcing(nproc = num_processors_forcing)
@@ -2,59 +2,62 @@ import os
 import shutil
 
 
+# removes a directory or a file
+def remove_path(path):
+    try:
+        shutil.rmtree(path)
+    except:
+        os.remove(path)
+
+# all paths are relative to output_dir (basin directory), the current working directory is not used
 def create_clean_dirs(output_dir,
                       setup_simulation = True,
                       rename_existing_simulation = "",
-                      clean = ["none"]):
+                      clean = ["none"],
+                      incremental = False):
 
     if (isinstance(rename_existing_simulation, str) and rename_existing_simulation != ""):
         subdirs  = os.listdir(output_dir)
-        os.mkdir(rename_existing_simulation)
+        os.mkdir(os.path.join(output_dir, rename_existing_simulation))
         for d in subdirs:
             if (d in ["configs", "json", "outputs"]):
-                shutil.move(d, rename_existing_simulation)
+                shutil.move(os.path.join(output_dir, d), os.path.join(output_dir, rename_existing_simulation))
+
+
+    # incremental mode keeps configs and json (configs/manifest.json decides what is regenerated), whatever
+    # the clean option
+    keep = ["data"] + (["configs", "json"] if incremental else [])
 
-    
     if (clean == ["all"]):
         subdirs  = os.listdir(output_dir)
         for d in subdirs:
-            if (d != "data"):
-                try:
-                    shutil.rmtree(d)
-                except:
-                    os.remove(d)
+            if (d not in keep):
+                remove_path(os.path.join(output_dir, d))
     elif (clean == ["existing"]):
         subdirs  = os.listdir(output_dir)
         for d in subdirs:
-            if (d in ["configs", "json", "outputs"]):
-                try:
-                    shutil.rmtree(d)
-                except:
-                    os.remove(d)
+            if (d in ["configs", "json", "outputs"] and d not in keep):
+                remove_path(os.path.join(output_dir, d))
     elif (len(clean) >= 1 and clean != ["none"]):
         subdirs  = os.listdir(output_dir)
         for d in subdirs:
-            if (d in clean):
-                try:
-                    shutil.rmtree(d)
-                except:
-                    os.remove(d)
+            if (d in clean and d not in keep):
+                remove_path(os.path.join(output_dir, d))
 
     if (setup_simulation):
-        subdirs  = os.listdir(output_dir)
-        for d in subdirs:
-            if (d in ["configs", "json", "outputs"]):
-                try:
-                    shutil.rmtree(d)
-                except:
-                    os.remove(d)
-        
-        os.mkdir("configs")
-        os.mkdir("json")
-        os.makedirs("outputs/div")
-        os.makedirs("outputs/troute")
-        os.makedirs("outputs/troute_parq")
-    
-    if (os.path.isdir("dem")):
-        shutil.rmtree("dem")
-    
+        # incremental mode keeps existing files, the manifest (configs/manifest.json) decides what is regenerated
+        if (not incremental):
+            subdirs  = os.listdir(output_dir)
+            for d in subdirs:
+                if (d in ["configs", "json", "outputs"]):
+                    remove_path(os.path.join(output_dir, d))
+
+        os.makedirs(os.path.join(output_dir, "configs"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "json"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "outputs/div"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "outputs/troute"), exist_ok=True)
+        os.makedirs(os.path.join(output_dir, "outputs/troute_parq"), exist_ok=True)
+
+    if (os.path.isdir(os.path.join(output_dir, "dem"))):
+        shutil.rmtree(os.path.join(output_dir, "dem"))
+
@@ -22,6 +22,9 @@ import json
 from pathlib import Path
 
 import helper
+import driver
+import tracing
+import basin_jobs
 # Note #1: from the command line just run 'python path_to/main.py'
 # Note #2: make sure to adjust the following required arguments
 # Note #3: several model coupling options are available, the script currently supports a few of them, for full list see
@@ -48,6 +51,28 @@ import helper
 # num_processors_sim         : int     | Number of processors for catchment/geopackage partition for ngen parallel runs
 # setup_simulation           : boolean | True to create files for simulaiton;
 # rename_existing_simulation : string  | move the existing simulation set (json, configs, outputs dirs) to this directory, e.g. "sim_cfe1.0"
+# config_archive             : boolean | True to write per-catchment config files of all models to one archive (configs/configs.tar)
+# config_archive_dir         : string  | directory the archive is extracted to before ngen runs (e.g. node-local scratch),
+#                                        "{*}" is replaced by the basin directory name; default is the configs directory
+# incremental                : boolean | True to keep existing configs/json and regenerate only the files whose inputs
+#                                        changed since the last run (see configs/manifest.json of each basin); configs and json
+#                                        are not cleaned in this mode (clean applies to the other directories)
+# troute_output_format       : string  | t-route stream output format, csv (default) or parquet (outputs/troute_parq; in calibration
+#                                        only the eval_feature rows are read, see ngen_cal_troute_output_plugin.py)
+# trace_file                 : string  | JSON-lines trace of stage, basin and sub-step timings (wall/CPU time, peak RSS of stages/runs, RSS of basins/sub-steps, file counts)
+#                                        shared by all workflow steps, convert with generate_files/tracing.py for chrome://tracing
+# forcing_csv_to_netcdf      : boolean | True to pack csv forcing files (is_netcdf_forcing : False) into one NetCDF file per basin
+#                                        (data/forcing/forcing_csv.nc), the realization file then uses the NetCDF provider
+# forcing_subset             : boolean | True to write a NetCDF forcing subset covering only simulation_time (plus spin-up) per basin,
+#                                        the realization file points to the subset (data/forcing/*_subset.nc)
+# forcing_spinup_hours       : int     | hours of forcing kept before the simulation start time in the subset (default 0)
+# forcing_id_pattern         : string  | regular expression extracting the basin id from the forcing file names when all .nc files are
+#                                        in forcing_dir, e.g. "forcing_(?P<id>[0-9]+)" (default: the id is a token of the file name)
+# rescan_basins              : boolean | False to reuse the job manifest of the last run (output_dir/basins_manifest.json) instead of
+#                                        scanning output_dir for basins (default True)
+# shard                      : string  | "i/N" processes only shard i of N of the basins (e.g. array jobs; the BASIN_WORKFLOW_SHARD
+#                                        environment variable overrides it), results go to output_dir/jobs/shard_{i}_of_{N}.csv
+# resume                     : boolean | True skips the basins that passed in the previous run of the shard (see basin_jobs.py)
 
 ####################################################################################
 
@@ -107,7 +132,18 @@ is_calibration             = dsim.get('is_calibration', False)
 is_netcdf_forcing          = dsim.get('is_netcdf_forcing', True)
 forcing_source             = dsim.get('forcing_source', "")
 forcing_dir                = dsim.get('forcing_dir', "")
+forcing_id_pattern         = dsim.get('forcing_id_pattern', "")
 schema_type                = dsim.get('schema_type', "noaa-owp")
+config_archive             = dsim.get('config_archive', False)
+config_archive_dir         = dsim.get('config_archive_dir', "")
+incremental                = dsim.get('incremental', False)
+trace_file                 = dsim.get('trace_file', "")
+rescan_basins              = dsim.get('rescan_basins', True)
+shard                      = dsim.get('shard', "")
+resume                     = dsim.get('resume', False)
+
+# stage/basin/sub-step timings are appended to the trace file (see tracing.py)
+tracing.init(trace_file)
 
 def process_clean_input_param():
     clean_lst = []
@@ -119,24 +155,24 @@ def process_clean_input_param():
 
 clean = process_clean_input_param()
 
+# incremental mode needs the existing configs/json directories, they are not cleaned (see helper.create_clean_dirs)
+if (incremental and clean != ["none"]):
+    print (f"incremental : True, configs and json directories are kept (clean : {clean} applies to the other directories)")
+
 ##############################################################################
 
-def generate_catchment_files(dir, forcing_files):
-    
-    os.chdir(dir)
+def generate_catchment_files(job):
 
     basin_ids = []
     num_cats  = []
-    
+
+    dir = job["dir"]
+
     if (verbosity >=2):
         print ("dir: ", dir)
-        print ("cwd: ", os.getcwd())
 
-    if (os.path.exists(os.path.join(dir,"data"))):
-        gpkg_name = os.path.basename(glob.glob(dir + "/data/*.gpkg")[0])
-        gpkg_dir = f"data/{gpkg_name}"
-    else:
-        return
+    gpkg_dir  = job["gpkg_file"]
+    gpkg_name = os.path.basename(gpkg_dir)
 
     filled_dot = '●'
 
@@ -145,148 +181,94 @@ def generate_catchment_files(dir, forcing_files):
         if verbosity >=1:
             print(filled_dot, gpkg_name, end="")
 
-        last_underscore_index = gpkg_name.rfind('_')
-        dot_index = gpkg_name.rfind('.')
-        id = gpkg_name[last_underscore_index + 1:dot_index]
+        id = job["basin_id"]
 
         #id = int(gpkg_name[:-5].rsplit("_")[1])
 
-        if len(forcing_files) > 0:
-
-            forcing_file = [f for f in forcing_files if str(id) in f]
-            if len(forcing_file) == 1:
-                div_forcing_dir = forcing_file[0]
-            else:
-                if verbosity >=2:
-                    print(" Forcing file .nc does not exist for this gpkg, continuing to the next gpkg")
-                if verbosity >=1:
-                    print (colors.RED + "  Failed " + colors.END )
-                return
-        
-        elif (forcing_source == "Nels_forcing_prep"):
-            sim_time = json.loads(simulation_time)
-            start_yr = pd.Timestamp(sim_time['start_time']).year 
-            end_yr   = pd.Timestamp(sim_time['end_time']).year 
-
-            if (start_yr <= end_yr):
-                end_yr = end_yr + 1
-
-            if (is_netcdf_forcing):
-                name_without_ext = gpkg_name.split(".")[0]
-                div_forcing_dir = os.path.join(dir, f"data/forcing/{start_yr}_to_{end_yr}/{name_without_ext}_{start_yr}_to_{end_yr}.nc")
-            else:
-                div_forcing_dir = os.path.join(dir, f"data/forcing/{start_yr}_to_{end_yr}")
-                
-            if (not os.path.exists(div_forcing_dir)):
-                if verbosity >=2:
-                    print(f" Forcing file does not exist under {div_forcing_dir}, continuing to the next gpkg")
-                if verbosity >=1:
-                    print (colors.RED + "  Failed " + colors.END )
-                return
-        elif (forcing_source == "local"):
-            if is_netcdf_forcing:
-                try:
-                    div_forcing_dir = forcing_dir.replace("{*}", Path(dir).name)
-                    div_forcing_dir = glob.glob(f"{div_forcing_dir}/*.nc")[0]
-                except:
-                    if verbosity >=2:
-                        print(f" \nForcing file does not exist under {div_forcing_dir}, continuing to the next gpkg")
-                        if verbosity >=1:
-                            print (colors.RED + "  Failed " + colors.END )
-                    return
-            else:
-                div_forcing_dir = forcing_dir.replace("{*}", Path(dir).name)
-
-        assert os.path.exists(div_forcing_dir)
+        # forcing file (or csv forcing directory) resolved for all basins up front (see basin_jobs.ForcingResolver)
+        div_forcing_dir = job.get("forcing_file")
+        if (div_forcing_dir is None):
+            if verbosity >=2:
+                print(" Forcing file does not exist for this gpkg, continuing to the next gpkg")
+            if verbosity >=1:
+                print (colors.RED + "  Failed " + colors.END )
+            return
 
     config_dir = os.path.join(dir,"configs")
     json_dir   = os.path.join(dir, "json")
-    gpkg_dir   = os.path.join(dir, gpkg_dir)
     sim_output_dir = os.path.join(dir, "outputs")
     
     helper.create_clean_dirs(output_dir = dir, setup_simulation = setup_simulation,
-                             rename_existing_simulation = rename_existing_simulation, clean = clean)
+                             rename_existing_simulation = rename_existing_simulation, clean = clean,
+                             incremental = incremental)
 
     if (not setup_simulation):
         return
 
-    workflow_driver = os.path.join(workflow_dir, "generate_files/driver.py")
-
     routing_file = os.path.join(workflow_dir, "configs/samples/config_troute.yaml")
 
-    driver = f'python {workflow_driver} -gpkg {gpkg_dir} -ngen {ngen_dir} -f {div_forcing_dir} \
-    -o {config_dir} -m {model_option} -p {precip_partitioning_scheme} -r {surface_runoff_scheme} -t \'{simulation_time}\' \
-    -netcdf {is_netcdf_forcing} -troute {is_routing} -routfile {routing_file} -json {json_dir} -v {verbosity} \
-    -c {is_calibration} -sout {sim_output_dir} -schema {schema_type}'
-
-    failed = subprocess.call(driver, shell=True)
+    options = dict(dsim, routing_file = routing_file, schema_type = schema_type)
+
+    # directory the config archive is extracted to before the run (e.g. node-local scratch), same layout as configs
+    if (config_archive and config_archive_dir != ""):
+        options['config_archive_dir'] = config_archive_dir.replace("{*}", Path(dir).name)
+
+    # generate_basin raises ValueError for invalid options; the input checks of configuration.py/realization.py
+    # (e.g. missing sample files) still exit, a failed basin must not end the worker
+    failed = False
+    try:
+        basin  = driver.generate_basin(gpkg_file      = gpkg_dir,
+                                       forcing_dir    = div_forcing_dir,
+                                       config_dir     = config_dir,
+                                       json_dir       = json_dir,
+                                       sim_output_dir = sim_output_dir,
+                                       options        = options)
+    except (Exception, SystemExit) as e:
+        failed = True
+        if verbosity >=1:
+            print (colors.RED + f"  Failed ({e}) " + colors.END )
 
     if (not failed):
-        #id_full = str(gpkg_name[:-5].split("_")[1])
-        #basin_ids.append(str(id_full))
         basin_ids.append(id)
-        x = gpd.read_file(gpkg_dir, layer="divides")
-        num_cats.append(len(x["divide_id"]))
+        num_cats.append(basin.n_cats)
 
-    if verbosity >=1:
-        result = "Passed" if not failed else "Failed" 
-        print (colors.GREEN + "  %s "%result + colors.END )
+        if verbosity >=1:
+            print (colors.GREEN + "  Passed " + colors.END )
 
     return basin_ids, num_cats
 
 ############################### MAIN LOOP #######################################
 
-def main(nproc = 4):
-    
-    basins_passed = os.path.join(output_dir,"basins_passed.csv")
-    
-    if (os.path.exists(basins_passed)):
-        os.remove(basins_passed)
-
-    # check if all forcing files (.nc) are stored in one directory, read in serial
-    forcing_files = []
-    if (is_netcdf_forcing):
-        try:
-            nc_forcing_dir  = dsim['forcing_dir']
-            if (not os.path.exists(forcing_dir)):
-                sys.exit(f"Forcing directory does not exist. Provided: {forcing_dir}")
-
-            forcing_files = glob.glob(os.path.join(nc_forcing_dir, "*.nc"), recursive = True)
-            assert (len(forcing_files) > 0)
-        except:
-            pass
-                
-    basin_ids = []
-    num_cats  = []
-
-    # create a pool of processors using multiprocessing tool
-    pool = multiprocessing.Pool(processes=nproc)
-    
-    #print ("CPU:", multiprocessing.cpu_count())
-
-    partial_generate_files_catchment = partial(generate_catchment_files, forcing_files=forcing_files)
-
-    # map catchments to each processor
-    results = pool.map(partial_generate_files_catchment, gpkg_dirs)
-
-    results = [result for result in results if result is not None]
+# a failure in one basin (anything not handled by generate_catchment_files) does not stop the pool
+# - returns : (basin id, result of generate_catchment_files)
+def generate_catchment_files_safe(job):
+    dir = job["dir"]
+    try:
+        with tracing.span(Path(dir).name, cat = "basin", files = dir):
+            return job["basin_id"], generate_catchment_files(job)
+    except (Exception, SystemExit) as e:
+        if verbosity >=1:
+            print (colors.RED + f" {dir} Failed ({e})" + colors.END)
+        return job["basin_id"], None
 
-    # collect results from all processes
-    for result in results:
-        basin_ids.extend(result[0])
-        num_cats.extend(result[1])
+def main(jobs, status, shard_count, nproc = 4):
 
-    # Write results to CSV
-    with open(basins_passed, 'w', newline='') as file:
-        dat = zip(basin_ids, num_cats)
-        writer = csv.writer(file)
-        writer.writerow(['basin_id', 'n_cats'])
-        writer.writerows(dat)
+    npassed = 0
 
-    pool.close()
-    pool.join()
+    # results are written to the shard status file as basins complete, so finished basins are kept (and skipped
+    # with resume) if the run is interrupted
+    try:
+        # pool of persistent workers, each worker processes basins in-process (no subprocesses, no chdir)
+        with multiprocessing.Pool(processes=nproc) as pool:
+            for id, result in pool.imap_unordered(generate_catchment_files_safe, jobs):
+                passed = result is not None and len(result[1]) > 0
+                status.add(id, result[1][0] if passed else "", passed)
+                npassed += int(passed)
+    finally:
+        status.close()
+        basin_jobs.write_basins_passed(output_dir, shard_count)
 
-    return len(num_cats)
+    return npassed
 
 if __name__ == "__main__":
 
@@ -311,21 +293,29 @@ if __name__ == "__main__":
     if (not os.path.exists(os.path.join(workflow_dir, "generate_files"))):
         sys.exit("check `workflow_dir`, it should be the parent directory of `generate_files` directory")
 
-    all_dirs = glob.glob(os.path.join(output_dir, '*/'), recursive = True)
+    # basins of this shard from the job manifest (output_dir is scanned once, see basin_jobs.py)
+    shard_index, shard_count = basin_jobs.get_shard(shard)
+    forcing_resolver = basin_jobs.ForcingResolver(forcing_source, forcing_dir, is_netcdf_forcing, simulation_time,
+                                                  id_pattern = forcing_id_pattern)
+    jobs = basin_jobs.get_jobs(output_dir, forcing_resolver, rescan = rescan_basins,
+                               shard_index = shard_index, shard_count = shard_count)
+
+    status = basin_jobs.ShardStatus(output_dir, shard_index, shard_count, resume = resume)
+    nbasins = len(jobs)
+    jobs = [job for job in jobs if job["basin_id"] not in status.passed]
 
-    gpkg_dirs = [
-        g for g in all_dirs 
-        if os.path.exists(os.path.join(g, 'data')) and glob.glob(os.path.join(g, 'data', '*.gpkg'))
-    ]
+    if (shard_count > 1):
+        print (f"Shard {shard_index}/{shard_count}: {nbasins} basins, {nbasins - len(jobs)} already passed")
 
-    success_ncats = main(nproc = num_processors_config)
+    success_ncats = main(jobs, status, shard_count, nproc = num_processors_config)
 
     end_time = time.time()
     total_time = end_time - start_time # in seconds
 
     print ("================== SUMMARY ===============================")
     print("| Total time         = %s [sec], %s [min]" % (round(total_time,4), round(total_time/60.,4)))
-    print("| Total no of basins = %s "% len(gpkg_dirs))
+    print("| Total no of basins = %s "% nbasins)
+    print("| Skipped (passed)   = %s "% (nbasins-len(jobs)))
     print("| Succeeded          = %s "% success_ncats)
-    print("| Failed             = %s "% (len(gpkg_dirs)-success_ncats))
+    print("| Failed             = %s "% (len(jobs)-success_ncats))
     print ("==========================================================")
@@ -0,0 +1,90 @@
+"""
+Manifest of the generated files of a basin (configs/manifest.json), used for incremental regeneration
+ - each artifact (model config files, t-route config, realization file, ...) is stored with the hash of its inputs
+   (geopackage mtime/size, relevant config_workflow.yaml keys, SOILPARM.TBL, t-route sample yaml, ...)
+ - an artifact is regenerated only if the hash of its inputs changed
+"""
+
+import os
+import json
+import hashlib
+
+manifest_name = "manifest.json"
+
+#############################################################################
+# returns file/directory stats used as input of an artifact (cheap check for large files, e.g., geopackage)
+#############################################################################
+def file_stat(path):
+    if (not path or not os.path.exists(path)):
+        return None
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+
+#############################################################################
+# returns stats of a file, or of every file in a directory (a directory mtime does not change when the files
+# in it are rewritten, e.g. csv forcing files)
+#############################################################################
+def path_stat(path):
+    if (not path or not os.path.isdir(path)):
+        return file_stat(path)
+    with os.scandir(path) as entries:
+        files = sorted(e.path for e in entries if e.is_file())
+    return [file_stat(f) for f in files]
+
+#############################################################################
+# returns content hash of a (small) file used as input of an artifact (e.g., SOILPARM.TBL)
+#############################################################################
+def file_hash(path):
+    if (not path or not os.path.isfile(path)):
+        return None
+    with open(path, 'rb') as infile:
+        return hashlib.sha256(infile.read()).hexdigest()
+
+#############################################################################
+# returns hash of the inputs (dict) of an artifact
+#############################################################################
+def hash_inputs(inputs):
+    s = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(s.encode()).hexdigest()
+
+#############################################################################
+# class holds the manifest of a basin
+# @param manifest_file : manifest file (json), read if it exists
+#############################################################################
+class Manifest:
+
+    def __init__(self, manifest_file):
+        self.manifest_file = manifest_file
+        self.artifacts = {}
+
+        if (os.path.exists(manifest_file)):
+            try:
+                with open(manifest_file, 'r') as infile:
+                    self.artifacts = json.load(infile)
+            except:
+                self.artifacts = {}
+
+    # true if the artifact has not been generated yet, its inputs changed or any of its outputs (files/dirs) is missing
+    def is_stale(self, artifact, inputs, outputs = []):
+        if (artifact not in self.artifacts):
+            return True
+        if (not all(os.path.exists(f) for f in outputs)):
+            return True
+        return self.artifacts[artifact]["hash"] != hash_inputs(inputs)
+
+    # records the artifact inputs (and optionally a value, e.g. number of catchments)
+    def update(self, artifact, inputs, value = None):
+        self.artifacts[artifact] = {"hash": hash_inputs(inputs), "value": value}
+
+    def remove(self, artifact):
+        self.artifacts.pop(artifact, None)
+
+    def get_value(self, artifact):
+        return self.artifacts[artifact]["value"]
+
+    # written to a temporary file first, an interrupted run does not leave a truncated manifest
+    def save(self):
+        tmp_file = f"{self.manifest_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as outfile:
+            json.dump(self.artifacts, outfile, indent=4)
+        os.replace(tmp_file, self.manifest_file)
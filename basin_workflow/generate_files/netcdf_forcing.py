@@ -0,0 +1,167 @@
+"""
+NetCDF forcing utilities (ngen NetCDF forcing layout: dims (catchment-id, time), variables `ids` and
+`Time` [seconds since 1970-01-01] and one (catchment-id, time) variable per forcing field)
+ - subset_forcing_file: writes the simulation window (plus spin-up) of a basin forcing file, so ngen does
+   not open the whole-year files generated by forcing_prep for every run/calibration iteration; the subset
+   is chunked per catchment (1, ntime), matching ngen's per-catchment reads
+ - csv_to_netcdf: packs per-catchment csv forcing files (CsvPerFeature layout, {cat_id}*.csv) into one
+   catchment-major NetCDF file (float32), reading/writing a batch of catchments at a time (bounded memory)
+"""
+
+import os, sys
+import re
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+import xarray as xr
+import netCDF4
+
+epoch = pd.Timestamp("1970-01-01 00:00:00")
+
+#############################################################################
+# returns the times (DatetimeIndex) of a forcing dataset opened with decode_times=False
+#############################################################################
+def get_forcing_times(ds):
+    values = ds['Time'].values
+    if (values.ndim == 2):
+        values = values[0]
+
+    units = ds['Time'].attrs.get('units', "s")
+    if ("since" in units):
+        # e.g. "seconds since 1970-01-01 00:00:00"
+        step, reference = units.split(" since ")
+        return pd.Timestamp(reference) + pd.to_timedelta(values, unit=step.strip()[0].lower())
+
+    return epoch + pd.to_timedelta(values, unit='s')
+
+#############################################################################
+# writes the subset of a basin NetCDF forcing file covering the simulation window plus spin-up
+# @param forcing_file : basin NetCDF forcing file
+# @param out_file     : subset file
+# @param start_time   : simulation start time
+# @param end_time     : simulation end time
+# @param spinup_hours : hours of forcing kept before start_time (spin-up)
+# - returns           : number of time steps in the subset
+#############################################################################
+def subset_forcing_file(forcing_file, out_file, start_time, end_time, spinup_hours = 0):
+
+    start_time = pd.Timestamp(start_time) - pd.Timedelta(hours=spinup_hours)
+    end_time   = pd.Timestamp(end_time)
+
+    with xr.open_dataset(forcing_file, decode_times=False, decode_timedelta=False) as ds:
+        times = get_forcing_times(ds)
+        steps = np.where((times >= start_time) & (times <= end_time))[0]
+
+        if (len(steps) == 0):
+            raise ValueError(f"Forcing file {forcing_file} does not cover the simulation time "
+                             f"({start_time} to {end_time})")
+
+        time_dim = ds['Time'].dims[-1]
+        ds_sub = ds.isel({time_dim : slice(steps[0], steps[-1] + 1)}).load()
+
+    # contiguous chunk per catchment (ngen reads the time series of one catchment at a time)
+    encoding = {}
+    for var in ds_sub.data_vars:
+        if (ds_sub[var].dims == ds_sub['Time'].dims):
+            encoding[var] = {"chunksizes" : (1, ds_sub.sizes[time_dim]), "zlib" : False}
+
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+    ds_sub.to_netcdf(tmp_file, encoding=encoding)
+    os.replace(tmp_file, out_file)
+
+    return len(steps)
+
+#############################################################################
+# returns the per-catchment csv forcing files of a directory as {cat_id : file}
+#############################################################################
+def get_csv_forcing_files(forcing_dir):
+    files = {}
+    for csv_file in sorted(glob.glob(os.path.join(forcing_dir, "*.csv"))):
+        match = re.search(r"cat-\d+", os.path.basename(csv_file))
+        if (match is not None):
+            files[match.group(0)] = csv_file
+    return files
+
+# returns times of a csv forcing file as seconds since 1970-01-01
+def get_csv_times(time):
+    if (pd.api.types.is_numeric_dtype(time)):
+        return time.to_numpy(dtype=np.float64)
+    return ((pd.to_datetime(time) - epoch) / pd.Timedelta(seconds=1)).to_numpy(dtype=np.float64)
+
+#############################################################################
+# converts per-catchment csv forcing files to one NetCDF file (ngen NetCDF forcing layout)
+# @param forcing_dir : directory of the csv forcing files (one file per catchment)
+# @param out_file    : NetCDF forcing file
+# @param batch_size  : number of catchments read and written at a time
+# - returns          : number of catchments converted
+#############################################################################
+def csv_to_netcdf(forcing_dir, out_file, batch_size = 500):
+
+    csv_files = get_csv_forcing_files(forcing_dir)
+    if (len(csv_files) == 0):
+        raise ValueError(f"No csv forcing files found in {forcing_dir}")
+
+    cat_ids = list(csv_files.keys())
+
+    # all catchments share the time steps and variables of the first file
+    df = pd.read_csv(csv_files[cat_ids[0]])
+    time_col  = df.columns[0]
+    variables = [v for v in df.columns[1:]]
+    times     = get_csv_times(df[time_col])
+    ntimes    = len(times)
+
+    os.makedirs(os.path.dirname(os.path.abspath(out_file)), exist_ok=True)
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+
+    with netCDF4.Dataset(tmp_file, "w", format="NETCDF4") as ds:
+        ds.createDimension("catchment-id", len(cat_ids))
+        ds.createDimension("time", ntimes)
+
+        ids = ds.createVariable("ids", str, ("catchment-id",))
+        ids[:] = np.asarray(cat_ids, dtype=object)
+
+        # catchment-major chunks, the time series of a catchment is stored contiguously
+        chunks = (1, ntimes)
+        time_var = ds.createVariable("Time", "f8", ("catchment-id", "time"), chunksizes=chunks)
+        time_var.units = "s"
+        time_var.epoch_start = "01/01/1970 00:00:00"
+
+        nc_vars = {v : ds.createVariable(v, "f4", ("catchment-id", "time"), chunksizes=chunks)
+                   for v in variables}
+
+        for start in range(0, len(cat_ids), batch_size):
+            batch = cat_ids[start : start + batch_size]
+            values = np.empty((len(variables), len(batch), ntimes), dtype=np.float32)
+
+            for i, cat_id in enumerate(batch):
+                df = pd.read_csv(csv_files[cat_id], usecols=variables, dtype=np.float32)
+                if (len(df) != ntimes):
+                    raise ValueError(f"{csv_files[cat_id]} has {len(df)} time steps, expected {ntimes}")
+                values[:, i, :] = df[variables].to_numpy().T
+
+            end = start + len(batch)
+            time_var[start:end, :] = np.broadcast_to(times, (len(batch), ntimes))
+            for k, v in enumerate(variables):
+                nc_vars[v][start:end, :] = values[k]
+
+    os.replace(tmp_file, out_file)
+
+    return len(cat_ids)
+
+if __name__ == "__main__":
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("-f",  dest="forcing_dir", type=str, required=True, help="csv forcing files directory")
+        parser.add_argument("-o",  dest="out_file",    type=str, required=True, help="output NetCDF forcing file")
+        parser.add_argument("-b",  dest="batch_size",  type=int, required=False, default=500,
+                            help="number of catchments converted at a time")
+    except:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+
+    ncats = csv_to_netcdf(args.forcing_dir, args.out_file, args.batch_size)
+    print (f"Converted {ncats} catchments: {args.out_file}")
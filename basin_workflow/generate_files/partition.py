@@ -0,0 +1,221 @@
+"""
+Cost model for sizing ngen MPI partitions of a basin (used by runner.py when num_processors_adaptive is True)
+ - runtime(p) = startup_time + ncats * nsteps * step_cost / p + rank_overhead * (p - 1)
+ - startup_time, step_cost (seconds per catchment per time step) and rank_overhead depend on the coupled models
+   and the machine, all three are fitted (least squares) from past runtimes (runtimes file written by runner.py;
+   calibration runs are recorded per iteration), preferring the runs of the same basin over the runs of other
+   basins with the same model option
+ - the fit needs runs at two or more core counts (and runs that determine all three terms); until such runtimes
+   are recorded, or if the fit is not physical (negative terms), there is no cost model and runner.py falls back
+   to the nproc heuristic (min(ncats/nproc, 20))
+ - the partition count is the smallest one within `tolerance` of the minimum predicted runtime
+Cache of partitionGenerator outputs
+ - partition files depend only on the geopackage and the number of ranks, they are cached as
+   {cache_dir}/{gpkg sha256}_{nproc}.json and validated before reuse (one file per entry, written atomically)
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import platform
+import pandas as pd
+import numpy as np
+
+runtimes_columns = ["basin_id", "model_option", "n_cats", "n_steps", "cores", "runtime_sec"]
+
+#############################################################################
+# returns number of (hourly) time steps of the simulation
+# @param simulation_time : dictionary containing simulations start and end time
+#############################################################################
+def get_num_steps(simulation_time):
+    start_time = pd.Timestamp(simulation_time['start_time'])
+    end_time   = pd.Timestamp(simulation_time['end_time'])
+    return max(int((end_time - start_time) / pd.Timedelta(hours=1)), 1)
+
+#############################################################################
+# returns predicted runtime [sec] of a basin on nproc ranks
+# @param cost : (startup_time [sec], step_cost [sec], rank_overhead [sec]), see fit_cost_model
+#############################################################################
+def predict_runtime(ncats, nsteps, nproc, cost):
+    startup_time, step_cost, rank_overhead = cost
+    nproc = np.asarray(nproc)
+    return startup_time + ncats * nsteps * step_cost / nproc + rank_overhead * (nproc - 1)
+
+#############################################################################
+# returns (startup_time, step_cost, rank_overhead) fitted by least squares to the runtimes of the given runs,
+# None if the runs do not determine all three terms or the fit is not physical
+#############################################################################
+def fit_runtimes(df):
+
+    if (df['cores'].nunique() < 2):
+        return None
+
+    work = (df['n_cats'] * df['n_steps']).to_numpy(dtype=float)
+    p    = df['cores'].to_numpy(dtype=float)
+    A    = np.column_stack([np.ones(len(df)), work / p, p - 1.0])
+
+    # columns scaled to unit norm, the work term is orders of magnitude larger than the others
+    scale = np.linalg.norm(A, axis=0)
+    if (np.linalg.matrix_rank(A / scale) < 3):
+        return None
+
+    coef = np.linalg.lstsq(A / scale, df['runtime_sec'].to_numpy(dtype=float), rcond=None)[0] / scale
+    startup_time, step_cost, rank_overhead = [float(c) for c in coef]
+    if (step_cost <= 0 or startup_time < 0 or rank_overhead < 0):
+        return None
+
+    return startup_time, step_cost, rank_overhead
+
+#############################################################################
+# returns the cost model (startup_time, step_cost, rank_overhead) of the model option fitted from the past
+# runtimes, or None if the runtimes do not determine it (runner.py then uses the nproc heuristic)
+# @param runtimes     : DataFrame of past successful runs (runtimes_columns)
+# @param model_option : model coupling option (e.g. NCP)
+# @param basin_id     : basin id, runs of the same basin are preferred if they determine the model
+#############################################################################
+def fit_cost_model(runtimes, model_option, basin_id = None):
+
+    if (runtimes is None or len(runtimes) == 0):
+        return None
+
+    df = runtimes[runtimes['model_option'] == model_option]
+    if (len(df) == 0):
+        return None
+
+    if (basin_id is not None):
+        cost = fit_runtimes(df[df['basin_id'] == str(basin_id)])
+        if (cost is not None):
+            return cost
+
+    return fit_runtimes(df)
+
+#############################################################################
+# returns the partition count minimizing the predicted runtime of a basin
+# @param ncats     : number of catchments
+# @param nsteps    : number of time steps
+# @param max_proc  : max number of ranks available to the basin
+# @param cost      : cost model (see fit_cost_model)
+# @param tolerance : relative runtime tolerance, the smallest partition count within it is chosen
+#                    (extra ranks saving less than tolerance are left to other basins)
+# - returns        : (nproc, predicted runtime [sec], expected speedup over a serial run)
+#############################################################################
+def optimal_partition(ncats, nsteps, max_proc, cost, tolerance = 0.05):
+
+    max_proc = max(min(int(max_proc), int(ncats)), 1)
+    nprocs   = np.arange(1, max_proc + 1)
+    runtime  = predict_runtime(ncats, nsteps, nprocs, cost)
+
+    nproc = int(nprocs[np.argmax(runtime <= runtime.min() * (1.0 + tolerance))])
+    runtime_p = float(predict_runtime(ncats, nsteps, nproc, cost))
+    speedup   = float(predict_runtime(ncats, nsteps, 1, cost)) / runtime_p
+
+    return nproc, runtime_p, speedup
+
+#############################################################################
+# reads/appends the past runtimes file (csv)
+#############################################################################
+def read_runtimes(runtimes_file):
+    if (not os.path.exists(runtimes_file)):
+        return None
+    return pd.read_csv(runtimes_file, dtype={'basin_id': str})
+
+def append_runtimes(runtimes_file, rows):
+    if (len(rows) == 0):
+        return
+    df = pd.DataFrame(rows, columns=runtimes_columns)
+    df.to_csv(runtimes_file, mode='a', index=False, header=not os.path.exists(runtimes_file))
+
+#############################################################################
+# returns content hash (sha256) of a geopackage; the hash is memoized by path, mtime and size in one file per
+# geopackage ({cache_dir}/gpkg_hashes/{path hash}.json), so unchanged geopackages are not read again and
+# concurrent basin runs never update the same file
+#############################################################################
+def get_gpkg_hash(gpkg_file, cache_dir):
+
+    gpkg_file = os.path.abspath(gpkg_file)
+    stat = os.stat(gpkg_file)
+    key  = [stat.st_mtime_ns, stat.st_size]
+
+    hashes_dir = os.path.join(cache_dir, "gpkg_hashes")
+    hash_file  = os.path.join(hashes_dir, hashlib.sha1(gpkg_file.encode()).hexdigest() + ".json")
+
+    try:
+        with open(hash_file, 'r') as infile:
+            path, file_key, gpkg_hash = json.load(infile)
+        if (path == gpkg_file and file_key == key):
+            return gpkg_hash
+    except:
+        pass
+
+    sha = hashlib.sha256()
+    with open(gpkg_file, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(1 << 20), b""):
+            sha.update(chunk)
+
+    os.makedirs(hashes_dir, exist_ok=True)
+    write_atomic(hash_file, json.dumps([gpkg_file, key, sha.hexdigest()]))
+
+    return sha.hexdigest()
+
+#############################################################################
+# writes a file through a temporary file, so concurrent readers never see partial files
+#############################################################################
+def write_atomic(file_name, text):
+    tmp_file = f"{file_name}.{platform.node()}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as outfile:
+        outfile.write(text)
+    os.replace(tmp_file, file_name)
+
+#############################################################################
+# returns True if the partition file is a valid ngen partition file with nproc non-empty partitions
+# (and ncats catchments in total, if given)
+#############################################################################
+def is_valid_partition_file(partition_file, nproc, ncats = None):
+
+    if (not os.path.isfile(partition_file)):
+        return False
+    try:
+        with open(partition_file, 'r') as infile:
+            partitions = json.load(infile)["partitions"]
+    except:
+        return False
+
+    if (len(partitions) != nproc):
+        return False
+
+    if (ncats is not None and sum(len(p.get("cat-ids", [])) for p in partitions) != ncats):
+        return False
+
+    return all(len(p.get("cat-ids", [])) > 0 for p in partitions)
+
+#############################################################################
+# provides the partition file of a geopackage for nproc ranks, from the cache if available
+# @param gpkg_file      : basin geopackage file
+# @param nproc          : number of ranks
+# @param partition_file : partition file used by the run (e.g. json/partition_4.json)
+# @param cache_dir      : partition cache directory
+# @param generate       : function generating partition_file (calls partitionGenerator)
+# @param ncats          : number of catchments of the basin (used for validation, optional)
+# - returns             : True if the partition file was taken from the cache
+#############################################################################
+def get_partition_file(gpkg_file, nproc, partition_file, cache_dir, generate, ncats = None):
+
+    os.makedirs(cache_dir, exist_ok=True)
+
+    gpkg_hash   = get_gpkg_hash(gpkg_file, cache_dir)
+    cached_file = os.path.join(cache_dir, f"{gpkg_hash}_{nproc}.json")
+
+    if (is_valid_partition_file(cached_file, nproc, ncats)):
+        shutil.copyfile(cached_file, partition_file)
+        return True
+
+    generate()
+
+    if (not is_valid_partition_file(partition_file, nproc, ncats)):
+        raise ValueError(f"partitionGenerator did not write a valid partition file ({partition_file})")
+
+    with open(partition_file, 'r') as infile:
+        write_atomic(cached_file, infile.read())
+
+    return False
@@ -12,10 +12,12 @@ The script generates realization files for a given model coupling option
 
 
 import os, sys
+import re
 import glob
 import json
 import subprocess
 import argparse
+import functools
 import pandas as pd
 import geopandas as gpd
 import numpy as np
@@ -373,23 +375,12 @@ def get_jinjabmi_unit_conversion_block(model_exe, config_dir):
     return block
 
 #############################################################################
-# module that calls all module blocks and assembles/writes full realization block/file
-# @param ngen_dir        : path to nextgen directory
-# @param forcing_dir : forcing data directory containing data for each catchment
-# @param config_dir        : input directory (config files of all models exist here under subdirectories)
-# @param realization file : name of the output realization file
-# @param coupled_models : models coupling option (pre-defined names; see main.py)
-# @param runoff_scheme  : surface runoff schemes - Options = Schaake or Xinanjiang (For CFE and SFT)
-# @param simulation_time  : dictionary containing simulation start/end time
-# @param baseline_casae   : boolean (if true, baseline scenario realization file is requested)
+# returns the models shared libraries under ngen_dir/extern (without extension), "" if a model has no library;
+# the libraries are discovered once per ngen_dir (per process) and shared by all basins of the run
 #############################################################################
-def write_realization_file(ngen_dir, forcing_dir, config_dir, realization_file,
-                           coupled_models, runoff_scheme, precip_partitioning_scheme,
-                           simulation_time, baseline_case, is_netcdf_forcing,
-                           is_troute, verbosity, sim_output_dir,
-                           is_calib):
+@functools.lru_cache(maxsize=None)
+def get_lib_files(ngen_dir):
 
-    lib_file = {}
     extern_path = os.path.join(ngen_dir, 'extern')
     models = os.listdir(extern_path)
     lib_files = {}
@@ -423,6 +414,19 @@ def write_realization_file(ngen_dir, forcing_dir, config_dir, realization_file,
             else:
                 lib_files[m] = ""
 
+    return lib_files
+
+#############################################################################
+# module that calls all module blocks and assembles the full realization block
+# (arguments: see write_realization_file)
+# - returns : dict
+#############################################################################
+def get_realization_block(ngen_dir, forcing_dir, config_dir, coupled_models, runoff_scheme,
+                          precip_partitioning_scheme, simulation_time, is_netcdf_forcing,
+                          is_troute, verbosity, sim_output_dir, is_calib, init_config_dir):
+
+    lib_files = get_lib_files(ngen_dir)
+
     if (verbosity >=3):
         print ("\n********** Models executables under extern directory **************")
         for key, value in lib_files.items():
@@ -432,7 +436,7 @@ def write_realization_file(ngen_dir, forcing_dir, config_dir, realization_file,
     nom_block = dict()
     if ("nom" in coupled_models):
         assert(lib_files['noah-owp-modular'] != "")
-        nom_block = get_noah_owp_modular_block(lib_files['noah-owp-modular'], config_dir)
+        nom_block = get_noah_owp_modular_block(lib_files['noah-owp-modular'], init_config_dir)
     
 
     # cfe
@@ -446,13 +450,13 @@ def write_realization_file(ngen_dir, forcing_dir, config_dir, realization_file,
         if ("pet" in coupled_models):
             is_pet_included = True
 
-        cfe_block = get_cfe_block(lib_files['cfe'], config_dir, cfe_standalone=False, cfe_with_pet = is_pet_included)
+        cfe_block = get_cfe_block(lib_files['cfe'], init_config_dir, cfe_standalone=False, cfe_with_pet = is_pet_included)
     
     # topmodel
     topmodel_block = dict()
     if ("topmodel" in coupled_models):
         assert (lib_files['topmodel'] != "")
-        topmodel_block = get_topmodel_block(lib_files['topmodel'], config_dir)
+        topmodel_block = get_topmodel_block(lib_files['topmodel'], init_config_dir)
     
     # sloth
     sloth_block = dict()
@@ -465,25 +469,25 @@ def write_realization_file(ngen_dir, forcing_dir, config_dir, realization_file,
     sft_block = dict()
     if ('sft' in coupled_models):
         assert (lib_files['SoilFreezeThaw'] != "")
-        sft_block = get_sft_block(lib_files['SoilFreezeThaw'], config_dir=config_dir)
+        sft_block = get_sft_block(lib_files['SoilFreezeThaw'], config_dir=init_config_dir)
     
     # smp
     smp_block = dict()
     if ('smp' in coupled_models):
         assert (lib_files['SoilMoistureProfiles'] != "")
-        smp_block = get_smp_block(lib_files['SoilMoistureProfiles'], config_dir, coupled_models)
+        smp_block = get_smp_block(lib_files['SoilMoistureProfiles'], init_config_dir, coupled_models)
 
     # lasam
     lasam_block = dict()
     if ('lasam' in coupled_models):
         if ("LASAM" in lib_files.keys()):
-            lasam_block = get_lasam_block(lib_files['LASAM'], config_dir)
+            lasam_block = get_lasam_block(lib_files['LASAM'], init_config_dir)
         elif ("LGAR-C" in lib_files.keys()):
-            lasam_block = get_lasam_block(lib_files['LGAR-C'], config_dir)
+            lasam_block = get_lasam_block(lib_files['LGAR-C'], init_config_dir)
 
     pet_block = dict()
     if (lib_files['evapotranspiration'] != ""):
-        pet_block = get_pet_block(lib_files['evapotranspiration'], config_dir)
+        pet_block = get_pet_block(lib_files['evapotranspiration'], init_config_dir)
 
 
     ##########################################################################
@@ -632,10 +636,89 @@ def write_realization_file(ngen_dir, forcing_dir, config_dir, realization_file,
 
     # replace formulations block
     root["global"]["formulations"] = [global_block]
-    
+
+    return root
+
+#############################################################################
+# realization template: the realization of all basins of a run differs only in paths and times, the block is
+# built once per set of options with placeholders (@@name@@) for the per-basin values and rendered per basin
+#############################################################################
+template_fields = ["forcing_dir", "config_dir", "init_config_dir", "sim_output_dir", "start_time", "end_time"]
+
+@functools.lru_cache(maxsize=None)
+def get_realization_template(ngen_dir, coupled_models, runoff_scheme, precip_partitioning_scheme,
+                             is_netcdf_forcing, is_troute, is_calib, verbosity):
+
+    fields = {name : f"@@{name}@@" for name in template_fields}
+
+    root = get_realization_block(ngen_dir                   = ngen_dir,
+                                 forcing_dir                = fields["forcing_dir"],
+                                 config_dir                 = fields["config_dir"],
+                                 coupled_models             = coupled_models,
+                                 runoff_scheme              = runoff_scheme,
+                                 precip_partitioning_scheme = precip_partitioning_scheme,
+                                 simulation_time            = fields,
+                                 is_netcdf_forcing          = is_netcdf_forcing,
+                                 is_troute                  = is_troute,
+                                 verbosity                  = verbosity,
+                                 sim_output_dir             = fields["sim_output_dir"],
+                                 is_calib                   = is_calib,
+                                 init_config_dir            = fields["init_config_dir"])
+
+    return json.dumps(root, indent=4, separators=(", ", ": "), sort_keys=False)
+
+#############################################################################
+# substitutes the per-basin values in the template; "@@dir@@/" stands for os.path.join(dir, ...) in the blocks,
+# so it is replaced by os.path.join(value, "") (same result for empty values and values with a trailing slash)
+# @param template : realization template (see get_realization_template)
+# @param values   : dict of the template fields values
+#############################################################################
+def render_realization(template, values):
+
+    def substitute(match):
+        value = str(values[match.group(1)])
+        if (match.group(2)):
+            value = os.path.join(value, "")
+        return json.dumps(value)[1:-1] # escaped as in a json string
+
+    return re.sub(r"@@(\w+)@@(/?)", substitute, template)
+
+#############################################################################
+# module that writes the realization file of a basin (rendered from the realization template of the options)
+# @param ngen_dir        : path to nextgen directory
+# @param forcing_dir : forcing data directory containing data for each catchment
+# @param config_dir        : input directory (config files of all models exist here under subdirectories)
+# @param realization file : name of the output realization file
+# @param coupled_models : models coupling option (pre-defined names; see main.py)
+# @param runoff_scheme  : surface runoff schemes - Options = Schaake or Xinanjiang (For CFE and SFT)
+# @param simulation_time  : dictionary containing simulation start/end time
+# @param baseline_casae   : boolean (if true, baseline scenario realization file is requested)
+# @param init_config_dir  : directory of the per-catchment config files used in init_config (defaults to config_dir),
+#                           e.g. node-local directory the config archive is extracted to (see config_archive.py)
+#############################################################################
+def write_realization_file(ngen_dir, forcing_dir, config_dir, realization_file,
+                           coupled_models, runoff_scheme, precip_partitioning_scheme,
+                           simulation_time, baseline_case, is_netcdf_forcing,
+                           is_troute, verbosity, sim_output_dir,
+                           is_calib, init_config_dir = None):
+
+    # per-catchment config files are read from init_config_dir (e.g. extracted config archive), if provided
+    if (init_config_dir is None or init_config_dir == ""):
+        init_config_dir = config_dir
+
+    template = get_realization_template(ngen_dir, coupled_models, runoff_scheme, precip_partitioning_scheme,
+                                        str(is_netcdf_forcing), str(is_troute), str(is_calib), verbosity)
+
+    realization = render_realization(template, {"forcing_dir"     : forcing_dir,
+                                                "config_dir"      : config_dir,
+                                                "init_config_dir" : init_config_dir,
+                                                "sim_output_dir"  : sim_output_dir,
+                                                "start_time"      : simulation_time['start_time'],
+                                                "end_time"        : simulation_time['end_time']})
+
     # save realization file as .json
     with open(realization_file, 'w') as outfile:
-        json.dump(root, outfile, indent=4, separators=(", ", ": "), sort_keys=False)
+        outfile.write(realization)
 
     
 
@@ -657,6 +740,8 @@ def main():
         parser.add_argument("-v", dest="verbosity",   type=int, required=False, default=False, help="verbosity option (0, 1, 2)")
         parser.add_argument("-sout",   dest="sim_output_dir",  type=str, required=True,  help="ngen runs output directory")
         parser.add_argument("-c",      dest="calib",     type=str, required=False, default=False, help="option for calibration")
+        parser.add_argument("-initdir", dest="init_config_dir", type=str, required=False, default=None,
+                            help="per-catchment config files directory used in init_config (e.g. extracted config archive)")
         args = parser.parse_args()
     except:
         parser.print_help()
@@ -699,7 +784,8 @@ def main():
         is_troute         = args.troute,
         verbosity         = args.verbosity,
         sim_output_dir    = args.sim_output_dir,
-        is_calib          = args.calib
+        is_calib          = args.calib,
+        init_config_dir   = args.init_config_dir
     )
 
 
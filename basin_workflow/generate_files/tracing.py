@@ -0,0 +1,194 @@
+"""
+Instrumentation of the workflow stages, basins and sub-steps
+ - each timed span is appended as one JSON line to the trace file (trace_file in the `simulations` block
+   of config_workflow.yaml); lines are Chrome trace "complete" events (ph = X, ts/dur in microseconds),
+   args hold wall time, CPU time [sec], memory [MB] and, if requested, the number of files written
+ - memory of commands run with call (workflow stages, forcing_prep basins): max_rss_mb, the peak RSS of the
+   command (largest process of its process tree), from the rusage of os.wait4
+ - memory of in-process spans (basins and sub-steps in pool workers): rss_mb and rss_delta_mb, the RSS at the end of
+   the span and its change over the span (linux /proc); max_rss_mb only if the peak RSS of the process was reached
+   within the span (ru_maxrss is a lifetime maximum of the worker, a lower peak within the span is not measurable)
+ - the trace file is passed to subprocesses and pool workers through the BASIN_WORKFLOW_TRACE
+   environment variable, all processes append to the same file
+ - tracing is disabled (no-op) if no trace file is set
+ - convert to a Chrome trace (chrome://tracing, https://ui.perfetto.dev):
+   python tracing.py workflow_trace.jsonl -o workflow_trace.json
+"""
+
+import os, sys
+import json
+import time
+import resource
+import subprocess
+import argparse
+import threading
+from contextlib import contextmanager
+
+trace_env = "BASIN_WORKFLOW_TRACE"
+
+#############################################################################
+# enables tracing to trace_file (also for subprocesses started afterwards); empty string keeps the
+# trace file inherited from the parent process, if any
+#############################################################################
+def init(trace_file = ""):
+    if (trace_file):
+        os.environ[trace_env] = os.path.abspath(trace_file)
+    return get_trace_file()
+
+def get_trace_file():
+    return os.environ.get(trace_env, "")
+
+def is_enabled():
+    return get_trace_file() != ""
+
+# peak RSS [MB] of this process or of its terminated children (ru_maxrss is in KB on linux, bytes on macOS)
+def get_max_rss(who = resource.RUSAGE_SELF):
+    return rss_to_mb(resource.getrusage(who).ru_maxrss)
+
+def rss_to_mb(rss):
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+# current RSS [MB] of this process, None where /proc is not available (e.g. macOS)
+def get_rss():
+    try:
+        with open("/proc/self/statm", 'r') as infile:
+            return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+def get_cpu_time(who = resource.RUSAGE_SELF):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+def count_files(path):
+    return sum(len(files) for _, _, files in os.walk(path))
+
+#############################################################################
+# appends an event to the trace file
+# @param name  : span name (e.g. basin id, model name)
+# @param cat   : category (stage, basin, step, run)
+# @param start : start time (time.time())
+# @param end   : end time (time.time())
+# @param args  : dict of values shown with the event
+#############################################################################
+def record(name, cat, start, end, args = None):
+    trace_file = get_trace_file()
+    if (not trace_file):
+        return
+
+    event = {"name" : str(name), "cat" : cat, "ph" : "X",
+             "ts"  : int(start * 1e6), "dur" : int((end - start) * 1e6),
+             "pid" : os.getpid(), "tid" : threading.get_ident() % 100000,
+             "args": dict(args or {}, wall_sec = round(end - start, 6))}
+
+    with open(trace_file, 'a') as outfile:
+        outfile.write(json.dumps(event) + "\n")
+
+#############################################################################
+# times a block of code and appends it to the trace file
+# @param name     : span name
+# @param cat      : category (stage, basin, step, run)
+# @param children : True if the work is done by subprocesses (CPU time of terminated children; no memory,
+#                    the children maximum covers all children ever terminated, use call to get the peak RSS of a
+#                    command)
+# @param files    : directory whose files are counted at the end of the span (optional)
+# @param args     : additional values shown with the event (e.g. basin id)
+#############################################################################
+@contextmanager
+def span(name, cat = "step", children = False, files = None, **args):
+    if (not is_enabled()):
+        yield
+        return
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    start = time.time()
+    cpu_start = get_cpu_time(who)
+    max_rss_start = get_max_rss()
+    rss_start = get_rss()
+    try:
+        yield
+    finally:
+        end = time.time()
+        args["cpu_sec"] = round(get_cpu_time(who) - cpu_start, 6)
+        if (not children):
+            max_rss = get_max_rss()
+            if (max_rss > max_rss_start):
+                args["max_rss_mb"] = round(max_rss, 2)
+            rss = get_rss()
+            if (rss is not None and rss_start is not None):
+                args["rss_mb"] = round(rss, 2)
+                args["rss_delta_mb"] = round(rss - rss_start, 2)
+        if (files is not None and os.path.isdir(files)):
+            args["nfiles"] = count_files(files)
+        record(name, cat, start, end, args)
+
+#############################################################################
+# runs a shell command (same as subprocess.call) and appends it to the trace file with the CPU time and peak RSS
+# of the command (rusage of os.wait4, covers the processes of the command; the peak RSS is at least the RSS of this
+# process at fork, linux keeps it across exec)
+# @param command : shell command
+# @param name    : span name
+# @param cat     : category (stage, basin)
+# @param files   : directory whose files are counted at the end of the span (optional)
+# @param env     : environment of the command (optional)
+# @param cwd     : working directory of the command (optional)
+# @param args    : additional values shown with the event
+# - returns      : exit code of the command
+#############################################################################
+def call(command, name, cat = "stage", files = None, env = None, cwd = None, **args):
+    if (not is_enabled()):
+        return subprocess.call(command, shell=True, env=env, cwd=cwd)
+
+    start = time.time()
+    process = subprocess.Popen(command, shell=True, env=env, cwd=cwd)
+    try:
+        _, wait_status, usage = os.wait4(process.pid, 0)
+    except:
+        process.kill()
+        process.wait()
+        raise
+    end = time.time()
+
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+
+    args["exit_code"]  = process.returncode
+    args["cpu_sec"]    = round(usage.ru_utime + usage.ru_stime, 6)
+    args["max_rss_mb"] = round(rss_to_mb(usage.ru_maxrss), 2)
+    if (files is not None and os.path.isdir(files)):
+        args["nfiles"] = count_files(files)
+    record(name, cat, start, end, args)
+
+    return process.returncode
+
+#############################################################################
+# converts the JSON-lines trace to a Chrome trace file
+#############################################################################
+def to_chrome_trace(trace_file, out_file):
+    events = []
+    with open(trace_file, 'r') as infile:
+        for line in infile:
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError:
+                pass # line of an interrupted process
+
+    with open(out_file, 'w') as outfile:
+        json.dump({"traceEvents" : events, "displayTimeUnit" : "ms"}, outfile)
+
+    return len(events)
+
+if __name__ == "__main__":
+    try:
+        parser = argparse.ArgumentParser()
+        parser.add_argument("trace_file", type=str, help="JSON-lines trace file")
+        parser.add_argument("-o", dest="out_file", type=str, required=False, default="",
+                            help="Chrome trace file (default: trace_file with .json extension)")
+    except:
+        parser.print_help()
+        sys.exit(0)
+
+    args = parser.parse_args()
+    out_file = args.out_file if args.out_file else os.path.splitext(args.trace_file)[0] + ".json"
+
+    nevents = to_chrome_trace(args.trace_file, out_file)
+    print (f"Chrome trace ({nevents} events): {out_file}")
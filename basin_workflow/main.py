@@ -5,21 +5,26 @@
 ############################################################################################
 
 import os, sys
-import subprocess
 import yaml
 import argparse
 from pathlib import Path
+from generate_files import tracing
 
 path = Path(sys.argv[0]).resolve()
 workflow_dir = path.parent
 
 
 def runner(config_workflow, config_calib):
-    
+
+    # timings of all stages (and of the basins/sub-steps within them) go to the workflow trace
+    with open(config_workflow, 'r') as file:
+        d = yaml.safe_load(file)
+    tracing.init(d['simulations'].get('trace_file', ""))
+
     if (args.gpkg):
         print ("Generating geopackages...")
         generate_gpkg = f"Rscript {workflow_dir}/giuh_twi/main.R {config_workflow}"
-        status = subprocess.call(generate_gpkg,shell=True)
+        status = tracing.call(generate_gpkg, "gpkg", cat = "stage")
 
         if (status):
             sys.exit("Failed during generating geopackge(s) step...")
@@ -29,7 +34,7 @@ def runner(config_workflow, config_calib):
     if (args.forc):
         print ("Generating forcing data...")
         generate_forcing = f"python {workflow_dir}/generate_files/forcing.py {config_workflow}"
-        status = subprocess.call(generate_forcing,shell=True)
+        status = tracing.call(generate_forcing, "forcing", cat = "stage")
 
         if (status):
             sys.exit("Failed during generating geopackge(s) step...")
@@ -39,7 +44,7 @@ def runner(config_workflow, config_calib):
     if (args.conf):
         print ("Generating config files...")
         generate_configs = f"python {workflow_dir}/generate_files/main.py {config_workflow}"
-        status = subprocess.call(generate_configs,shell=True)
+        status = tracing.call(generate_configs, "configs", cat = "stage", files = d['output_dir'])
 
         if (status):
             sys.exit("Failed during generating config files step...")
@@ -50,11 +55,8 @@ def runner(config_workflow, config_calib):
         print ("Calling Runner ...")
         #infile = f"{workflow_dir}/configs/config_workflow.yaml"
         
-        with open(config_workflow, 'r') as file:
-            d = yaml.safe_load(file)
-
         run_command = f"python {workflow_dir}/runner.py {config_workflow} {config_calib}"
-        status = subprocess.call(run_command,shell=True)
+        status = tracing.call(run_command, "run", cat = "stage")
 
         if (status):
             sys.exit("Failed during ngen-cal execution...")
@@ -62,6 +64,9 @@ def runner(config_workflow, config_calib):
             print ("DONE \u2713")
     
     print ("**********************************")
+
+    if (tracing.is_enabled()):
+        print (f"Workflow trace: {tracing.get_trace_file()} (convert with generate_files/tracing.py)")
     
     
 
@@ -10,8 +10,13 @@ import glob
 import yaml
 import platform
 from generate_files import configuration
+from generate_files import config_archive
+from generate_files import partition
+from generate_files import tracing
 import json
+import time
 from pathlib import Path
+from dataclasses import dataclass
 
 os_name = platform.system()
 workflow_infile   = sys.argv[1]
@@ -26,8 +31,137 @@ output_dir       = d["output_dir"]
 ngen_dir         = dsim["ngen_dir"]
 nproc            = int(dsim.get('num_processors_sim', 1))
 nproc_adaptive   = int(dsim.get('num_processors_adaptive', True))
+model_option     = dsim['model_option']
 is_calibration   = dsim.get('is_calibration', False)
 simulation_time  = json.loads(dsim["simulation_time"])
+is_config_archive  = dsim.get('config_archive', False)
+config_archive_dir = dsim.get('config_archive_dir', "")
+troute_output_format = dsim.get('troute_output_format', "csv")
+# total cores shared by concurrent basin runs (each basin uses up to num_processors_sim MPI ranks)
+ncores_total     = int(dsim.get('num_processors_total', os.cpu_count()))
+# past runtimes of successful runs, used by the partition cost model (see generate_files/partition.py)
+runtimes_file    = os.path.join(output_dir, "ngen_runtimes.csv")
+# partitionGenerator outputs cached by geopackage content and number of ranks
+partition_cache_dir = dsim.get('partition_cache_dir', os.path.join(output_dir, "partition_cache"))
+
+# run/partitioning timings are appended to the workflow trace (see generate_files/tracing.py)
+tracing.init(dsim.get('trace_file', ""))
+
+#
+# extract the basin config archive (configs/configs.tar) to the directory read by ngen (see config_archive.py)
+#
+def extract_basin_configs(dir):
+
+    archive_file = os.path.join(dir, "configs", config_archive.archive_name)
+
+    if (config_archive_dir == ""):
+        extract_dir = os.path.join(dir, "configs")
+    else:
+        extract_dir = config_archive_dir.replace("{*}", os.path.basename(dir))
+
+    nfiles = config_archive.extract_config_archive(archive_file, extract_dir)
+    print (f"Extracted {nfiles} config files to {extract_dir}", flush = True)
+
+#
+# ngen run of a basin, scheduled by run_basin_jobs
+#
+@dataclass
+class BasinJob:
+    basin_id : str
+    n_cats   : int
+    cores    : int
+    command  : str
+    run_dir  : str
+    log_file : str
+    status   : int = None
+    start_time : float = None
+    end_time   : float = None
+    process    : subprocess.Popen = None
+
+    @property
+    def runtime(self):
+        if (self.start_time is None or self.end_time is None):
+            return None
+        return round(self.end_time - self.start_time, 2)
+
+#
+# writes the per-basin runtime/status report
+#
+def write_jobs_report(jobs, report_file):
+    df = pd.DataFrame({
+        "basin_id"    : [job.basin_id for job in jobs],
+        "n_cats"      : [job.n_cats for job in jobs],
+        "cores"       : [job.cores for job in jobs],
+        "status"      : ["Running" if job.process is not None and job.status is None else
+                         "Pending" if job.status is None else
+                         "Passed"  if job.status == 0 else "Failed" for job in jobs],
+        "exit_code"   : [job.status for job in jobs],
+        "runtime_sec" : [job.runtime for job in jobs],
+        "log_file"    : [job.log_file for job in jobs]
+    })
+    df.to_csv(report_file, index=False)
+
+#
+# runs basin jobs concurrently on a core budget, wide (MPI) jobs are started first and
+# small (single core) jobs fill the remaining cores; the report is updated as jobs finish
+#
+def run_basin_jobs(jobs, core_budget, report_file, poll_interval = 1.0):
+
+    # jobs with a status already (e.g. failed during setup) are only reported
+    pending = sorted([job for job in jobs if job.status is None], key=lambda job: job.cores, reverse=True)
+    running = []
+    free_cores = core_budget
+
+    write_jobs_report(jobs, report_file)
+
+    while (len(pending) > 0 or len(running) > 0):
+
+        for job in list(pending):
+            # a job wider than the core budget runs alone
+            if (job.cores > free_cores and len(running) > 0):
+                continue
+
+            print ("Running basin %s on cores %s ********"%(job.basin_id, job.cores), flush = True)
+            print (f"Run command: {job.command} ", flush = True)
+
+            log = open(job.log_file, 'w')
+            job.start_time = time.time()
+            job.process = subprocess.Popen(job.command, shell=True, cwd=job.run_dir, stdout=log, stderr=subprocess.STDOUT)
+            log.close()
+
+            free_cores -= job.cores
+            pending.remove(job)
+            running.append(job)
+
+        time.sleep(poll_interval if len(running) > 0 else 0)
+
+        for job in list(running):
+            # reaped with wait4 for the resource usage of this job (CPU time, peak RSS of the job processes;
+            # the peak RSS is at least the RSS of this process at fork, linux keeps it across exec)
+            pid, wait_status, usage = os.wait4(job.process.pid, os.WNOHANG)
+            if (pid == 0):
+                continue
+
+            status = os.waitstatus_to_exitcode(wait_status)
+            job.process.returncode = status
+            job.status   = status
+            job.end_time = time.time()
+            free_cores  += job.cores
+            running.remove(job)
+
+            str_status = "Passed" if status == 0 else "Failed (exit code %s, see %s)"%(status, job.log_file)
+            print ("Basin %s %s in %s [sec]"%(job.basin_id, str_status, job.runtime), flush = True)
+
+            if (tracing.is_enabled()):
+                tracing.record(job.basin_id, "run", job.start_time, job.end_time,
+                               {"cores" : job.cores, "exit_code" : status,
+                                "cpu_sec" : round(usage.ru_utime + usage.ru_stime, 6),
+                                "max_rss_mb" : round(tracing.rss_to_mb(usage.ru_maxrss), 2),
+                                "nfiles" : tracing.count_files(os.path.join(job.run_dir, "outputs"))})
+
+            write_jobs_report(jobs, report_file)
+
+    return jobs
 
 #
 #
@@ -38,30 +172,39 @@ def run_ngen_without_calibration():
 
     ngen_exe = os.path.join(ngen_dir, "cmake_build/ngen")
 
-    
+    jobs = []
     for id, ncats in zip(indata["basin_id"], indata['n_cats']):
 
         ncats = int(ncats)
         
         dir = os.path.join(output_dir, id)
-        os.chdir(dir)
+
+        if (is_config_archive):
+            extract_basin_configs(dir)
 
         gpkg_name  = os.path.basename(glob.glob(dir + "/data/*.gpkg")[0])
         gpkg_file  = f"data/{gpkg_name}" 
 
-        nproc_local = nproc
+        # a basin never gets more cores than the total budget
+        nproc_local = min(nproc, ncores_total)
+
+        log_file = os.path.join(dir, "outputs", "ngen_run.log")
 
         file_par = ""
         if (nproc_local > 1):
-            nproc_local, file_par = generate_partition_basin_file(ncats, gpkg_file)
-        
-        print ("Running basin %s on cores %s ********"%(id, nproc_local), flush = True)
+            try:
+                nproc_local, file_par = generate_partition_basin_file(ncats, gpkg_file, dir, nproc_local, id)
+            except ValueError as e:
+                print ("Basin %s Failed (%s)"%(id, e), flush = True)
+                jobs.append(BasinJob(basin_id = id, n_cats = ncats, cores = nproc_local, command = "", run_dir = dir,
+                                     log_file = log_file, status = -1))
+                continue
         
-        realization = glob.glob("json/realization_*.json")
+        realization = glob.glob(dir + "/json/realization_*.json")
         
         assert (len(realization) == 1)
 
-        realization = realization[0]
+        realization = os.path.relpath(realization[0], dir)
         
         if (nproc_local == 1):
             run_cmd = f'{ngen_exe} {gpkg_file} all {gpkg_file} all {realization}'
@@ -70,32 +213,130 @@ def run_ngen_without_calibration():
 
         if os_name == "Darwin":
             run_cmd = f'PYTHONEXECUTABLE=$(which python) {run_cmd}'
-        
-        print (f"Run command: {run_cmd} ", flush = True)
-        result = subprocess.call(run_cmd,shell=True)
+
+        jobs.append(BasinJob(basin_id = id, n_cats = ncats, cores = nproc_local, command = run_cmd, run_dir = dir,
+                             log_file = log_file))
+
+    report_file = os.path.join(output_dir, "basins_run_status.csv")
+    run_basin_jobs(jobs, ncores_total, report_file)
+
+    nsteps = partition.get_num_steps(simulation_time)
+    partition.append_runtimes(runtimes_file, [[job.basin_id, model_option, job.n_cats, nsteps, job.cores, job.runtime]
+                                              for job in jobs if job.status == 0])
+
+    nfailed = len([job for job in jobs if job.status != 0])
+    print ("Basins run: %s, failed: %s (see %s)"%(len(jobs), nfailed, report_file), flush = True)
 
     
+#
+# reads the calibration progress of a basin from the ngen-cal logs of all (resumed) runs under the basin
+# directory: {workdir}/*_worker/*objective*.txt (lines "iteration, objective") and the parameter
+# state file *_parameter_df_state.parquet (one column per iteration)
+# - returns : dict (last_iteration, iterations, best_iteration, best_objective, best_params) or None if not started
+#
+def read_calib_progress(dir):
+
+    worker_dirs = sorted(glob.glob(os.path.join(dir, "*_worker")), key=os.path.getmtime)
+
+    objective = {}
+    for wdir in worker_dirs:
+        for f in glob.glob(os.path.join(wdir, "*objective*.txt")):
+            with open(f, 'r') as infile:
+                for line in infile:
+                    # header, blank or partially written (interrupted run) lines
+                    try:
+                        i, value = line.replace(",", " ").split()[:2]
+                        objective[int(i)] = float(value)
+                    except ValueError:
+                        pass
+
+    if (len(objective) == 0):
+        return None
+
+    # ngen-cal minimizes the objective function
+    best_iteration = min(objective, key=objective.get)
+
+    best_params = {}
+    param_files = [f for wdir in worker_dirs for f in glob.glob(os.path.join(wdir, "*_parameter_df_state.parquet"))]
+    if (len(param_files) > 0):
+        try:
+            df = pd.read_parquet(param_files[-1])
+            name = "param" if "param" in df.columns else "name"
+            if (str(best_iteration) in df.columns):
+                best_params = dict(zip(df[name], df[str(best_iteration)]))
+        except (OSError, ValueError, KeyError) as e:
+            print ("Basin %s: could not read the parameter state file %s (%s), best parameters not reported"
+                   %(os.path.basename(os.path.normpath(dir)), param_files[-1], e), flush = True)
+
+    return {"last_iteration" : max(objective),
+            "iterations"     : sorted(objective),
+            "best_iteration" : best_iteration,
+            "best_objective" : objective[best_iteration],
+            "best_params"    : best_params}
+
+#
+# writes the calibration summary table (best objective and parameters of each basin)
+#
+def write_calib_summary(jobs, iterations, summary_file):
+
+    rows = []
+    for job in jobs:
+        progress = read_calib_progress(job.run_dir)
+        row = {"basin_id" : job.basin_id, "n_cats" : job.n_cats, "cores" : job.cores,
+               "exit_code" : job.status, "runtime_sec" : job.runtime}
+        if (progress is not None):
+            row["iterations_done"] = progress["last_iteration"]
+            row["completed"]       = progress["last_iteration"] >= iterations
+            row["best_iteration"]  = progress["best_iteration"]
+            row["best_objective"]  = progress["best_objective"]
+            row.update(progress["best_params"])
+        rows.append(row)
+
+    pd.DataFrame(rows).to_csv(summary_file, index=False)
+
+#
+# runs ngen-cal for all basins concurrently on the core budget (see run_basin_jobs); interrupted
+# calibrations are resumed from the last completed iteration, completed ones are skipped
+#
 def run_ngen_with_calibration():
 
     infile = os.path.join(output_dir, "basins_passed.csv")
     indata = pd.read_csv(infile, dtype=str)
    
-    #path = Path(sys.argv[0]).resolve() # get the absolute path
-    
-    #ngen_cal_basefile = sys.argv[1] #os.path.join(path_arg1.parent,Path(sys.argv[1]).name)
-   
+    with open(ngen_cal_basefile, 'r') as file:
+        iterations = int(yaml.safe_load(file)['general']['iterations'])
+
+    jobs = []
+    skipped = []
+    start_iterations = {}
     for id, ncats in zip(indata["basin_id"], indata['n_cats']):
 
         ncats = int(ncats)
         
         dir = os.path.join(output_dir, id)
-        os.chdir(dir)
+
+        log_file = os.path.join(dir, "outputs", "ngen_cal.log")
+
+        progress = read_calib_progress(dir)
+        start_iteration = None
+        if (progress is not None):
+            if (progress["last_iteration"] >= iterations):
+                print ("Basin %s calibration completed (%s iterations), skipping ********"%(id, iterations), flush = True)
+                skipped.append(BasinJob(basin_id = id, n_cats = ncats, cores = 0, command = "", run_dir = dir,
+                                        log_file = log_file, status = 0))
+                continue
+            start_iteration = progress["last_iteration"] + 1
+            print ("Basin %s resuming calibration from iteration %s ********"%(id, start_iteration), flush = True)
+        start_iterations[id] = start_iteration
+
+        if (is_config_archive):
+            extract_basin_configs(dir)
 
         gpkg_file = glob.glob(dir + "/data/*.gpkg")[0]
         gpkg_name  = os.path.basename(gpkg_file).split(".")[0]
-        nproc_local = nproc
-        
-        start_time = pd.Timestamp(simulation_time['start_time']).strftime("%Y%m%d%H%M")
+
+        # a basin never gets more cores than the total budget
+        nproc_local = min(nproc, ncores_total)
         
         #troute_output_file = os.path.join(dir, "outputs/troute", "troute_output_{}.csv".format(start_time))
         troute_output_file = os.path.join(dir, "outputs/troute", "flowveldepth_{}.csv".format(gpkg_name))
@@ -103,9 +344,14 @@ def run_ngen_with_calibration():
 
         file_par = ""
         if (nproc_local > 1):
-            nproc_local, file_par = generate_partition_basin_file(ncats, gpkg_file)
+            try:
+                nproc_local, file_par = generate_partition_basin_file(ncats, gpkg_file, dir, nproc_local, id)
+            except ValueError as e:
+                print ("Basin %s Failed (%s)"%(id, e), flush = True)
+                jobs.append(BasinJob(basin_id = id, n_cats = ncats, cores = nproc_local, command = "", run_dir = dir,
+                                     log_file = log_file, status = -1))
+                continue
             file_par = os.path.join(dir, file_par)
-        print ("Running basin %s on cores %s ********"%(id, nproc_local), flush = True)
         
         realization = glob.glob(dir+"/json/realization_*.json")
 
@@ -120,18 +366,61 @@ def run_ngen_with_calibration():
                                               realz_file_par = file_par,
                                               ngen_cal_basefile = ngen_cal_basefile,
                                               num_proc = nproc_local,
-                                              troute_output_file = troute_output_file)
-        #quit()
-        run_command = f"python -m ngen.cal configs/calib_config.yaml"  
-        result = subprocess.call(run_command,shell=True)
+                                              troute_output_file = troute_output_file,
+                                              start_iteration = start_iteration,
+                                              troute_output_format = troute_output_format)
+
+        run_command = f"python -m ngen.cal configs/calib_config.yaml"
+
+        jobs.append(BasinJob(basin_id = id, n_cats = ncats, cores = nproc_local, command = run_command, run_dir = dir,
+                             log_file = log_file))
+
+    report_file = os.path.join(output_dir, "basins_run_status.csv")
+    run_basin_jobs(jobs, ncores_total, report_file)
+
+    summary_file = os.path.join(output_dir, "calib_summary.csv")
+    write_calib_summary(skipped + jobs, iterations, summary_file)
+
+    # runtimes of calibration runs are recorded per iteration (one ngen run per iteration)
+    nsteps = partition.get_num_steps(simulation_time)
+    rows = []
+    for job in jobs:
+        progress = read_calib_progress(job.run_dir) if job.status == 0 else None
+        if (progress is None):
+            continue
+        first_iteration = start_iterations[job.basin_id]
+        if (first_iteration is None):
+            first_iteration = min(progress["iterations"])
+        niterations = len([i for i in progress["iterations"] if i >= first_iteration])
+        if (niterations > 0):
+            rows.append([job.basin_id, model_option, job.n_cats, nsteps, job.cores, round(job.runtime / niterations, 2)])
+    partition.append_runtimes(runtimes_file, rows)
+
+    nfailed = len([job for job in jobs if job.status != 0])
+    print ("Basins calibrated: %s, skipped (completed): %s, failed: %s (see %s)"%(len(jobs), len(skipped), nfailed,
+                                                                                  summary_file), flush = True)
 
 #####################################################################
-def generate_partition_basin_file(ncats, gpkg_file):
+# adaptive: partition count predicted by the cost model (generate_files/partition.py) with
+# nproc_local as the max number of ranks (nproc heuristic until the runtimes of the model option determine
+# the cost model, i.e. runs at two or more core counts are recorded),
+# otherwise nproc_local ranks (at most one per catchment)
+def generate_partition_basin_file(ncats, gpkg_file, dir, nproc_local, basin_id):
 
-    nproc_local = nproc
     json_dir   = "json"
 
-    if (ncats <= nproc_local):
+    cost = None
+    if(nproc_adaptive):
+        runtimes = partition.read_runtimes(runtimes_file)
+        cost     = partition.fit_cost_model(runtimes, model_option, basin_id)
+
+    if (cost is not None):
+        nsteps = partition.get_num_steps(simulation_time)
+
+        nproc_local, runtime, speedup = partition.optimal_partition(ncats, nsteps, nproc_local, cost)
+        print ("Basin %s: %s partitions, expected runtime %s [sec], expected speedup %sx"
+               %(basin_id, nproc_local, round(runtime, 1), round(speedup, 2)), flush = True)
+    elif (ncats <= nproc_local):
         nproc_local = ncats
     elif(nproc_adaptive):
         nproc_local = min(int(ncats/nproc_local), 20)
@@ -140,8 +429,15 @@ def generate_partition_basin_file(ncats, gpkg_file):
     
     if (nproc_local > 1):
         fpar = os.path.join(json_dir, f"partition_{nproc_local}.json")
-        partition=f"{ngen_dir}/cmake_build/partitionGenerator {gpkg_file} {gpkg_file} {fpar} {nproc_local} \"\" \"\" "
-        result = subprocess.call(partition,shell=True)
+        str_partition=f"{ngen_dir}/cmake_build/partitionGenerator {gpkg_file} {gpkg_file} {fpar} {nproc_local} \"\" \"\" "
+
+        with tracing.span("partition", basin = basin_id, nproc = nproc_local):
+            is_cached = partition.get_partition_file(os.path.join(dir, gpkg_file), nproc_local, os.path.join(dir, fpar),
+                                                     partition_cache_dir,
+                                                     lambda: subprocess.call(str_partition,shell=True,cwd=dir),
+                                                     ncats = ncats)
+        if (is_cached):
+            print ("Basin %s: partition file taken from the cache"%basin_id, flush = True)
 
     return nproc_local, fpar
 
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# workflow modules are imported as `generate_files.<module>` (same as main.py and runner.py)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+import xarray as xr
+
+from generate_files import aorc
+
+url_template = "{source}/{year}.zarr"
+
+
+# local yearly zarr store standing in for the AORC s3 bucket (4 x 4 grid, 6 hourly steps)
+@pytest.fixture
+def aorc_source(tmp_path):
+    time = pd.date_range("2010-01-01", periods=6, freq="h")
+    lat  = np.array([40.0, 40.01, 40.02, 40.03])
+    lon  = np.array([-100.0, -99.99, -99.98, -99.97])
+
+    rng = np.random.default_rng(0)
+    ds = xr.Dataset({var : (("time", "latitude", "longitude"), rng.random((6, 4, 4)).astype(np.float32))
+                     for var in aorc.aorc_variables},
+                    coords = {"time" : time, "latitude" : lat, "longitude" : lon})
+
+    encoding = {var : {"chunks" : (4, 2, 2)} for var in aorc.aorc_variables}
+    ds.to_zarr(tmp_path / "2010.zarr", encoding=encoding, zarr_format=2)
+
+    return str(tmp_path), ds
+
+
+def get_cells():
+    # cat-1 averages two cells in different spatial chunks, cat-2 is one cell
+    weights = scipy.sparse.csr_matrix(np.array([[0.25, 0.0],
+                                                [0.75, 0.0],
+                                                [0.0,  1.0]]))
+    return aorc.BasinCells(gpkg_file = "basin.gpkg", divide_ids = np.array(["cat-1", "cat-2"]),
+                           iy = np.array([0, 1, 3]), ix = np.array([1, 2, 3]), weights = weights)
+
+
+def test_grid_of_local_store(aorc_source):
+    source, ds = aorc_source
+    grid = aorc.get_aorc_grid(source, url_template, 2010)
+
+    assert grid.chunks == (4, 2, 2)
+    assert len(grid.time) == 6
+    np.testing.assert_allclose(grid.lat, ds["latitude"].values)
+
+
+def test_missing_local_store(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        aorc.get_aorc_grid(str(tmp_path), url_template, 1999)
+
+
+def test_basin_forcing_from_chunk_cache(aorc_source, tmp_path):
+    source, ds = aorc_source
+    grid  = aorc.get_aorc_grid(source, url_template, 2010)
+    cells = get_cells()
+    cache_dir = str(tmp_path / "cache")
+
+    tasks = aorc.get_fetch_tasks([cells], [grid], source, url_template, cache_dir, "longitude", "latitude")
+    # 2 time chunks x 3 spatial chunks holding the cells
+    assert len(tasks) == 6
+    assert sum(aorc.fetch_chunk(task) for task in tasks) == 6 * len(aorc.aorc_variables)
+    # cached chunks are not fetched again
+    assert sum(aorc.fetch_chunk(task) for task in tasks) == 0
+
+    out_file = str(tmp_path / "forcing" / "basin.nc")
+    aorc.write_basin_forcing(cells, [grid], cache_dir, out_file)
+
+    with xr.open_dataset(out_file, decode_times=False) as out:
+        assert list(out["ids"].values) == ["cat-1", "cat-2"]
+        assert "precip_rate" not in out
+
+        seconds = (pd.DatetimeIndex(ds["time"].values) - aorc.epoch) // pd.Timedelta(seconds=1)
+        np.testing.assert_array_equal(out["Time"].values[1], seconds)
+
+        for var in aorc.aorc_variables:
+            values = ds[var].values
+            expected = np.stack([0.25 * values[:, 0, 1] + 0.75 * values[:, 1, 2], values[:, 3, 3]])
+            if (var == "APCP_surface"):
+                expected = expected / 3600.0
+            np.testing.assert_allclose(out[var].values, expected, rtol=1e-6)
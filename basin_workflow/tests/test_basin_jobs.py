@@ -0,0 +1,117 @@
+import zlib
+
+import pytest
+
+from generate_files import basin_jobs
+
+
+def make_basin(output_dir, name, basin_id):
+    data_dir = output_dir / name / "data"
+    data_dir.mkdir(parents=True)
+    (data_dir / f"Gage_{basin_id}.gpkg").write_bytes(b"")
+
+
+@pytest.fixture(autouse=True)
+def no_shard_env(monkeypatch):
+    monkeypatch.delenv(basin_jobs.shard_env, raising=False)
+
+
+def test_get_shard():
+    assert basin_jobs.get_shard("") == (0, 1)
+    assert basin_jobs.get_shard("3/16") == (3, 16)
+
+
+def test_get_shard_environment_overrides(monkeypatch):
+    monkeypatch.setenv(basin_jobs.shard_env, "1/4")
+    assert basin_jobs.get_shard("0/2") == (1, 4)
+
+
+@pytest.mark.parametrize("shard", ["4/4", "-1/4", "1", "a/b"])
+def test_invalid_shard(shard):
+    with pytest.raises(SystemExit):
+        basin_jobs.get_shard(shard)
+
+
+def test_shards_partition_the_basins():
+    basin_ids = [f"{i:08d}" for i in range(200)]
+    shards = [[b for b in basin_ids if basin_jobs.in_shard(b, i, 4)] for i in range(4)]
+
+    assert sorted(sum(shards, [])) == basin_ids
+    for i, shard in enumerate(shards):
+        assert all(zlib.crc32(b.encode()) % 4 == i for b in shard)
+
+
+def test_jobs_of_shard(tmp_path):
+    basin_ids = ["01047000", "01052500", "01054200", "01055000", "01057000"]
+    for basin_id in basin_ids:
+        make_basin(tmp_path, f"basin_{basin_id}", basin_id)
+
+    jobs = [basin_jobs.get_jobs(str(tmp_path), shard_index=i, shard_count=2) for i in range(2)]
+    assert sorted(job["basin_id"] for job in jobs[0] + jobs[1]) == basin_ids
+
+    # the manifest of the first scan is reused
+    make_basin(tmp_path, "basin_02000000", "02000000")
+    jobs = basin_jobs.get_jobs(str(tmp_path), rescan=False)
+    assert [job["basin_id"] for job in jobs] == basin_ids
+
+
+def test_forcing_index_token_match():
+    index = basin_jobs.ForcingIndex(["f/basin_01047000_2010.nc", "f/basin_01052500_2010.nc", "f/basin_1047.nc"])
+
+    assert index.lookup("01047000") == "f/basin_01047000_2010.nc"
+    assert index.lookup("1047") == "f/basin_1047.nc"
+    # exact tokens only, no substring matches
+    assert index.lookup("0104") is None
+    # token shared by several files
+    assert index.lookup("2010") is None
+
+
+def test_forcing_index_id_pattern():
+    files = ["f/forcing_01047000.nc", "f/forcing_01052500.nc", "f/readme.nc"]
+    index = basin_jobs.ForcingIndex(files, id_pattern="forcing_(?P<id>[0-9]+)")
+
+    assert index.lookup("01047000") == "f/forcing_01047000.nc"
+    assert index.lookup("forcing") is None
+    assert index.lookup("readme") is None
+
+
+def test_forcing_resolver_directory_index(tmp_path):
+    forcing_dir = tmp_path / "forcing"
+    forcing_dir.mkdir()
+    (forcing_dir / "basin_01047000.nc").write_bytes(b"")
+
+    basins = [{"basin_id": "01047000"}, {"basin_id": "01052500"}]
+    resolver = basin_jobs.ForcingResolver(forcing_source="local", forcing_dir=str(forcing_dir))
+    resolver.resolve(basins)
+
+    assert basins[0]["forcing_file"] == str(forcing_dir / "basin_01047000.nc")
+    assert basins[1]["forcing_file"] is None
+
+
+def test_reused_manifest_forcing_is_checked(tmp_path):
+    output_dir = tmp_path / "basins"
+    for basin_id in ["01047000", "01052500"]:
+        make_basin(output_dir, f"basin_{basin_id}", basin_id)
+
+    forcing1 = tmp_path / "forcing1"
+    forcing2 = tmp_path / "forcing2"
+    for forcing_dir in [forcing1, forcing2]:
+        forcing_dir.mkdir()
+        (forcing_dir / "basin_01047000.nc").write_bytes(b"")
+        (forcing_dir / "basin_01052500.nc").write_bytes(b"")
+
+    def get_forcing(forcing_dir):
+        resolver = basin_jobs.ForcingResolver(forcing_source="local", forcing_dir=str(forcing_dir))
+        jobs = basin_jobs.get_jobs(str(output_dir), resolver, rescan=False)
+        return {job["basin_id"]: job["forcing_file"] for job in jobs}
+
+    assert get_forcing(forcing1)["01047000"] == str(forcing1 / "basin_01047000.nc")
+
+    # forcing settings changed since the manifest was written
+    assert get_forcing(forcing2)["01047000"] == str(forcing2 / "basin_01047000.nc")
+
+    # stored forcing file removed
+    (forcing1 / "basin_01047000.nc").unlink()
+    forcing = get_forcing(forcing1)
+    assert forcing["01047000"] is None
+    assert forcing["01052500"] == str(forcing1 / "basin_01052500.nc")
@@ -0,0 +1,65 @@
+import json
+import os
+
+import pytest
+
+from generate_files import config_archive
+
+
+@pytest.fixture
+def archive_file(tmp_path):
+    root_dir = tmp_path / "configs"
+    params_dir = tmp_path / "parameters"
+    (params_dir / "sub").mkdir(parents=True)
+    (params_dir / "SOILPARM.TBL").write_text("soil")
+    (params_dir / "sub" / "MPTABLE.TBL").write_bytes(b"\x00mp")
+
+    archive_file = str(root_dir / config_archive.archive_name)
+    root_dir.mkdir()
+    with config_archive.ConfigArchive(archive_file, str(root_dir)) as archive:
+        archive.add(str(root_dir / "cfe" / "cat-1.txt"), "cfe config")
+        archive.add(str(root_dir / "cfe" / "cat-2.txt"), "x" * 600)   # spans two tar blocks
+        archive.add(str(root_dir / "pet" / "cat-1.txt"), b"")
+        archive.add_dir(str(root_dir / "nom" / "parameters"), str(params_dir))
+
+    return archive_file
+
+
+def check_files(output_dir):
+    assert (output_dir / "cfe" / "cat-1.txt").read_text() == "cfe config"
+    assert (output_dir / "cfe" / "cat-2.txt").read_text() == "x" * 600
+    assert (output_dir / "pet" / "cat-1.txt").read_text() == ""
+    assert (output_dir / "nom" / "parameters" / "SOILPARM.TBL").read_text() == "soil"
+    assert (output_dir / "nom" / "parameters" / "sub" / "MPTABLE.TBL").read_bytes() == b"\x00mp"
+
+
+def test_extract_with_index(archive_file, tmp_path):
+    output_dir = tmp_path / "scratch"
+    assert config_archive.extract_config_archive(archive_file, str(output_dir)) == 5
+    check_files(output_dir)
+
+
+def test_extract_without_index(archive_file, tmp_path):
+    os.remove(config_archive.get_index_file(archive_file))
+
+    output_dir = tmp_path / "scratch"
+    assert config_archive.extract_config_archive(archive_file, str(output_dir)) == 5
+    check_files(output_dir)
+
+
+def test_read_config_file(archive_file):
+    assert config_archive.read_config_file(archive_file, os.path.join("cfe", "cat-2.txt")) == "x" * 600
+    assert config_archive.read_config_file(archive_file, os.path.join("cfe", "cat-1.txt")) == "cfe config"
+
+
+def test_index_member_outside_output_dir(archive_file, tmp_path):
+    index_file = config_archive.get_index_file(archive_file)
+    with open(index_file, 'r') as infile:
+        index = json.load(infile)
+    index[os.path.join("..", "escaped.txt")] = index[os.path.join("cfe", "cat-1.txt")]
+    with open(index_file, 'w') as outfile:
+        json.dump(index, outfile)
+
+    with pytest.raises(SystemExit):
+        config_archive.extract_config_archive(archive_file, str(tmp_path / "scratch"))
+    assert not (tmp_path / "escaped.txt").exists()
@@ -0,0 +1,69 @@
+import os
+
+from generate_files import manifest
+
+
+def test_stale_until_updated(tmp_path):
+    m = manifest.Manifest(str(tmp_path / manifest.manifest_name))
+    inputs = {"model_option": "NCP", "ncats": 10}
+
+    assert m.is_stale("cfe", inputs)
+    m.update("cfe", inputs, value=10)
+    assert not m.is_stale("cfe", inputs)
+    assert m.get_value("cfe") == 10
+
+
+def test_stale_after_input_change(tmp_path):
+    m = manifest.Manifest(str(tmp_path / manifest.manifest_name))
+    m.update("cfe", {"model_option": "NCP"})
+
+    assert m.is_stale("cfe", {"model_option": "CFE"})
+
+    m.remove("cfe")
+    assert m.is_stale("cfe", {"model_option": "NCP"})
+
+
+def test_stale_if_output_missing(tmp_path):
+    m = manifest.Manifest(str(tmp_path / manifest.manifest_name))
+    output = tmp_path / "cfe"
+    output.mkdir()
+    m.update("cfe", {})
+
+    assert not m.is_stale("cfe", {}, [str(output)])
+    output.rmdir()
+    assert m.is_stale("cfe", {}, [str(output)])
+
+
+def test_file_inputs(tmp_path):
+    soil_file = tmp_path / "SOILPARM.TBL"
+    soil_file.write_text("a")
+    m = manifest.Manifest(str(tmp_path / manifest.manifest_name))
+
+    inputs = {"soil": manifest.file_hash(str(soil_file))}
+    m.update("nom", inputs)
+
+    soil_file.write_text("b")
+    assert m.is_stale("nom", {"soil": manifest.file_hash(str(soil_file))})
+    assert manifest.file_stat(str(tmp_path / "missing")) is None
+
+
+def test_save_round_trip(tmp_path):
+    manifest_file = str(tmp_path / manifest.manifest_name)
+    m = manifest.Manifest(manifest_file)
+    m.update("realization", {"ncats": 5}, value=5)
+    m.save()
+
+    # no temporary file is left behind
+    assert os.listdir(tmp_path) == [manifest.manifest_name]
+
+    m = manifest.Manifest(manifest_file)
+    assert not m.is_stale("realization", {"ncats": 5})
+    assert m.get_value("realization") == 5
+
+
+def test_corrupt_manifest_is_empty(tmp_path):
+    manifest_file = tmp_path / manifest.manifest_name
+    manifest_file.write_text("{")
+
+    m = manifest.Manifest(str(manifest_file))
+    assert m.artifacts == {}
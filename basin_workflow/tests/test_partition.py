@@ -0,0 +1,120 @@
+import json
+import os
+
+import pandas as pd
+import pytest
+
+from generate_files import partition
+
+
+def write_partition_file(partition_file, cat_ids):
+    partitions = [{"id": i, "cat-ids": ids, "nex-ids": [], "remote-connections": []} for i, ids in enumerate(cat_ids)]
+    with open(partition_file, 'w') as outfile:
+        json.dump({"partitions": partitions}, outfile)
+
+
+@pytest.fixture
+def gpkg_file(tmp_path):
+    gpkg_file = tmp_path / "Gage_01047000.gpkg"
+    gpkg_file.write_bytes(b"gpkg")
+    return str(gpkg_file)
+
+
+def test_valid_partition_file(tmp_path):
+    partition_file = str(tmp_path / "partition_2.json")
+    write_partition_file(partition_file, [["cat-1", "cat-2"], ["cat-3"]])
+
+    assert partition.is_valid_partition_file(partition_file, 2)
+    assert partition.is_valid_partition_file(partition_file, 2, ncats=3)
+    assert not partition.is_valid_partition_file(partition_file, 2, ncats=4)
+    assert not partition.is_valid_partition_file(partition_file, 3)
+
+
+def test_invalid_partition_file(tmp_path):
+    partition_file = tmp_path / "partition_2.json"
+    assert not partition.is_valid_partition_file(str(partition_file), 2)
+
+    write_partition_file(str(partition_file), [["cat-1"], []])
+    assert not partition.is_valid_partition_file(str(partition_file), 2)
+
+    partition_file.write_text('{"partitions": [')
+    assert not partition.is_valid_partition_file(str(partition_file), 2)
+
+
+def test_partition_file_cache(gpkg_file, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    calls = []
+
+    def generate(partition_file):
+        calls.append(partition_file)
+        write_partition_file(partition_file, [["cat-1"], ["cat-2"]])
+
+    run1 = str(tmp_path / "run1.json")
+    assert not partition.get_partition_file(gpkg_file, 2, run1, cache_dir, lambda: generate(run1), ncats=2)
+
+    run2 = str(tmp_path / "run2.json")
+    assert partition.get_partition_file(gpkg_file, 2, run2, cache_dir, lambda: generate(run2), ncats=2)
+    assert calls == [run1]
+    assert partition.is_valid_partition_file(run2, 2, ncats=2)
+
+
+def test_partition_file_not_generated(gpkg_file, tmp_path):
+    partition_file = str(tmp_path / "partition_2.json")
+    with pytest.raises(ValueError):
+        partition.get_partition_file(gpkg_file, 2, partition_file, str(tmp_path / "cache"), lambda: None)
+
+
+def test_gpkg_hash_follows_changes(gpkg_file, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+
+    hash1 = partition.get_gpkg_hash(gpkg_file, cache_dir)
+    assert partition.get_gpkg_hash(gpkg_file, cache_dir) == hash1
+    assert len(os.listdir(os.path.join(cache_dir, "gpkg_hashes"))) == 1
+
+    with open(gpkg_file, 'wb') as outfile:
+        outfile.write(b"changed geopackage")
+    assert partition.get_gpkg_hash(gpkg_file, cache_dir) != hash1
+
+
+def make_runtimes(basin_id, ncats, cost, cores_list):
+    return [[basin_id, "NCP", ncats, 24, cores, float(partition.predict_runtime(ncats, 24, cores, cost))]
+            for cores in cores_list]
+
+
+def test_fit_cost_model():
+    assert partition.fit_cost_model(None, "NCP") is None
+
+    cost = (3.0, 1.0e-4, 0.2)
+    rows = make_runtimes("01047000", 1000, cost, [1, 2, 4]) + make_runtimes("01052500", 5000, cost, [1, 8])
+    runtimes = pd.DataFrame(rows, columns=partition.runtimes_columns)
+
+    assert partition.fit_cost_model(runtimes, "CFE") is None
+    assert partition.fit_cost_model(runtimes, "NCP", "01047000") == pytest.approx(cost)
+    # two core counts of one basin do not determine the model, the runs of all basins are used
+    assert partition.fit_cost_model(runtimes, "NCP", "01052500") == pytest.approx(cost)
+
+
+def test_cost_model_needs_two_core_counts():
+    rows = make_runtimes("01047000", 1000, (3.0, 1.0e-4, 0.2), [4, 4])
+    rows += make_runtimes("01052500", 5000, (3.0, 1.0e-4, 0.2), [4])
+    assert partition.fit_cost_model(pd.DataFrame(rows, columns=partition.runtimes_columns), "NCP") is None
+
+
+def test_cost_model_not_physical():
+    # runtime decreasing with the work: negative step cost
+    rows = [["01047000", "NCP", 1000, 24, 1, 10.0], ["01047000", "NCP", 1000, 24, 2, 12.0],
+            ["01052500", "NCP", 5000, 24, 1, 8.0]]
+    assert partition.fit_cost_model(pd.DataFrame(rows, columns=partition.runtimes_columns), "NCP") is None
+
+
+def test_optimal_partition():
+    # fixed costs only: one rank
+    nproc, runtime, speedup = partition.optimal_partition(10, 24, 8, (2.0, 0.0, 0.5))
+    assert (nproc, speedup) == (1, 1.0)
+
+    # large basin: more ranks, never more than catchments or max_proc
+    cost = (2.0, 1.0e-4, 0.5)
+    nproc, runtime, speedup = partition.optimal_partition(10000, 8760, 16, cost)
+    assert 1 < nproc <= 16 and speedup > 1.0
+    assert runtime == pytest.approx(float(partition.predict_runtime(10000, 8760, nproc, cost)))
+    assert partition.optimal_partition(3, 8760, 16, (2.0, 1.0, 0.5))[0] <= 3
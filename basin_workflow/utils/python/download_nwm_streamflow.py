@@ -1,67 +1,173 @@
+import os, sys
+import json
+import argparse
 import xarray as xr
-import requests
 import pandas as pd
 import numpy as np
-from matplotlib import pyplot as plt
-import matplotlib.dates as mdates
 
+# NWM 3.0 retrospective streamflow (dimensions: time, feature_id); a local zarr store with the same
+# layout can be used instead (e.g. for tests)
+#awspath2 ='https://noaa-nwm-retrospective-2-1-zarr-pds.s3.amazonaws.com/ldasout.zarr'
+awspath3  = 'https://noaa-nwm-retrospective-3-0-pds.s3.amazonaws.com/CONUS/zarr/chrtout.zarr'
+#nwm_url  = 's3://noaa-nwm-retrospective-3-0-pds/CONUS/zarr/chrtout.zarr' # this also works
 
-from dataretrieval import nwis, utils, codes, nldi
+# local cache: gage -> COMID mappings (comids.json) and per-gage streamflow (streamflow/{gage_id}.parquet)
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "nwm_streamflow")
+
+
+def get_gage_id(gage_id):
+    #gage_id = "USGS-01052500"
+    if not 'USGS' in gage_id:
+        gage_id = 'USGS-'+gage_id
+    return gage_id
 
 
 def get_comid(fid):
+    from dataretrieval import nldi
     gdf = nldi.get_features(feature_source="WQP", feature_id=fid)
     comid = int(gdf['comid'][0])
 
     return comid
 
+#############################################################################
+# returns COMIDs of the gages, NLDI is queried only for gages not in the cache (cache_dir/comids.json)
+#############################################################################
+def get_comids(gage_ids, cache_dir = default_cache_dir):
 
-def get_stream_discharge(gage_id, start_time, end_time):
+    comids_file = os.path.join(cache_dir, "comids.json")
+    comids = {}
+    if (os.path.exists(comids_file)):
+        with open(comids_file, 'r') as infile:
+            comids = json.load(infile)
 
-    #gage_id = "USGS-01052500"
-    if not 'USGS' in gage_id:
-        gage_id = 'USGS-'+gage_id
+    missing = [g for g in gage_ids if g not in comids]
+    for gage_id in missing:
+        comids[gage_id] = get_comid(gage_id)
+
+    if (len(missing) > 0):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{comids_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as outfile:
+            json.dump(comids, outfile, indent=2)
+        os.replace(tmp_file, comids_file)
+
+    return {g : comids[g] for g in gage_ids}
+
+
+def get_streamflow_file(cache_dir, gage_id):
+    return os.path.join(cache_dir, "streamflow", f"{gage_id}.parquet")
+
+# returns the cached streamflow of a gage if it covers the time window, else None
+def read_cached_streamflow(cache_dir, gage_id, start_time, end_time):
+    streamflow_file = get_streamflow_file(cache_dir, gage_id)
+    if (not os.path.exists(streamflow_file)):
+        return None
+
+    df = pd.read_parquet(streamflow_file)
+    if (len(df) == 0 or df['time'].min() > pd.Timestamp(start_time) or df['time'].max() < pd.Timestamp(end_time)):
+        return None
+
+    # same (label based) time slicing as the selection from the zarr store
+    df = df.set_index('time').sort_index().loc[start_time:end_time]
+    return df.reset_index()
+
+# merges the fetched streamflow into the gage store
+def write_cached_streamflow(cache_dir, gage_id, df):
+    streamflow_file = get_streamflow_file(cache_dir, gage_id)
+    os.makedirs(os.path.dirname(streamflow_file), exist_ok=True)
+
+    if (os.path.exists(streamflow_file)):
+        df = pd.concat([pd.read_parquet(streamflow_file), df])
+        df = df.drop_duplicates(subset='time', keep='last').sort_values('time')
+
+    tmp_file = f"{streamflow_file}.{os.getpid()}.tmp"
+    df.to_parquet(tmp_file, index=False)
+    os.replace(tmp_file, streamflow_file)
+
+#############################################################################
+# returns NWM retrospective streamflow of many gages
+# - cached gages are read from the local store (cache_dir/streamflow), the other gages are fetched
+#   together: all their feature_ids are selected in one indexed selection, so each zarr chunk is read once
+# @param gage_ids   : list of USGS gage ids
+# @param start_time : start time
+# @param end_time   : end time
+# @param cache_dir  : local cache directory
+# @param nwm_url    : NWM chrtout zarr store (S3 or local path)
+# - returns         : dict {gage_id : DataFrame (time [hour], flow [m3 s-1])}
+#############################################################################
+def get_stream_discharge_gages(gage_ids, start_time, end_time, cache_dir = default_cache_dir, nwm_url = awspath3):
+
+    gage_ids = [get_gage_id(g) for g in gage_ids]
+
+    flows = {}
+    for gage_id in gage_ids:
+        df = read_cached_streamflow(cache_dir, gage_id, start_time, end_time)
+        if (df is not None):
+            flows[gage_id] = df
+
+    missing = [g for g in gage_ids if g not in flows]
+    if (len(missing) == 0):
+        return flows
+
+    comids = get_comids(missing, cache_dir)
+
+    ds = xr.open_zarr(nwm_url, consolidated=True)
 
-    comid = get_comid(gage_id)
-    
-    #awspath2 ='https://noaa-nwm-retrospective-2-1-zarr-pds.s3.amazonaws.com/ldasout.zarr'
-    
-    awspath3  = 'https://noaa-nwm-retrospective-3-0-pds.s3.amazonaws.com/CONUS/zarr/chrtout.zarr'
-    #nwm_url  = 's3://noaa-nwm-retrospective-3-0-pds/CONUS/zarr/chrtout.zarr' # this also works
-    
-    ds = xr.open_zarr(awspath3,consolidated=True)
-
-    nwm_streamflow = ds['streamflow']
-    
-    #nwm_streamflow has dimensions ('time', 'feature_id')
     # slice the time dimension by range of start and end times
-    nwm_streamflow = nwm_streamflow.sel(time=slice(start_time, end_time))
-    
-    # slice feature_id dimension by comid
-    flow_data = nwm_streamflow.sel(feature_id=comid)
-    
-    df = pd.DataFrame({
-        'time': flow_data.time,
-        'flow': flow_data.data
-    })
+    nwm_streamflow = ds['streamflow'].sel(time=slice(start_time, end_time))
+
+    # feature_ids of all gages (sorted positions, chunks are read once)
+    positions = ds.indexes['feature_id'].get_indexer([comids[g] for g in missing])
+    found = [g for g, p in zip(missing, positions) if p >= 0]
+    for gage_id in missing:
+        if (gage_id not in found):
+            print (f"COMID {comids[gage_id]} of gage {gage_id} is not in the NWM streamflow data")
+
+    if (len(found) == 0):
+        return flows
+
+    positions = positions[positions >= 0]
+    order = np.argsort(positions)
+    flow_data = nwm_streamflow.isel(feature_id=positions[order]).load()
+
+    time = pd.to_datetime(flow_data['time'].values)
+    for k, i in enumerate(order):
+        gage_id = found[i]
+        df = pd.DataFrame({
+            'time': time,
+            'flow': flow_data.values[:, k].astype(np.float64)
+        })
+        write_cached_streamflow(cache_dir, gage_id, df)
+        flows[gage_id] = df
+
+    return {g : flows[g] for g in gage_ids if g in flows}
+
+
+def get_stream_discharge(gage_id, start_time, end_time, cache_dir = default_cache_dir, nwm_url = awspath3):
+
+    flows = get_stream_discharge_gages([gage_id], start_time, end_time, cache_dir, nwm_url)
 
     # time units [hour]
     # flow units [m3 s-1]
-    return df
+    return flows.get(get_gage_id(gage_id))
 
 if __name__ == "__main__":
 
-
-     try:
+    try:
         parser = argparse.ArgumentParser()
-        parser.add_argument("-gid", dest="gage_id",    type=str, required=True,  help="USGS gage ID")
-        parser.add_argument("-s",   dest="start_rime", type=str, required=True,  help="start time")
+        parser.add_argument("-gid", dest="gage_ids",   type=str, required=True,  nargs='+', help="USGS gage ID(s)")
+        parser.add_argument("-s",   dest="start_time", type=str, required=True,  help="start time")
         parser.add_argument("-e",   dest="end_time",   type=str, required=True,  help="end time")
+        parser.add_argument("-c",   dest="cache_dir",  type=str, required=False, default=default_cache_dir,
+                            help="local cache directory")
+        parser.add_argument("-u",   dest="nwm_url",    type=str, required=False, default=awspath3,
+                            help="NWM chrtout zarr store")
     except:
         parser.print_help()
         sys.exit(1)
-    
+
     args = parser.parse_args()
-    
-    get_stream_discharge(args.gage_id, args.start_time, args.end_time)
-    
+
+    flows = get_stream_discharge_gages(args.gage_ids, args.start_time, args.end_time, args.cache_dir, args.nwm_url)
+    for gage_id, df in flows.items():
+        print (f"{gage_id}: {len(df)} time steps, stored in {get_streamflow_file(args.cache_dir, gage_id)}")
@@ -2,32 +2,95 @@ from glob import glob
 import os
 import geopandas as gpd
 import netCDF4
+import numpy as np
 import pandas as pd
 
 gpkg_file = 'Gage_*.gpkg'
 troute_ncfile="troute_output_*.nc"
 
-# identify outlet nexus draining to stream gage
-gage = os.path.basename(gpkg_file).split('.')[0].split('_')[1]
-nexdf = gpd.read_file(gpkg_file, layer="nexus").dropna()
-if nexdf['hl_uri'].values[0].split('-')[1] == gage:
-    nexs = nexdf['id'].tolist()
-
-# identify catchments draining to outlet nexus
-div = gpd.read_file(gpkg_file, layer="divides")
-wbs = div[div['toid'].isin(nexs)]['divide_id'].tolist()
-wblst = [int(wb.split('-')[1]) for wb in wbs]
-
-# get streamflow corresponding to the selected catchments
-ncvar = netCDF4.Dataset(troute_ncfile, "r")
-fid_index = [list(ncvar['feature_id'][0:]).index(fid) for fid in wblst]
-output = pd.DataFrame(data={'sim_flow': pd.DataFrame(ncvar['flow'][fid_index], index=fid_index).T.sum(axis=1)})
-
-# add time range
-nexfile = list(glob("nex*.csv"))[0]
-nexdf = pd.read_csv(nexfile, index_col=0, parse_dates=[1], names=['ts', 'time', 'Q']).set_index('time')
-dt_range = pd.date_range(nexdf.index[1], nexdf.index[-1], len(output.index)).round('min')
-output.index = dt_range
-output = output.resample('1H').first()
-output.index.name='Time'
-output.reset_index(inplace=True)
+#############################################################################
+# returns the segments (catchment ids, integers) draining to the outlet nexus of each gage in the geopackage
+# - returns : dict {gage_id : list of segment ids}
+#############################################################################
+def get_gage_segments(gpkg_file):
+    # identify outlet nexus draining to stream gages
+    nexdf = gpd.read_file(gpkg_file, layer="nexus", ignore_geometry=True).dropna(subset=['hl_uri'])
+    nex_gage = dict(zip(nexdf['id'], nexdf['hl_uri'].map(lambda x: x.split('-')[1])))
+
+    # identify catchments draining to outlet nexus
+    div = gpd.read_file(gpkg_file, layer="divides", ignore_geometry=True)
+    div = div[div['toid'].isin(nex_gage.keys())]
+
+    segments = {}
+    for toid, divide_id in zip(div['toid'], div['divide_id']):
+        segments.setdefault(nex_gage[toid], []).append(int(divide_id.split('-')[1]))
+    return segments
+
+#############################################################################
+# returns the times of the t-route output: the time variable of the file if present, otherwise
+# evenly spaced over the period of the nexus output file (nex-*.csv), rounded to minutes
+#############################################################################
+def get_troute_times(ncvar, ntimes, nexfile = None):
+    if ('time' in ncvar.variables and hasattr(ncvar['time'], 'units')):
+        times = netCDF4.num2date(ncvar['time'][:], ncvar['time'].units, only_use_cftime_datetimes=False,
+                                 only_use_python_datetimes=True)
+        return pd.DatetimeIndex(times)
+
+    nexdf = pd.read_csv(nexfile, index_col=0, parse_dates=[1], names=['ts', 'time', 'Q']).set_index('time')
+    return pd.date_range(nexdf.index[1], nexdf.index[-1], ntimes).round('min')
+
+#############################################################################
+# sums the t-route flows of the segments of many gages
+# - the feature_id index (hash) is built once, only the rows of the needed segments are read and the
+#   flows of each gage are summed with numpy
+# @param troute_ncfile : t-route output file (troute_output_*.nc)
+# @param gage_segments : dict {gage_id : list of segment ids} (see get_gage_segments)
+# @param nexfile       : nexus output file used for the times if the t-route file has no time variable
+# @param resample      : resampling frequency of the output ('1h'), None keeps the t-route time steps
+# - returns            : DataFrame of simulated flows (index: Time, one column per gage)
+#############################################################################
+def read_gage_flows(troute_ncfile, gage_segments, nexfile = None, resample = '1h'):
+
+    with netCDF4.Dataset(troute_ncfile, "r") as ncvar:
+        feature_index = pd.Index(np.asarray(ncvar['feature_id'][:]))
+
+        gages = list(gage_segments.keys())
+        segments = np.concatenate([np.asarray(gage_segments[g], dtype=np.int64) for g in gages])
+        positions = feature_index.get_indexer(segments)
+        if (np.any(positions < 0)):
+            raise ValueError(f"segments not in {troute_ncfile}: {segments[positions < 0].tolist()}")
+
+        # read the needed rows once (sorted, unique)
+        rows, inverse = np.unique(positions, return_inverse=True)
+        flow = np.ma.filled(ncvar['flow'][rows, :].astype(np.float64), np.nan)
+
+        # missing (masked/NaN) flows of a segment are skipped in the gage sums, as in pandas sum
+        flow[np.isnan(flow)] = 0.0
+
+        times = get_troute_times(ncvar, flow.shape[1], nexfile)
+
+    # sum the segments of each gage (rows of the gage are contiguous in segments)
+    counts = [len(gage_segments[g]) for g in gages]
+    flows = np.add.reduceat(flow[inverse.ravel()], np.cumsum([0] + counts[:-1]), axis=0)
+
+    output = pd.DataFrame(flows.T, index=times, columns=gages)
+    if (resample is not None):
+        output = output.resample(resample).first()
+    output.index.name = 'Time'
+
+    return output
+
+
+if __name__ == "__main__":
+
+    gpkg_file = glob(gpkg_file)[0]
+    troute_ncfile = glob(troute_ncfile)[0]
+    nexfile = list(glob("nex*.csv"))[0]
+
+    # streamflow at the gage of the geopackage
+    gage = os.path.basename(gpkg_file).split('.')[0].split('_')[1]
+    segments = get_gage_segments(gpkg_file)
+
+    output = read_gage_flows(troute_ncfile, {gage : segments[gage]}, nexfile)
+    output = output.rename(columns={gage : 'sim_flow'})
+    output.reset_index(inplace=True)